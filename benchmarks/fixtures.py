@@ -0,0 +1,453 @@
+# Payloads for benchmarks, shaped like the responses of the remote sources
+# (Overpass and DBpedia), but generated deterministically at any size so that
+# benchmarks need no network access.
+
+import csv
+import io
+import json
+import math
+import random
+import zlib
+from datetime import datetime
+from itertools import batched, pairwise
+from xml.sax.saxutils import escape, quoteattr
+
+from powdb.common.record import Place
+
+RELIGIONS = ["christian", "muslim", "buddhist", "hindu", "jewish", "sikh", None]
+DENOMINATIONS = ["anglican", "catholic", "methodist", "presbyterian", None]
+LANGS = ["en", "de", "fr", "mi", "zh"]
+
+_XSD_FLOAT = "http://www.w3.org/2001/XMLSchema#float"
+
+
+def _coords(rng: random.Random) -> tuple[float, float]:
+    return round(rng.uniform(-47, -34), 7), round(rng.uniform(166, 179), 7)
+
+
+def _tags(rng: random.Random, i: int) -> dict[str, str]:
+    tags = {"amenity": "place_of_worship", "name": f"St {i}'s Church"}
+    if (religion := rng.choice(RELIGIONS)) is not None:
+        tags["religion"] = religion
+    if (denomination := rng.choice(DENOMINATIONS)) is not None:
+        tags["denomination"] = denomination
+    return tags
+
+
+def overpass(nodes: int, ways: int, relations: int, seed: int = 0) -> bytes:
+    """
+    Return the body of an Overpass response to `church_query`: tagged nodes,
+    ways (of 8 nodes), and multipolygon relations (of 2 outer ways), followed
+    by the skeleton nodes and ways that they reference.
+    """
+    rng = random.Random(seed)
+    tagged, skeleton = [], []
+    next_id = 1
+
+    def meta() -> dict:
+        return {
+            "timestamp": "2025-01-01T00:00:00Z",
+            "version": rng.randint(1, 20),
+            "changeset": rng.randrange(10**8),
+            "user": "mapper",
+            "uid": rng.randrange(10**6),
+        }
+
+    def way_nodes(lat: float, lon: float) -> list[int]:
+        nonlocal next_id
+        refs = []
+        for k in range(8):
+            skeleton.append(
+                {
+                    "type": "node",
+                    "id": next_id,
+                    "lat": lat + (k // 4) * 1e-4,
+                    "lon": lon + (k % 4) * 1e-4,
+                }
+            )
+            refs.append(next_id)
+            next_id += 1
+        return [*refs, refs[0]]
+
+    for i in range(nodes):
+        lat, lon = _coords(rng)
+        tagged.append(
+            {
+                "type": "node",
+                "id": next_id,
+                "lat": lat,
+                "lon": lon,
+                **meta(),
+                "tags": _tags(rng, i),
+            }
+        )
+        next_id += 1
+
+    for i in range(ways):
+        tagged.append(
+            {
+                "type": "way",
+                "id": i + 1,
+                **meta(),
+                "nodes": way_nodes(*_coords(rng)),
+                "tags": _tags(rng, i),
+            }
+        )
+
+    for i in range(relations):
+        members = []
+        lat, lon = _coords(rng)
+        for k in range(2):
+            w = ways + 2 * i + k + 1
+            refs = way_nodes(lat + k * 1e-3, lon)
+            skeleton.append({"type": "way", "id": w, "nodes": refs})
+            members.append({"type": "way", "ref": w, "role": "outer"})
+        tagged.append(
+            {
+                "type": "relation",
+                "id": i + 1,
+                **meta(),
+                "members": members,
+                "tags": {"type": "multipolygon", **_tags(rng, i)},
+            }
+        )
+
+    return json.dumps(
+        {
+            "version": 0.6,
+            "generator": "Overpass API",
+            "osm3s": {
+                "timestamp_osm_base": "2025-06-01T00:00:00Z",
+                "copyright": "The data included in this document is from "
+                "www.openstreetmap.org.",
+            },
+            "elements": tagged + skeleton,
+        }
+    ).encode()
+
+
+def pbf(
+    body: bytes, untagged: int = 0, block_size: int = 8000, seed: int = 0
+) -> bytes:
+    """
+    Encode the body of an Overpass response (see `overpass`) as an extract in
+    the PBF format, with `untagged` nodes more (as an extract is mostly nodes
+    of no interest), in blocks of `block_size` elements of each type.
+    """
+    rng = random.Random(seed)
+    data = json.loads(body)
+    elements = data["elements"]
+    next_id = 1 + max(e["id"] for e in elements if e["type"] == "node")
+    for i in range(untagged):
+        lat, lon = _coords(rng)
+        elements.append(
+            {"type": "node", "id": next_id + i, "lat": lat, "lon": lon}
+        )
+
+    timestamp = _epoch(data["osm3s"]["timestamp_osm_base"])
+    head = b"".join(
+        [
+            _pb(4, b"OsmSchema-V0.6"),
+            _pb(4, b"DenseNodes"),
+            _pb(16, b"fixtures"),
+            _pb(32, timestamp),
+        ]
+    )
+    out = [_pbf_blob("OSMHeader", head)]
+
+    order = {"node": 0, "way": 1, "relation": 2}
+    elements.sort(key=lambda e: (order[e["type"]], e["id"]))
+    for t in order:
+        of_type = [e for e in elements if e["type"] == t]
+        for block in batched(of_type, block_size):
+            out.append(_pbf_blob("OSMData", _pbf_block(t, block)))
+    return b"".join(out)
+
+
+def _epoch(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp())
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _pb(field: int, value: int | bytes) -> bytes:
+    if isinstance(value, int):
+        return _varint(field << 3) + _varint(value)
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed(ns) -> bytes:
+    return b"".join(map(_varint, ns))
+
+
+def _sint(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _delta(ns) -> bytes:
+    ns = list(ns)
+    return _packed(_sint(b - a) for a, b in pairwise([0, *ns]))
+
+
+def _pbf_blob(kind: str, data: bytes) -> bytes:
+    blob = _pb(2, len(data)) + _pb(3, zlib.compress(data))
+    header = _pb(1, kind.encode()) + _pb(3, len(blob))
+    return len(header).to_bytes(4, "big") + header + blob
+
+
+# Every element of an extract has metadata, unlike Overpass' skeletons
+_PBF_META = {
+    "version": 1,
+    "timestamp": "2020-01-01T00:00:00Z",
+    "changeset": 1,
+    "uid": 1,
+    "user": "mapper",
+}
+
+
+def _pbf_block(kind: str, elements: tuple[dict, ...]) -> bytes:
+    strings = {b"": 0}
+
+    def sid(s: str) -> int:
+        return strings.setdefault(s.encode(), len(strings))
+
+    def info(e: dict) -> bytes:
+        e = _PBF_META | e
+        return _pb(
+            4,
+            _pb(1, e["version"])
+            + _pb(2, _epoch(e["timestamp"]))
+            + _pb(3, e["changeset"])
+            + _pb(4, e["uid"])
+            + _pb(5, sid(e["user"])),
+        )
+
+    def tags(e: dict) -> bytes:
+        t = e.get("tags", {})
+        keys = _packed(sid(k) for k in t)
+        return _pb(2, keys) + _pb(3, _packed(sid(v) for v in t.values()))
+
+    match kind:
+        case "node":
+            kv = []
+            for e in elements:
+                for k, v in e.get("tags", {}).items():
+                    kv += [sid(k), sid(v)]
+                kv.append(0)
+            meta = [_PBF_META | e for e in elements]
+            dense = [
+                _pb(1, _delta(e["id"] for e in elements)),
+                _pb(8, _delta(round(e["lat"] * 1e7) for e in elements)),
+                _pb(9, _delta(round(e["lon"] * 1e7) for e in elements)),
+                _pb(10, _packed(kv)),
+            ]
+            dense.append(
+                _pb(
+                    5,
+                    _pb(1, _packed(e["version"] for e in meta))
+                    + _pb(2, _delta(_epoch(e["timestamp"]) for e in meta))
+                    + _pb(3, _delta(e["changeset"] for e in meta))
+                    + _pb(4, _delta(e["uid"] for e in meta))
+                    + _pb(5, _delta(sid(e["user"]) for e in meta)),
+                )
+            )
+            group = _pb(2, b"".join(dense))
+        case "way":
+            group = b"".join(
+                _pb(
+                    3,
+                    _pb(1, e["id"])
+                    + tags(e)
+                    + info(e)
+                    + _pb(8, _delta(e["nodes"])),
+                )
+                for e in elements
+            )
+        case "relation":
+            types = {"node": 0, "way": 1, "relation": 2}
+            group = b"".join(
+                _pb(
+                    4,
+                    _pb(1, e["id"])
+                    + tags(e)
+                    + info(e)
+                    + _pb(8, _packed(sid(m["role"]) for m in e["members"]))
+                    + _pb(9, _delta(m["ref"] for m in e["members"]))
+                    + _pb(10, _packed(types[m["type"]] for m in e["members"])),
+                )
+                for e in elements
+            )
+
+    table = b"".join(_pb(1, s) for s in strings)
+    return _pb(1, table) + _pb(2, group)
+
+
+def regions(rows: int, cols: int, vertices: int, seed: int = 0) -> dict:
+    """
+    Return a GeoJSON FeatureCollection of `rows` × `cols` regions tiling the
+    bounds of the places generated (see `_coords`), each with a wiggly edge of
+    some `vertices`, as boundaries traced from coastlines and rivers have.
+    """
+    rng = random.Random(seed)
+    south, west, north, east = -47, 166, -34, 179
+    dlat, dlon = (north - south) / rows, (east - west) / cols
+    features = []
+    for i in range(rows):
+        for j in range(cols):
+            # A blob around the centre of the tile, most of the way to its edge
+            lat, lon = south + (i + 0.5) * dlat, west + (j + 0.5) * dlon
+            r, ring = 0.4, []
+            for k in range(vertices):
+                r = min(0.5, max(0.3, r + rng.gauss(0, 0.005)))
+                a = 2 * math.pi * k / vertices
+                ring.append(
+                    [
+                        round(lon + r * dlon * math.cos(a), 7),
+                        round(lat + r * dlat * math.sin(a), 7),
+                    ]
+                )
+            ring.append(ring[0])
+            features.append(
+                {
+                    "type": "Feature",
+                    "properties": {"name": f"Region {i * cols + j}"},
+                    "geometry": {"type": "Polygon", "coordinates": [ring]},
+                }
+            )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def sparql(buildings: int, seed: int = 0) -> dict:
+    """
+    Return the (decoded) JSON results of `CHURCH_QUERY`, ordered by building,
+    with a row for each building's label in each of a few languages.
+    """
+    rng = random.Random(seed)
+    variables = ["building", "label", "country", "location"]
+    variables += ["locationCountry", "address", "lat", "long", "denomination"]
+    rows = []
+    for i in range(buildings):
+        uri = f"http://dbpedia.org/resource/Church_{i:07d}"
+        lat, lon = _coords(rng)
+        for lang in rng.sample(LANGS, rng.randint(1, 3)):
+            row = {
+                "building": {"type": "uri", "value": uri},
+                "label": {
+                    "type": "literal",
+                    "xml:lang": lang,
+                    "value": f"Church {i} ({lang})",
+                },
+                "lat": {"type": "typed-literal", "datatype": _XSD_FLOAT},
+                "long": {"type": "typed-literal", "datatype": _XSD_FLOAT},
+                "country": {
+                    "type": "uri",
+                    "value": "http://dbpedia.org/resource/New_Zealand",
+                },
+            }
+            row["lat"]["value"], row["long"]["value"] = str(lat), str(lon)
+            if (denomination := rng.choice(DENOMINATIONS)) is not None:
+                row["denomination"] = {
+                    "type": "uri",
+                    "value": f"http://dbpedia.org/resource/{denomination}",
+                }
+            rows.append(row)
+
+    return {"head": {"vars": variables}, "results": {"bindings": rows}}
+
+
+def sparql_results(result: dict, out_type: str) -> bytes:
+    """
+    Encode (decoded) JSON results of a SPARQL query in another format, given
+    by its MIME type (see `dbpedia.MIMEType`).
+    """
+    variables = result["head"]["vars"]
+    bindings = result["results"]["bindings"]
+    match out_type:
+        case "application/json":
+            return json.dumps(result).encode()
+        case "text/tab-separated-values":
+            lines = ["\t".join(f"?{v}" for v in variables)]
+            for b in bindings:
+                lines.append("\t".join(_tsv(b.get(v)) for v in variables))
+            return "".join(f"{line}\n" for line in lines).encode()
+        case "text/csv":
+            f = io.StringIO()
+            w = csv.writer(f)
+            w.writerow(variables)
+            for b in bindings:
+                w.writerow(b[v]["value"] if v in b else "" for v in variables)
+            return f.getvalue().encode()
+        case "application/sparql-results+xml":
+            parts = ['<?xml version="1.0"?>\n<sparql xmlns=']
+            parts.append('"http://www.w3.org/2005/sparql-results#"><head>')
+            parts += (f"<variable name={quoteattr(v)}/>" for v in variables)
+            parts.append("</head><results>")
+            for b in bindings:
+                parts.append("<result>")
+                parts += (_xml(v, t) for v, t in b.items())
+                parts.append("</result>\n")
+            parts.append("</results></sparql>\n")
+            return "".join(parts).encode()
+    raise ValueError(f"Unknown format {out_type}")
+
+
+def _tsv(term: dict | None) -> str:
+    if term is None:
+        return ""
+    v = term["value"]
+    if term["type"] == "uri":
+        return f"<{v}>"
+    if term["type"] == "bnode":
+        return f"_:{v}"
+    v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\t", "\\t")
+    v = v.replace("\n", "\\n").replace("\r", "\\r")
+    if "xml:lang" in term:
+        return f'"{v}"@{term["xml:lang"]}'
+    if "datatype" in term:
+        return f'"{v}"^^<{term["datatype"]}>'
+    return f'"{v}"'
+
+
+def _xml(var: str, term: dict) -> str:
+    v = escape(term["value"])
+    match term["type"]:
+        case "uri":
+            t = f"<uri>{v}</uri>"
+        case "bnode":
+            t = f"<bnode>{v}</bnode>"
+        case _:
+            attrs = ""
+            if "xml:lang" in term:
+                attrs += f" xml:lang={quoteattr(term['xml:lang'])}"
+            if "datatype" in term:
+                attrs += f" datatype={quoteattr(term['datatype'])}"
+            t = f"<literal{attrs}>{v}</literal>"
+    return f"<binding name={quoteattr(var)}>{t}</binding>"
+
+
+def places(n: int, seed: int = 0) -> list[Place]:
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        lat, lon = _coords(rng)
+        tags = _tags(rng, i)
+        out.append(
+            Place(
+                source=rng.choice(["osm", "dbpedia"]),
+                id=f"node/{i}",
+                name=tags["name"],
+                lat=lat,
+                lon=lon,
+                religion=tags.get("religion"),
+                denomination=tags.get("denomination"),
+                tags=tags,
+            )
+        )
+    return out
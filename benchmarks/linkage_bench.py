@@ -0,0 +1,50 @@
+# Time proposing candidate pairs between two sets of places with a spatial
+# index, against comparing every pair (on a sample, extrapolated).  Run with
+#
+#   $ uv run python benchmarks/linkage_bench.py
+
+import random
+from time import perf_counter
+
+from powdb.common.geo import haversine
+from powdb.linkage import GridIndex, candidate_pairs
+
+N, M = 200_000, 50_000
+RADIUS = 250.0
+SAMPLE = 200
+
+
+def _points(rng: random.Random, n: int) -> tuple[list[float], list[float]]:
+    return (
+        [rng.uniform(-47, -34) for _ in range(n)],
+        [rng.uniform(166, 179) for _ in range(n)],
+    )
+
+
+def main():
+    rng = random.Random(0)
+    left, right = _points(rng, N), _points(rng, M)
+
+    t0 = perf_counter()
+    index = GridIndex(*right, cell=RADIUS)
+    t_index = perf_counter() - t0
+
+    t0 = perf_counter()
+    pairs = sum(1 for _ in candidate_pairs(left, index, RADIUS))
+    t_pairs = perf_counter() - t0
+
+    # Naively, every left point is compared with every right point
+    t0 = perf_counter()
+    for lat, lon in zip(*(c[:SAMPLE] for c in left), strict=True):
+        for lat2, lon2 in zip(*right, strict=True):
+            _ = haversine(lat, lon, lat2, lon2) <= RADIUS
+    t_naive = (perf_counter() - t0) * N / SAMPLE
+
+    print(f"{N} x {M} places, within {RADIUS:g}m ({pairs} candidate pairs)")
+    print(f"  build index:     {t_index:10.3f}s")
+    print(f"  query index:     {t_pairs:10.3f}s")
+    print(f"  naive (approx):  {t_naive:10.3f}s")
+
+
+if __name__ == "__main__":
+    main()
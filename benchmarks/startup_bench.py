@@ -0,0 +1,68 @@
+# Check that the CLI starts (to print its help) within a time budget, as it
+# would if it imported every source up front.  Exits non-zero if over budget.
+# Run with
+#
+#   $ uv run python benchmarks/startup_bench.py
+
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+# Seconds, for the median of `ROUNDS` runs, over that of a bare interpreter
+BUDGET = 0.1
+ROUNDS = 10
+
+CLI = "import sys, cli; sys.argv[1:] = ['--help']; cli.main()"
+
+
+def _time(code: str) -> float:
+    times = []
+    for _ in range(ROUNDS):
+        t0 = perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code], check=False, capture_output=True
+        )
+        times.append(perf_counter() - t0)
+    return statistics.median(times)
+
+
+def _imports(code: str, n: int = 10) -> list[tuple[int, str]]:
+    # The slowest imports (cumulative, in microseconds), from `-X importtime`
+    err = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        check=False,
+        capture_output=True,
+        text=True,
+    ).stderr
+    imports = []
+    for line in err.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main() -> int:
+    bare = _time("pass")
+    cli = _time(CLI)
+    startup = cli - bare
+
+    print(f"Interpreter: {bare * 1000:.1f} ms")
+    print(f"CLI --help:  {cli * 1000:.1f} ms")
+    print(
+        f"Startup:     {startup * 1000:.1f} ms (budget {BUDGET * 1000:.0f} ms)"
+    )
+    print("\nSlowest imports (cumulative):")
+    for us, name in _imports(CLI):
+        print(f"  {us / 1000:7.1f} ms  {name}")
+
+    if startup > BUDGET:
+        print("\nOver budget; import more lazily (see `powdb.common.lazy`)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,80 @@
+# Compare the memory and load time of a columnar `PlaceTable` against the
+# equivalent list of dicts, as parsed from JSON.  Run with
+#
+#   $ uv run python benchmarks/store_bench.py
+
+import json
+import random
+import tempfile
+import tracemalloc
+from dataclasses import asdict
+from pathlib import Path
+from time import perf_counter
+
+from powdb.common.record import Place
+from powdb.store import PlaceTable
+
+N = 200_000
+
+RELIGIONS = ["christian", "muslim", "buddhist", "hindu", "jewish", "sikh", None]
+DENOMINATIONS = ["anglican", "catholic", "methodist", "sunni", None]
+
+
+def _places(rng: random.Random) -> list[Place]:
+    return [
+        Place(
+            source=rng.choice(["osm", "dbpedia"]),
+            id=f"node/{rng.randrange(10**10)}",
+            name=f"St {rng.randrange(10**4)}'s Church",
+            lat=rng.uniform(-47, -34),
+            lon=rng.uniform(166, 179),
+            religion=rng.choice(RELIGIONS),
+            denomination=rng.choice(DENOMINATIONS),
+        )
+        for _ in range(N)
+    ]
+
+
+def _measure(f):
+    tracemalloc.start()
+    t0 = perf_counter()
+    x = f()
+    t = perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return x, t, peak
+
+
+def main():
+    places = _places(random.Random(0))
+    fields = ["source", "id", "name", "lat", "lon", "religion", "denomination"]
+
+    with tempfile.TemporaryDirectory() as d:
+        json_path, table_path = Path(d, "places.json"), Path(d, "places.powdb")
+        with open(json_path, "w") as f:
+            json.dump([{k: asdict(p)[k] for k in fields} for p in places], f)
+        PlaceTable(places).save(table_path)
+
+        def load_json():
+            with open(json_path) as f:
+                return json.load(f)
+
+        dicts, t_json, m_json = _measure(load_json)
+        table, t_table, m_table = _measure(lambda: PlaceTable.load(table_path))
+
+        # Touch every coordinate, so that the mapped pages are read
+        def scan(t=table):
+            return sum(t.lat), sum(t.lon)
+
+        _, t_scan, _ = _measure(scan)
+
+        print(f"{N} places")
+        print(f"  dicts (JSON):  {m_json / 2**20:8.1f} MiB  {t_json:8.3f}s")
+        print(f"  table (mmap):  {m_table / 2**20:8.1f} MiB  {t_table:8.3f}s")
+        print(f"  table (data):  {table.nbytes / 2**20:8.1f} MiB")
+        print(f"  scan coordinates from mapped table: {t_scan:.3f}s")
+        del dicts, table
+
+
+if __name__ == "__main__":
+    main()
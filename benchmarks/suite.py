@@ -0,0 +1,408 @@
+# A suite of benchmarks over the hot paths of the pipeline, from the common
+# utilities, through parsing and normalising each source's responses, to a
+# complete run of the CLI against a local replay of the remote services.
+# Run with
+#
+#   $ uv run python benchmarks/suite.py [-k PATTERN] [-o OUT.json]
+#
+# Each benchmark is timed over a number of rounds (after a warm-up round), as
+# pytest-benchmark would, then run once more under `tracemalloc` for its peak
+# memory.  Results are written as JSON (by default, to benchmarks/results/
+# <commit>.json), and a previous run may be compared against with
+#
+#   $ uv run python benchmarks/suite.py --compare benchmarks/results/abc123.json
+#
+# Payloads are generated by `fixtures` in the shape of real responses, so no
+# network access is needed.
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from functools import partial
+from itertools import starmap
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+from unittest import mock
+
+import fixtures
+
+import cli
+from powdb.common import eltype, findfirst, only, partition, unique
+from powdb.common.jsonstream import JSONArrayStream
+from powdb.common.replay import SERVICES, ReplayServer, record
+from powdb.common.schema import sparql_fields
+from powdb.linkage import load_regions
+from powdb.sources.dbpedia import remote as dbpedia
+from powdb.sources.osm import pbf
+from powdb.sources.osm import remote as osm
+from powdb.store import Categorical, Counts, PlaceTable
+
+RESULTS = Path(__file__).parent / "results"
+
+# How much slower (as a ratio of minimum times) a benchmark must be than in
+# the baseline to be reported as a regression; timings vary by a few percent
+# from run to run
+REGRESSION = 1.1
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # A generator that sets up the benchmark, yields the function to time,
+    # and then tears it down
+    setup: Callable[[], Iterator[Callable[[], Any]]]
+    rounds: int
+
+
+BENCHMARKS: list[Benchmark] = []
+
+
+def benchmark(name: str, rounds: int = 5):
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name, setup, rounds))
+        return setup
+
+    return register
+
+
+# Common utilities, at the sizes of a national harvest (some tens of thousands
+# of places, each with a dozen or so tags)
+
+
+@benchmark("utils.unique[strings]")
+def _():
+    xs = [f"St {i % 20_000}'s Church" for i in range(200_000)]
+    yield partial(unique, xs)
+
+
+@benchmark("utils.unique[dicts]")
+def _():
+    xs = [fixtures.places(1)[0].tags for _ in range(2_000)]
+    xs += [{"name": str(i)} for i in range(2_000)]
+    yield partial(unique, xs)
+
+
+@benchmark("utils.eltype[tuples]")
+def _():
+    xs = [(i, f"{i}", float(i), None if i % 7 else i) for i in range(200_000)]
+    yield partial(eltype, xs)
+
+
+@benchmark("utils.eltype[tags]")
+def _():
+    xs = [p.tags for p in fixtures.places(50_000)]
+    yield partial(eltype, xs)
+
+
+@benchmark("utils.partition")
+def _():
+    xs = range(1_000_000)
+    yield lambda: sum(map(len, partition(xs, 10_000)))
+
+
+@benchmark("utils.findfirst")
+def _():
+    xs = list(range(1_000_000))
+    yield partial(findfirst, (999_999).__eq__, xs)
+
+
+@benchmark("utils.only")
+def _():
+    xs = list(range(1_000_000))
+    yield lambda: only(filter((999_999).__eq__, xs))
+
+
+# Parsing and normalising the responses of each source
+
+
+def _chunks(body: bytes, size: int = 64 * 1024) -> Iterator[bytes]:
+    for i in range(0, len(body), size):
+        yield body[i : i + size]
+
+
+@benchmark("osm.parse", rounds=3)
+def _():
+    body = fixtures.overpass(nodes=20_000, ways=10_000, relations=500)
+    yield lambda: sum(1 for _ in JSONArrayStream(_chunks(body), "elements"))
+
+
+@benchmark("osm.normalise", rounds=3)
+def _():
+    body = fixtures.overpass(nodes=20_000, ways=10_000, relations=500)
+    elements = list(JSONArrayStream(_chunks(body), "elements"))
+    yield lambda: sum(1 for _ in osm.normalise(elements))
+
+
+def _pbf(workers: int):
+    # Reading the places of an extract, in this process and on a pool
+    @benchmark(f"osm.pbf[workers={workers}]", rounds=3)
+    def _():
+        body = fixtures.overpass(nodes=20_000, ways=10_000, relations=500)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "extract.osm.pbf"
+            path.write_bytes(fixtures.pbf(body, untagged=500_000))
+            yield lambda: sum(1 for _ in pbf.read_pbf(path, workers))
+
+
+for workers in (0, 4):
+    _pbf(workers)
+
+
+def _parse(out_type: dbpedia.MIMEType):
+    # Decoding a page of results, in each format, into records
+    @benchmark(f"dbpedia.parse[{out_type.name.lower()}]", rounds=3)
+    def _():
+        body = fixtures.sparql_results(fixtures.sparql(20_000), out_type)
+
+        def parse():
+            rows = dbpedia._DECODERS[out_type](_chunks(body))
+            variables = list(next(rows))
+            rows = list(rows)
+            fields = dbpedia._fields(variables)
+            records = (
+                dict(zip(fields, r, strict=True))
+                for r in rows[: dbpedia._SAMPLE_SIZE]
+            )
+            row = dbpedia.row_type(variables, records, "building")
+            return list(starmap(row, rows))
+
+        yield parse
+
+
+for out_type in ("JSON", "TSV", "CSV", "XML"):
+    _parse(dbpedia.MIMEType[out_type])
+
+
+@benchmark("dbpedia.normalise", rounds=3)
+def _():
+    result = fixtures.sparql(20_000)
+    rows = list(map(sparql_fields, result["results"]["bindings"]))
+    row = dbpedia.row_type(result["head"]["vars"], rows, "building")
+    rows = list(map(row.decode, rows))
+    yield lambda: sum(1 for _ in dbpedia.normalise(rows))
+
+
+# Reports over a (national, many times over) table of places: counting them
+# all by every dimension at once, and then rolling up counts by some
+
+
+@benchmark("store.counts[update]", rounds=3)
+def _():
+    table = PlaceTable(fixtures.places(1_000_000))
+    regions = Categorical(f"Region {i % 16}" for i in range(len(table)))
+    yield lambda: Counts().update(table, region=regions)
+
+
+@benchmark("store.counts[by]")
+def _():
+    table = PlaceTable(fixtures.places(1_000_000))
+    counts = Counts()
+    counts.update(table)
+    yield lambda: counts.by("religion", "source")
+
+
+# Assigning places to regions (as many as New Zealand's, with boundaries of
+# as many vertices in all as Stats NZ's generalised ones), once loaded
+
+
+@benchmark("linkage.regions[load]", rounds=3)
+def _():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "regions.geojson"
+        path.write_text(json.dumps(fixtures.regions(4, 4, 20_000)))
+        yield lambda: load_regions(path)
+
+
+@benchmark("linkage.regions[assign]", rounds=3)
+def _():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "regions.geojson"
+        path.write_text(json.dumps(fixtures.regions(4, 4, 20_000)))
+        index = load_regions(path)
+    table = PlaceTable(fixtures.places(100_000))
+    yield lambda: index.assign(table.lat, table.lon)
+
+
+# The pipeline from end to end: fetching from every source (as replayed by a
+# local server), and publishing to a fresh database (with a cold cache) each
+# round
+
+
+def _record(root: Path, overpass: bytes, sparql: dict, page_size: int = 10_000):
+    overpass_uri, _, dbpedia_uri = (uri for _, uri in SERVICES.values())
+    q = osm.build_overpass_query(osm.church_query())
+    record(root, overpass_uri, q, overpass)
+
+    # Every page that `query_pages` may request, including those past the end
+    bindings = sparql["results"]["bindings"]
+    for offset in range(0, len(bindings) + 4 * page_size + 1, page_size):
+        q = dbpedia.paginate_query(
+            dbpedia.CHURCH_QUERY, "?building", page_size, offset
+        )
+        uri = dbpedia.build_dbpedia_query(q, dbpedia.MIMEType.JSON)
+        uri = uri.replace(dbpedia.DBPEDIA_URI, dbpedia_uri)
+        page = bindings[offset : offset + page_size]
+        body = {"head": sparql["head"], "results": {"bindings": page}}
+        record(
+            root, uri, q, fixtures.sparql_results(body, dbpedia.MIMEType.JSON)
+        )
+
+
+@benchmark("cli.end_to_end", rounds=3)
+def _():
+    overpass = fixtures.overpass(nodes=20_000, ways=10_000, relations=500)
+    sparql = fixtures.sparql(20_000)
+
+    def run():
+        # The cache, watermarks, and database all live under `data/`
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            contextlib.chdir(tmp),
+            contextlib.redirect_stdout(io.StringIO()),
+        ):
+            if cli.run_main([]) != 0:
+                raise RuntimeError("Pipeline failed")
+
+    with tempfile.TemporaryDirectory() as recordings:
+        _record(Path(recordings), overpass, sparql)
+        with (
+            ReplayServer(recordings) as server,
+            mock.patch.object(
+                osm, "OVERPASS_URI", server.url + "/api/interpreter"
+            ),
+            mock.patch.object(dbpedia, "DBPEDIA_URI", server.url + "/sparql"),
+        ):
+            yield run
+
+
+def run(b: Benchmark) -> dict[str, Any]:
+    with contextlib.contextmanager(b.setup)() as f:
+        f()
+
+        times = []
+        for _ in range(b.rounds):
+            t0 = perf_counter()
+            f()
+            times.append(perf_counter() - t0)
+
+        tracemalloc.start()
+        try:
+            f()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "name": b.name,
+        "stats": {
+            "rounds": b.rounds,
+            "min": min(times),
+            "max": max(times),
+            "mean": statistics.fmean(times),
+            "median": statistics.median(times),
+            "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        },
+        "peak_memory": peak,
+    }
+
+
+def _commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def compare(results: list[dict[str, Any]], baseline: dict[str, Any]) -> bool:
+    """
+    Print each benchmark's time and memory relative to a baseline, and return
+    whether any has regressed.
+    """
+    old = {r["name"]: r for r in baseline["benchmarks"]}
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+
+    regressed = False
+    for r in results:
+        if (b := old.get(r["name"])) is None:
+            continue
+
+        t = r["stats"]["min"] / b["stats"]["min"]
+        m = r["peak_memory"] / max(b["peak_memory"], 1)
+        flag = ""
+        if t > REGRESSION:
+            flag, regressed = "  (slower)", True
+        print(f"  {r['name']:<28} time {t:5.2f}x  memory {m:5.2f}x{flag}")
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline's hot paths"
+    )
+    parser.add_argument(
+        "-k", help="only run benchmarks whose names match this pattern"
+    )
+    parser.add_argument("-o", "--output", type=Path, help="results file")
+    parser.add_argument(
+        "--compare", type=Path, help="results of a previous run to compare"
+    )
+    args = parser.parse_args()
+
+    commit = _commit()
+    results = []
+    for b in BENCHMARKS:
+        if args.k is not None and not re.search(args.k, b.name):
+            continue
+
+        r = run(b)
+        results.append(r)
+        s = r["stats"]
+        print(
+            f"{b.name:<28} min {s['min'] * 1e3:9.1f}ms  "
+            f"mean {s['mean'] * 1e3:9.1f}ms ± {s['stddev'] * 1e3:7.1f}ms  "
+            f"peak {r['peak_memory'] / 2**20:7.1f} MiB"
+        )
+
+    output = args.output or RESULTS / f"{commit or 'latest'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "datetime": datetime.now(UTC).isoformat(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "benchmarks": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote results to {output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)):
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
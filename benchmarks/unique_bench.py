@@ -0,0 +1,64 @@
+# Compare `common.unique` against its previous (list-based) implementation.
+#
+# The previous implementation tracked seen elements in a list, so each
+# membership check was a linear scan, making deduplication O(n²).  Run with
+#
+#   $ uv run python benchmarks/unique_bench.py
+
+import random
+from time import perf_counter
+
+from powdb import common
+
+N = 100_000
+
+
+def _legacy_unique(x):
+    # As of v0.0.6:
+    #   <github.com/jakewilliami/places-of-worship/blob/v0.0.6/src/powdb/common/utils/unique.py>  # noqa: E501
+    seen, out = list(), list()
+    for e in x:
+        if e in seen:
+            continue
+        seen.append(e)
+        out.append(e)
+    return out
+
+
+def _time(f, *args, **kwargs) -> float:
+    t0 = perf_counter()
+    f(*args, **kwargs)
+    return perf_counter() - t0
+
+
+def main():
+    rng = random.Random(0)
+
+    cases = {
+        # Many repeats of few values; the legacy implementation copes with this
+        "ints (100 distinct)": [rng.randrange(100) for _ in range(N)],
+        # Realistic harvest, where most records are unique
+        "ints (10k distinct)": [rng.randrange(10_000) for _ in range(N)],
+        "strs (10k distinct)": [
+            f"node/{rng.randrange(10_000)}" for _ in range(N)
+        ],
+    }
+
+    print(f"{'case':<28}{'legacy':>12}{'unique':>12}{'speedup':>10}")
+    for name, xs in cases.items():
+        assert _legacy_unique(xs) == common.unique(xs)
+        a, b = _time(_legacy_unique, xs), _time(common.unique, xs)
+        print(f"{name:<28}{a:>11.3f}s{b:>11.3f}s{a / b:>9.1f}x")
+
+    # Deduplicating records on a key, which the legacy implementation could
+    # not do without hashing (or comparing) entire records
+    records = [
+        {"id": rng.randrange(N // 2), "tags": {"amenity": "place_of_worship"}}
+        for _ in range(N)
+    ]
+    t = _time(common.unique, records, by=lambda r: r["id"])
+    print(f"{'dicts by key (50k distinct)':<28}{'-':>12}{t:>11.3f}s{'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -28,13 +28,216 @@
 # TODO: standardised interface (like we do in console package) to make sources
 #   easier to work with
 
-from powdb.sources import dbpedia, osm
+import argparse
+import json
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
 
+from powdb.common.metrics import METRICS, STAGES
+from powdb.common.profiler import MODES, Profiler
+from powdb.sources import SOURCES
 
-def run_main() -> int:
-    osm.get_church_data()
-    dbpedia.get_church_data()
-    return 0
+# NOTE: the CLI should start quickly (see benchmarks/startup_bench.py), so
+#   anything costly to import (the sources themselves, asyncio, the database)
+#   is only imported in `run_main`, once the arguments are known to be valid
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="powdb",
+        description="Pull data on places of worship from various sources",
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        metavar="SOURCE",
+        help=f"only harvest these sources (of {', '.join(SOURCES)}; "
+        "default: all)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only fetch places changed since the last successful run",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="also fetch when each OSM place was first seen and last modified, "
+        "from its history",
+    )
+    parser.add_argument(
+        "--pbf",
+        type=Path,
+        metavar="PATH",
+        help="read OSM places from this extract (.osm.pbf) rather than from "
+        "Overpass",
+    )
+    parser.add_argument(
+        "--regions",
+        type=_regions,
+        action="append",
+        default=[],
+        metavar="[KEY=]PATH",
+        help="tag each place with the name of the region containing it, as "
+        "KEY (default: region), from boundaries in this GeoJSON file; may be "
+        "given for each of several kinds of region",
+    )
+    parser.add_argument(
+        "--database",
+        type=Path,
+        help="SQLite or GeoPackage (.gpkg) database to publish places to "
+        "(default: $POWDB_DATABASE, or data/places.gpkg)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="write the time, records, and bytes of each stage of each source "
+        "to this JSON file",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        help="write a Chrome trace of the stages of each source to this file "
+        "(e.g., to open in ui.perfetto.dev)",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=MODES,
+        help="profile each source, deterministically (cprofile) or by "
+        "sampling its stacks (sample)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        default=Path("data/profiles"),
+        help="directory to write profiles to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile-stages",
+        type=_stages,
+        default=STAGES,
+        metavar="STAGE[,STAGE...]",
+        help=f"only profile these stages (of {', '.join(STAGES)})",
+    )
+
+    args = parser.parse_args(argv)
+    # Validated here rather than by `choices`, which rejects an empty list
+    if unknown := set(args.sources) - set(SOURCES):
+        parser.error(f"unknown sources: {', '.join(sorted(unknown))}")
+    args.sources = list(dict.fromkeys(args.sources)) or list(SOURCES)
+    return args
+
+
+def _regions(s: str) -> tuple[str, Path]:
+    key, sep, path = s.partition("=")
+    if not sep:
+        return "region", Path(s)
+    return key, Path(path)
+
+
+def _stages(s: str) -> list[str]:
+    stages = s.split(",")
+    if unknown := set(stages) - set(STAGES):
+        raise argparse.ArgumentTypeError(
+            f"unknown stages: {', '.join(sorted(unknown))}"
+        )
+    return stages
+
+
+def run_main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+
+    import asyncio
+
+    from powdb.linkage.regions import load_regions
+    from powdb.sources import load_watermarks, run_sources, save_watermarks
+    from powdb.store.sqlite import DEFAULT_DATABASE, Database
+
+    METRICS.reset()
+    METRICS.trace = args.trace is not None
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.profile, args.profile_stages)
+    METRICS.profiler = profiler
+
+    # Only the chosen sources are imported
+    options = {"osm": {"history": args.history, "pbf": args.pbf}}
+    sources = {
+        name: SOURCES[name](**options.get(name, {})) for name in args.sources
+    }
+    watermarks = load_watermarks()
+    database = args.database or DEFAULT_DATABASE
+    # Boundaries are loaded (and prepared) once, for every place
+    regions = {key: load_regions(path) for key, path in args.regions}
+
+    # Fetch from the chosen sources concurrently, publishing places as they
+    # arrive
+    fetches = {
+        name: partial(
+            src.fetch, since=watermarks.get(name) if args.incremental else None
+        )
+        for name, src in sources.items()
+    }
+    # Sources are attributed their own work as they run (see `run_sources`),
+    # so what remains is publishing
+    with (
+        METRICS.source("store"),
+        Database(database) as db,
+        profiler or nullcontext(),
+    ):
+
+        def publish(_name, place):
+            if place.lat is not None and place.lon is not None:
+                for key, index in regions.items():
+                    if (
+                        region := index.locate(place.lat, place.lon)
+                    ) is not None:
+                        place.tags[key] = region
+            db.add(place)
+
+        if args.profile == "cprofile":
+            # A deterministic profile cannot tell concurrent sources apart (see
+            # `Profiler`), so they are run one at a time
+            outcomes = {}
+            for name, fetch in fetches.items():
+                outcomes |= asyncio.run(run_sources({name: fetch}, publish))
+        else:
+            outcomes = asyncio.run(run_sources(fetches, publish))
+        total = len(db)
+
+    status = 0
+    for o in outcomes.values():
+        if o.error is None:
+            print(
+                f"Received {o.count} records from {o.name} in {o.elapsed:.1f}s"
+            )
+        else:
+            print(f"ERROR: {o.name} failed after {o.count} records: {o.error}")
+            status = 1
+
+    print(f"Published {total} places to {database}")
+    print(METRICS.report())
+
+    if args.metrics is not None:
+        with open(args.metrics, "w") as f:
+            json.dump(METRICS.summary(), f, indent=2)
+    if args.trace is not None:
+        with open(args.trace, "w") as f:
+            json.dump(METRICS.chrome_trace(), f)
+    if profiler is not None:
+        METRICS.profiler = None
+        for path in profiler.write(args.profile_dir):
+            print(f"Wrote profile to {path}")
+
+    # Only advance the watermarks of sources that succeeded, so that the next
+    # incremental run picks up where the last complete one left off
+    for name, src in sources.items():
+        if outcomes[name].error is None and src.watermark is not None:
+            watermarks[name] = src.watermark
+
+    save_watermarks(watermarks)
+    return status
 
 
 def main():
@@ -1 +1,16 @@
-from .utils import eltype, findfirst, only, partition, unique
+from powdb.common.lazy import lazy
+
+__getattr__, __dir__ = lazy(
+    __name__,
+    {
+        name: ".utils"
+        for name in (
+            "TypeUnion",
+            "eltype",
+            "findfirst",
+            "only",
+            "partition",
+            "unique",
+        )
+    },
+)
@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO
+
+# Default location of the cache, following the convention of persisting
+# generated data under `data/`
+DEFAULT_ROOT = Path(os.environ.get("POWDB_CACHE_DIR", "data/cache"))
+
+# Default maximum size of the cache on disk, after compression
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# How long responses from each source remain fresh.  Places of worship change
+# slowly, but OSM is edited constantly, so we keep it fresh for less time
+TTL = {
+    "overpass": timedelta(days=1),
+    "nominatim": timedelta(days=30),
+    "dbpedia": timedelta(days=7),
+}
+
+_CHUNK_SIZE = 64 * 1024
+_SUFFIX = ".gz"
+
+
+def normalise_query(query: str) -> str:
+    """
+    Normalise the text of a query so that insignificant differences in
+    indentation or blank lines do not change its key in the cache.
+    """
+    lines = (line.strip() for line in query.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def cache_key(endpoint: str, query: str) -> str:
+    h = hashlib.sha256()
+    h.update(endpoint.encode())
+    h.update(b"\0")
+    h.update(normalise_query(query).encode())
+    return h.hexdigest()
+
+
+@contextmanager
+def _closing(chunks: Iterable[bytes]) -> Iterator[Iterator[bytes]]:
+    # Like `contextlib.closing`, but for any iterable, as only generators (and
+    # not all iterators) have a `close` method to release their resources
+    it = iter(chunks)
+    try:
+        yield it
+    finally:
+        if (close := getattr(it, "close", None)) is not None:
+            close()
+
+
+class Cache:
+    """
+    A content-addressed cache of raw (compressed) responses on disk.
+
+    Responses are keyed on their endpoint and (normalised) query.  An entry's
+    modification time records when it was written, and is used to expire it
+    after some TTL; its access time records when it was last read, and is used
+    to evict the least recently used entries once the cache grows beyond
+    `max_bytes`.
+
+    If `root` is None, the cache is disabled and all requests are passed
+    through.
+    """
+
+    def __init__(
+        self,
+        root: Path | None = DEFAULT_ROOT,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> Path:
+        # Shard entries by the first byte of their key, so that no directory
+        # grows too large
+        return self.root / key[:2] / f"{key}{_SUFFIX}"
+
+    def _lookup(self, key: str, ttl: timedelta) -> Path | None:
+        path = self._path(key)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if now - st.st_mtime > ttl.total_seconds():
+            path.unlink(missing_ok=True)
+            return None
+
+        # Mark as recently used, preserving the time at which it was written
+        os.utime(path, (now, st.st_mtime))
+        return path
+
+    @contextmanager
+    def stream(
+        self,
+        endpoint: str,
+        query: str,
+        fetch: Callable[[], Iterable[bytes]],
+        ttl: timedelta,
+    ) -> Iterator[Iterator[bytes]]:
+        """
+        Context manager yielding an iterator of raw chunks of the response to
+        `query` at `endpoint`.
+
+        If there is a fresh entry in the cache, chunks are streamed from disk.
+        Otherwise, chunks are streamed from `fetch()`, and written to the cache
+        as they pass through.  The entry is only kept if every chunk is consumed
+        and the block exits without an exception, so that the caller may reject
+        an invalid response by raising.
+        """
+        if self.root is None:
+            with _closing(fetch()) as chunks:
+                yield chunks
+            return
+
+        key = cache_key(endpoint, query)
+        if (path := self._lookup(key, ttl)) is not None:
+            with gzip.open(path, "rb") as f:
+                yield iter(partial(f.read, _CHUNK_SIZE), b"")
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        done = False
+
+        def tee(chunks: Iterable[bytes], f: BinaryIO) -> Iterator[bytes]:
+            nonlocal done
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+            done = True
+
+        try:
+            with (
+                gzip.open(tmp, "wb") as f,
+                _closing(fetch()) as chunks,
+            ):
+                yield tee(chunks, f)
+
+            if done:
+                os.replace(tmp, path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+        if done:
+            self.evict()
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for path in self.root.glob(f"*/*{_SUFFIX}"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                # Removed concurrently
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        """
+        Return the total size (in bytes) of entries in the cache.
+        """
+        if self.root is None:
+            return 0
+
+        return sum(n for _, n, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries from the cache until it fits
+        within `max_bytes`.
+        """
+        if self.root is None:
+            return
+
+        entries = sorted(self._entries())
+        total = sum(n for _, n, _ in entries)
+        for _, n, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= n
+
+    def clear(self):
+        if self.root is None:
+            return
+
+        for _, _, path in self._entries():
+            path.unlink(missing_ok=True)
+
+
+# Shared cache used by all sources by default
+CACHE = Cache()
@@ -0,0 +1,79 @@
+import math
+from collections.abc import Iterator
+from typing import NamedTuple
+
+
+class BBox(NamedTuple):
+    """
+    A geographic bounding box, in degrees.
+
+    Fields are ordered as Overpass expects them (south, west, north, east):
+      <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Bounding_box>
+    """
+
+    south: float
+    west: float
+    north: float
+    east: float
+
+    def __str__(self) -> str:
+        return ",".join(str(c) for c in self)
+
+    def grid(self, rows: int, cols: int) -> Iterator["BBox"]:
+        """
+        Split the bounding box into a grid of `rows` × `cols` equal tiles.
+        """
+        if rows < 1 or cols < 1:
+            raise ValueError("Grid must have at least one row and column")
+
+        # Use the outer edges exactly, so that floating point error cannot
+        # leave a gap at the boundary of the box
+        dlat = (self.north - self.south) / rows
+        dlon = (self.east - self.west) / cols
+        lats = [self.south + i * dlat for i in range(rows)] + [self.north]
+        lons = [self.west + j * dlon for j in range(cols)] + [self.east]
+
+        for i in range(rows):
+            for j in range(cols):
+                yield BBox(lats[i], lons[j], lats[i + 1], lons[j + 1])
+
+    def split(self) -> list["BBox"]:
+        """
+        Split the bounding box into four equal quadrants.
+        """
+        return list(self.grid(2, 2))
+
+
+# Approximate bounds of New Zealand's main (and sub-Antarctic) islands
+NZ_BBOX = BBox(-52.8, 163.08, -31.31, 180.0)
+
+# Approximate bounds of all of New Zealand, as covered by its area in OSM: the
+# Chatham and Kermadec Islands lie across the antimeridian, so have their own
+NZ_BBOXES = (
+    NZ_BBOX,
+    BBox(-44.8, -177.2, -43.3, -175.6),
+    BBox(-31.6, -179.1, -29.1, -177.7),
+)
+
+
+# Mean radius of the Earth, in metres:
+#   <en.wikipedia.org/wiki/Earth_radius#Mean_radius>
+EARTH_RADIUS = 6_371_008.8
+
+# Length of one degree of latitude, in metres (approximately)
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Return the great-circle distance (in metres) between two points given in
+    degrees:
+      <en.wikipedia.org/wiki/Haversine_formula>
+    """
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = (
+        math.sin(dp / 2) ** 2
+        + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
@@ -0,0 +1,171 @@
+import codecs
+import json
+from collections.abc import Iterable, Iterator, Sequence
+from typing import Any
+
+# Characters that JSON considers insignificant whitespace:
+#   <datatracker.ietf.org/doc/html/rfc8259#section-2>
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",:]}"
+
+_DECODER = json.JSONDecoder()
+
+
+class JSONArrayStream:
+    """
+    Incrementally decode the elements of an array `key` within a top-level JSON
+    object, as raw chunks of bytes arrive.
+
+    For example, Overpass returns
+
+        {"version": ..., "osm3s": {...}, "elements": [...], "remark": ...}
+
+    And with `key="elements"`, iterating over the stream yields each element of
+    the array one at a time, so that only a single element (and at most one
+    chunk of raw bytes) is held in memory at once, regardless of the size of the
+    response.  All other top-level members of the object are decoded in full
+    and collected in `meta` (which is only complete once the stream has been
+    consumed).
+
+    The array may also be nested within objects, given the path of keys to it;
+    e.g., SPARQL returns
+
+        {"head": {"vars": [...]}, "results": {"bindings": [...]}}
+
+    And with `key=("results", "bindings")`, the stream yields each binding,
+    while `meta` collects `{"head": {...}, "results": {}}` (with any other
+    members of `results` in the latter).  Members are read in the order they
+    are written, so `meta` holds those before the array as soon as the first
+    element is yielded.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], key: str | Sequence[str]):
+        self.path = (key,) if isinstance(key, str) else tuple(key)
+        self.meta: dict[str, Any] = {}
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._i = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        # Read another chunk of bytes into the buffer, discarding what has
+        # already been consumed.  Returns false once the stream is exhausted
+        if self._eof:
+            return False
+
+        self._buf = self._buf[self._i :]
+        self._i = 0
+
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._buf += self._utf8.decode(b"", final=True)
+        else:
+            self._buf += self._utf8.decode(chunk)
+
+        return True
+
+    def _peek(self) -> str:
+        # Return the next significant character, reading more if required
+        while True:
+            buf, n = self._buf, len(self._buf)
+            while self._i < n and buf[self._i] in _WHITESPACE:
+                self._i += 1
+
+            if self._i < n:
+                return buf[self._i]
+
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def _expect(self, c: str):
+        if (d := self._peek()) != c:
+            raise ValueError(f"Expected {c!r} in JSON stream, but found {d!r}")
+
+        self._i += 1
+
+    def _value(self) -> Any:
+        # Decode the next complete value, reading more if required
+        self._peek()
+        while True:
+            try:
+                v, j = _DECODER.raw_decode(self._buf, self._i)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A value at the end of the buffer (e.g., the number `1` or `1.`)
+            # may be the truncated prefix of a longer value (e.g., `1.5`), so
+            # we can only trust it if it is followed by a delimiter
+            truncated = j == len(self._buf) or self._buf[j] not in _DELIMITERS
+            if truncated and self._fill():
+                continue
+
+            self._i = j
+            return v
+
+    def __iter__(self) -> Iterator[Any]:
+        yield from self._object(self.path, self.meta)
+        self._end()
+
+    def _end(self):
+        # Consume the rest of the stream, ensuring there is nothing after the
+        # object other than whitespace
+        while True:
+            rest = self._buf[self._i :].lstrip(_WHITESPACE)
+            if rest:
+                raise ValueError(f"Unexpected {rest[0]!r} after end of JSON")
+
+            self._i = len(self._buf)
+            if not self._fill():
+                return
+
+    def _object(
+        self, path: tuple[str, ...], meta: dict[str, Any]
+    ) -> Iterator[Any]:
+        # Yield the elements of the array at the end of `path` within the next
+        # object, collecting its other members in `meta`
+        self._expect("{")
+        if self._peek() == "}":
+            self._i += 1
+            return
+
+        while True:
+            k = self._value()
+            if not isinstance(k, str):
+                raise ValueError("Expected string key in JSON object")
+
+            self._expect(":")
+
+            if k != path[0]:
+                meta[k] = self._value()
+            elif len(path) == 1:
+                yield from self._array()
+            elif self._peek() == "{":
+                yield from self._object(path[1:], meta.setdefault(k, {}))
+            else:
+                # Not the object expected, so there are no elements within it
+                meta[k] = self._value()
+
+            if self._peek() == "}":
+                self._i += 1
+                return
+
+            self._expect(",")
+
+    def _array(self) -> Iterator[Any]:
+        self._expect("[")
+        if self._peek() == "]":
+            self._i += 1
+            return
+
+        while True:
+            yield self._value()
+
+            if self._peek() == "]":
+                self._i += 1
+                return
+
+            self._expect(",")
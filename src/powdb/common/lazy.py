@@ -0,0 +1,67 @@
+import importlib
+import importlib.util
+import sys
+from collections.abc import Callable, Iterator, Mapping
+from typing import Any
+
+
+def lazy(
+    package: str, attrs: Mapping[str, str]
+) -> tuple[Callable[[str], Any], Callable[[], list[str]]]:
+    """
+    Return the module `__getattr__` and `__dir__` for a package, so that each
+    of its attributes `attrs` (mapped to the module defining it) is only
+    imported when first used:
+      <peps.python.org/pep-0562>
+
+    For example, the package of a source may re-export its class without
+    importing the HTTP client that the rest of the source needs.
+
+    NOTE: importing a submodule binds it to its package under its own name,
+    whenever it is imported (e.g., by `from package.name import name`), so an
+    attribute may not be named after the submodule that defines it; such
+    packages should import it eagerly instead.
+    """
+    module = sys.modules[package]
+    paths = {
+        a: importlib.util.resolve_name(m, package) for a, m in attrs.items()
+    }
+    if shadowed := [a for a, p in paths.items() if p == f"{package}.{a}"]:
+        raise ValueError(f"Attributes named after their modules: {shadowed}")
+
+    def __getattr__(name: str) -> Any:
+        if (path := paths.get(name)) is None:
+            raise AttributeError(
+                f"module {package!r} has no attribute {name!r}"
+            )
+        value = getattr(importlib.import_module(path), name)
+        setattr(module, name, value)
+        return value
+
+    def __dir__() -> list[str]:
+        return sorted({*vars(module), *paths})
+
+    return __getattr__, __dir__
+
+
+class LazyMapping[T](Mapping[str, T]):
+    """
+    A mapping of names to objects given as "module:attribute", each imported
+    when first looked up.  Names may be listed without importing anything.
+    """
+
+    def __init__(self, paths: Mapping[str, str]):
+        self._paths = dict(paths)
+        self._loaded: dict[str, T] = {}
+
+    def __getitem__(self, name: str) -> T:
+        if name not in self._loaded:
+            module, _, attr = self._paths[name].partition(":")
+            self._loaded[name] = getattr(importlib.import_module(module), attr)
+        return self._loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._paths)
+
+    def __len__(self) -> int:
+        return len(self._paths)
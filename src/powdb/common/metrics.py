@@ -0,0 +1,325 @@
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# The stages of the pipeline, in order
+STAGES = ("request", "transfer", "parse", "normalise", "dedupe", "publish")
+
+# The source on whose behalf work is done.  Context variables are copied to
+# the thread running each source (by `asyncio.to_thread`), but must be copied
+# explicitly to threads of any pool it uses (see `contextvars.copy_context`)
+_SOURCE: ContextVar[str] = ContextVar("source", default="-")
+
+
+@dataclass(slots=True)
+class Stage:
+    """
+    What is known of one stage of the pipeline for one source: the time spent
+    in it (excluding time spent in other stages within it, such as a request
+    made while parsing), how many times it was entered, and how many records
+    and bytes passed through it.
+
+    `peak_rss` is the process' peak resident set size (in bytes) as of the
+    last time the stage was left.
+    """
+
+    source: str
+    name: str
+    time: float = 0.0
+    calls: int = 0
+    records: int = 0
+    bytes: int = 0
+    retries: int = 0
+    peak_rss: int = 0
+
+    @property
+    def rate(self) -> float:
+        """
+        Records per second.
+        """
+        return self.records / self.time if self.time else 0.0
+
+
+def peak_rss() -> int:
+    """
+    Return the peak resident set size of the process in bytes, or 0 if it is
+    not known on this platform.
+    """
+    if resource is None:
+        return 0
+
+    # In kilobytes on Linux, but bytes on macOS:
+    #   <man7.org/linux/man-pages/man2/getrusage.2.html>
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Metrics:
+    """
+    Lightweight instrumentation of the stages of the pipeline (see `STAGES`),
+    for each source.
+
+    Work is attributed to the source set by `source`, and timed with `stage`
+    (for a block) or `timed` (for the items of an iterator, as most stages
+    stream into one another).  Each thread keeps a stack of the stages it is
+    in, so that time is only counted against the innermost.  Counters are
+    only updated once per block or iterator, so instrumentation costs little
+    more than two clock reads per item.
+
+    If `trace` is set, each block and iterator is also recorded as an event,
+    to be written as a Chrome trace (see `chrome_trace`).  If `profiler` is
+    set, it is told as each stage is entered and left (see `profiler`).
+    """
+
+    def __init__(self, trace: bool = False):
+        self.trace = trace
+        self.profiler = None
+        self.stages: dict[tuple[str, str], Stage] = {}
+        self.events: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.events.clear()
+            self._t0 = time.perf_counter()
+
+    @contextmanager
+    def source(self, name: str) -> Iterator[None]:
+        """
+        Attribute work within the block (on this thread) to a source.
+        """
+        token = _SOURCE.set(name)
+        try:
+            yield
+        finally:
+            _SOURCE.reset(token)
+
+    def _stage(self, name: str) -> Stage:
+        key = (_SOURCE.get(), name)
+        if (s := self.stages.get(key)) is None:
+            with self._lock:
+                s = self.stages.setdefault(key, Stage(*key))
+        return s
+
+    def add(self, name: str, **counts: int):
+        """
+        Add to the counters of a stage (e.g., `retries=1`).
+        """
+        s = self._stage(name)
+        with self._lock:
+            for k, n in counts.items():
+                setattr(s, k, getattr(s, k) + n)
+
+    def _enter(self) -> float:
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        return time.perf_counter()
+
+    def _exit(self, t0: float) -> float:
+        # Return the time since `t0` less that spent in nested stages, and
+        # count it all as nested in the enclosing stage, if any
+        elapsed = time.perf_counter() - t0
+        stack = self._local.stack
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        return elapsed - nested
+
+    def _record(
+        self, s: Stage, t0: float, self_time: float, counts: dict[str, int]
+    ):
+        rss = peak_rss()
+        with self._lock:
+            s.time += self_time
+            s.calls += 1
+            s.peak_rss = max(s.peak_rss, rss)
+            for k, n in counts.items():
+                setattr(s, k, getattr(s, k) + n)
+
+            if self.trace:
+                t = threading.current_thread()
+                self.events.append(
+                    {
+                        "name": s.name,
+                        "cat": s.source,
+                        "ph": "X",
+                        "ts": (t0 - self._t0) * 1e6,
+                        "dur": (time.perf_counter() - t0) * 1e6,
+                        "pid": s.source,
+                        "tid": t.name,
+                        "args": {"self_time": self_time, **counts},
+                    }
+                )
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict[str, int]]:
+        """
+        Time a block as one call of a stage.  The block may set counts (e.g.,
+        of "records" or "bytes") in the dict that it is given.
+        """
+        s, counts = self._stage(name), {}
+        if (profiler := self.profiler) is not None:
+            profiler.enter(s.source, name)
+            profiler.resume(s.source, name)
+        t0 = self._enter()
+        try:
+            yield counts
+        finally:
+            self._record(s, t0, self._exit(t0), counts)
+            if profiler is not None:
+                profiler.suspend(s.source, name)
+                profiler.exit(s.source, name)
+
+    def timed[T](
+        self,
+        items: Iterable[T],
+        name: str,
+        size: Callable[[T], int] | None = None,
+    ) -> Iterator[T]:
+        """
+        Yield items from an iterable, timing each step of it as part of a
+        stage.  Each item counts as a record or, if `size` is given, as that
+        many bytes (e.g., for chunks of a response).
+        """
+        s, it = self._stage(name), iter(items)
+        start, self_time, n = time.perf_counter(), 0.0, 0
+
+        # As `_enter` and `_exit`, inlined, as this is called for every item.
+        # The iterator is assumed to be consumed on the thread that started it
+        clock, local = time.perf_counter, self._local.__dict__
+        if (profiler := self.profiler) is not None:
+            profiler.enter(s.source, name)
+        try:
+            while True:
+                if profiler is not None:
+                    profiler.resume(s.source, name)
+                stack = local.setdefault("stack", [])
+                stack.append(0.0)
+                t0 = clock()
+                try:
+                    x = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed = clock() - t0
+                    nested = stack.pop()
+                    if stack:
+                        stack[-1] += elapsed
+                    self_time += elapsed - nested
+                    if profiler is not None:
+                        profiler.suspend(s.source, name)
+
+                n += 1 if size is None else size(x)
+                yield x
+        finally:
+            key = "records" if size is None else "bytes"
+            self._record(s, start, self_time, {key: n})
+            if profiler is not None:
+                profiler.exit(s.source, name)
+
+    def summary(self) -> dict[str, dict[str, dict[str, Any]]]:
+        """
+        Return the counters of each stage (in order), by source.
+        """
+        out: dict[str, dict[str, dict[str, Any]]] = {}
+        order = {name: i for i, name in enumerate(STAGES)}
+        with self._lock:
+            stages = sorted(
+                self.stages.values(),
+                key=lambda s: (s.source, order.get(s.name, len(order))),
+            )
+            for s in stages:
+                out.setdefault(s.source, {})[s.name] = {
+                    "time": s.time,
+                    "calls": s.calls,
+                    "records": s.records,
+                    "bytes": s.bytes,
+                    "records_per_s": s.rate,
+                    "retries": s.retries,
+                    "peak_rss": s.peak_rss,
+                }
+        return out
+
+    def report(self) -> str:
+        """
+        Return the summary as a table.
+        """
+        lines = [
+            f"{'source':<10} {'stage':<10} {'time':>9} {'calls':>7} "
+            f"{'records':>9} {'records/s':>10} {'MiB':>9} {'retries':>7} "
+            f"{'peak RSS':>9}"
+        ]
+        for source, stages in self.summary().items():
+            for name, s in stages.items():
+                lines.append(
+                    f"{source:<10} {name:<10} {s['time']:>8.2f}s "
+                    f"{s['calls']:>7} {s['records']:>9} "
+                    f"{s['records_per_s']:>10.0f} "
+                    f"{s['bytes'] / 2**20:>9.1f} {s['retries']:>7} "
+                    f"{s['peak_rss'] / 2**20:>5.0f} MiB"
+                )
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict[str, Any]:
+        """
+        Return the events recorded (if `trace` is set) in the Chrome trace
+        event format, to be opened in (e.g.) Perfetto:
+          <docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU>
+          <ui.perfetto.dev>
+
+        Each source is shown as a process, and each thread as a track within
+        it, with the stages on that thread nested as they ran.
+        """
+        with self._lock:
+            events = list(self.events)
+
+        # Processes and threads are identified by number, and named by
+        # metadata events
+        pids: dict[str, int] = {}
+        tids: dict[tuple[str, str], int] = {}
+        out = []
+        for e in events:
+            source, thread = e["pid"], e["tid"]
+            if source not in pids:
+                pids[source] = len(pids) + 1
+                out.append(_metadata("process_name", pids[source], 0, source))
+            if (source, thread) not in tids:
+                tids[source, thread] = len(tids) + 1
+                out.append(
+                    _metadata(
+                        "thread_name",
+                        pids[source],
+                        tids[source, thread],
+                        thread,
+                    )
+                )
+            out.append({**e, "pid": pids[source], "tid": tids[source, thread]})
+
+        return {"traceEvents": out, "displayTimeUnit": "ms"}
+
+
+def _metadata(name: str, pid: int, tid: int, value: str) -> dict[str, Any]:
+    return {
+        "name": name,
+        "ph": "M",
+        "pid": pid,
+        "tid": tid,
+        "args": {"name": value},
+    }
+
+
+# Shared instrumentation of the pipeline
+METRICS = Metrics()
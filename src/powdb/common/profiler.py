@@ -0,0 +1,202 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from collections.abc import Iterable
+from pathlib import Path
+from types import FrameType
+
+from powdb.common.metrics import STAGES
+
+MODES = ("cprofile", "sample")
+
+# Frames of the instrumentation itself, left out of sampled stacks
+_INTERNAL = tuple(
+    str(Path(__file__).with_name(f"{m}.py")) for m in ("metrics", "profiler")
+)
+
+
+class Profiler:
+    """
+    Profile the chosen `stages` of the pipeline (see `metrics.STAGES`), with
+    one profile per source.  `METRICS` tells the profiler as each block or
+    iterator of a stage begins and ends (`enter` and `exit`), and as each
+    step of it is taken (`resume` and `suspend`), so that only work within
+    (any of) the chosen stages is profiled.
+
+    In "cprofile" mode, a deterministic profile (of every call) is kept for
+    each source, and written as "<source>.prof" (to be read by `pstats`, or
+    tools like snakeviz).  Only one profile can be enabled at a time, so while
+    any block or iterator of a chosen stage is live, the profile enabled is
+    that of the source that last entered or stepped into one, switching only
+    as another source does (e.g., to the store's as it publishes a batch, and
+    back as the source takes its next step).  It is not toggled with every
+    step, as enabling it is costly.
+
+    In "sample" mode, a background thread samples the stack of every thread
+    in a chosen stage each `interval` seconds, and the stacks are written in
+    the "collapsed" format of flame graphs (one line per distinct stack, of
+    frames separated by semicolons, then its count), as "<source>.collapsed":
+      <github.com/brendangregg/FlameGraph#2-fold-stacks>
+      <www.speedscope.app>
+    Stacks begin with the stage they were sampled in.  Sampling is much less
+    intrusive than deterministic profiling, so its timings are more faithful.
+
+    NOTE: since Python 3.12, `cProfile` profiles every thread at once, so one
+    source's profile will include any work of others at the same moment, if
+    they do not step in between; sources should be run one at a time (as the
+    CLI does) to separate them.
+    """
+
+    def __init__(
+        self,
+        mode: str = "sample",
+        stages: Iterable[str] = STAGES,
+        interval: float = 0.005,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}; use {MODES}")
+
+        self.mode = mode
+        self.stages = frozenset(stages)
+        if unknown := self.stages - set(STAGES):
+            raise ValueError(f"Unknown stages {sorted(unknown)}; use {STAGES}")
+
+        self.interval = interval
+        self.profiles: dict[str, cProfile.Profile] = {}
+        self.stacks: dict[str, Counter[str]] = {}
+
+        # The chosen stages that each thread is in (innermost last), by thread
+        self._threads: dict[int, list[tuple[str, str]]] = {}
+        # How many blocks and iterators of chosen stages are live, by source
+        # (the most recently active last), and whose profile is enabled
+        self._live: dict[str, int] = {}
+        self._profiling: str | None = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    def __enter__(self) -> "Profiler":
+        if self.mode == "sample":
+            self._stop.clear()
+            self._sampler = threading.Thread(
+                target=self._sample, name="profiler", daemon=True
+            )
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        self._switch(None)
+
+    def _switch(self, source: str | None):
+        # Enable the profile of `source` (if any) in place of the one enabled
+        if source == self._profiling:
+            return
+        if self._profiling is not None:
+            self.profiles[self._profiling].disable()
+        if source is not None:
+            self.profiles.setdefault(source, cProfile.Profile()).enable()
+        self._profiling = source
+
+    def enter(self, source: str, stage: str):
+        if self.mode != "cprofile" or stage not in self.stages:
+            return
+
+        with self._lock:
+            self._live[source] = self._live.pop(source, 0) + 1
+            self._switch(source)
+
+    def exit(self, source: str, stage: str):
+        if self.mode != "cprofile" or stage not in self.stages:
+            return
+
+        with self._lock:
+            if self._live[source] > 1:
+                self._live[source] -= 1
+                return
+
+            # Back to the source that was active most recently, if any
+            del self._live[source]
+            if source == self._profiling:
+                self._switch(next(reversed(self._live), None))
+
+    def resume(self, source: str, stage: str):
+        if stage not in self.stages:
+            return
+
+        if self.mode == "cprofile":
+            # Most steps are of the source already being profiled
+            if source != self._profiling:
+                with self._lock:
+                    if source in self._live:
+                        self._live[source] = self._live.pop(source)
+                        self._switch(source)
+            return
+
+        with self._lock:
+            ident = threading.get_ident()
+            self._threads.setdefault(ident, []).append((source, stage))
+
+    def suspend(self, source: str, stage: str):
+        if self.mode != "sample" or stage not in self.stages:
+            return
+
+        with self._lock:
+            ident = threading.get_ident()
+            if stack := self._threads.get(ident):
+                stack.pop()
+                if not stack:
+                    del self._threads[ident]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                active = [
+                    (ident, *stack[-1])
+                    for ident, stack in self._threads.items()
+                ]
+            for ident, source, stage in active:
+                if (frame := frames.get(ident)) is not None:
+                    stacks = self.stacks.setdefault(source, Counter())
+                    stacks[_collapse(stage, frame)] += 1
+
+    def write(self, directory: Path) -> list[Path]:
+        """
+        Write the profile of each source to a directory, and return the paths
+        written.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for source, profile in self.profiles.items():
+            path = directory / f"{source}.prof"
+            pstats.Stats(profile).dump_stats(path)
+            paths.append(path)
+
+        for source, stacks in self.stacks.items():
+            path = directory / f"{source}.collapsed"
+            with open(path, "w") as f:
+                for stack, n in sorted(stacks.items()):
+                    f.write(f"{stack} {n}\n")
+            paths.append(path)
+
+        return paths
+
+
+def _collapse(stage: str, frame: FrameType | None) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename not in _INTERNAL:
+            file = os.path.basename(code.co_filename)
+            names.append(f"{code.co_qualname} ({file}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    names.append(stage)
+    return ";".join(reversed(names))
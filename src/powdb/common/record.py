@@ -0,0 +1,31 @@
+from dataclasses import dataclass, field
+
+
+@dataclass(slots=True)
+class Place:
+    """
+    A place of worship, as normalised from any one source.
+
+    `id` is unique within its `source` (e.g., "node/123" for OSM, or the
+    resource URI for DBpedia).  `timestamp` is when the source last changed the
+    record (as an ISO 8601 string), if known.  Any other source-specific data
+    are kept in `tags`, using OSM's key conventions where they apply (e.g.,
+    "name:en" for a name in English).
+    """
+
+    source: str
+    id: str
+    name: str | None = None
+    lat: float | None = None
+    lon: float | None = None
+    religion: str | None = None
+    denomination: str | None = None
+    timestamp: str | None = None
+    tags: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def key(self) -> tuple[str, str]:
+        """
+        Return the key that uniquely identifies this place across all sources.
+        """
+        return self.source, self.id
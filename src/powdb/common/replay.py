@@ -0,0 +1,281 @@
+import argparse
+import gzip
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, fields
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from powdb.common.cache import DEFAULT_ROOT, Cache, cache_key
+
+# The services replayed, by the path of their endpoint: the environment
+# variable that points the client at an endpoint, and the public endpoint that
+# responses were recorded from
+SERVICES = {
+    "/api/interpreter": (
+        "POWDB_OVERPASS_URI",
+        "https://overpass-api.de/api/interpreter",
+    ),
+    "/search": (
+        "POWDB_NOMINATIM_URI",
+        "https://nominatim.openstreetmap.org/search",
+    ),
+    "/sparql": ("POWDB_DBPEDIA_URI", "https://dbpedia.org/sparql"),
+}
+
+# Recordings never expire
+_FOREVER = timedelta(days=365_000)
+
+
+@dataclass(slots=True)
+class Faults:
+    """
+    How the replay server degrades its responses, to test how clients cope.
+
+    Each response is delayed by `latency` seconds before it is sent, and its
+    body is then written in chunks of `chunk_size` bytes (with chunked transfer
+    encoding), at no more than `bandwidth` bytes per second.  If `truncate` is
+    given, the connection is dropped after that fraction of the body.
+
+    The first `errors` attempts at each request fail with `error_status`, as
+    does any other attempt with probability `error_rate`, with a Retry-After
+    header of `retry_after` seconds, if given.  Which attempts fail depends
+    only on the request, the attempt, and `seed`, and not on the order in
+    which concurrent requests arrive, so that runs are repeatable.
+    """
+
+    latency: float = 0.0
+    bandwidth: float | None = None
+    chunk_size: int = 64 * 1024
+    truncate: float | None = None
+    errors: int = 0
+    error_rate: float = 0.0
+    error_status: int = 503
+    retry_after: float | None = None
+    seed: int = 0
+
+
+def record(root: Path, endpoint: str, query: str, body: bytes):
+    """
+    Record the response to a query at one of the public endpoints in
+    `SERVICES`, as the cache in `root` would have (see `replay_key`).
+    """
+    cache = Cache(root, max_bytes=2**63)
+    with cache.stream(endpoint, query, lambda: [body], _FOREVER) as chunks:
+        for _ in chunks:
+            pass
+
+
+def replay_key(path: str, query_string: str, body: bytes = b"") -> str | None:
+    """
+    Return the key in the cache of the response to a request (by its path,
+    query string, and form-encoded body) to the replay server, or None if it
+    is not a request to a known service.
+
+    The key is that under which the client would have cached the response
+    had it made the request to the public endpoint (see `osm.remote` and
+    `dbpedia.remote`), so that the cache of a real run can be replayed.
+    """
+    if (service := SERVICES.get(path)) is None:
+        return None
+
+    _, endpoint = service
+    params = parse_qs(query_string)
+    if path == "/api/interpreter":
+        form = parse_qs(body.decode())
+        return cache_key(endpoint, (form or params).get("data", [""])[0])
+    if path == "/search":
+        return cache_key(endpoint, query_string)
+    return cache_key(f"{endpoint}?{query_string}", params["query"][0])
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    A local HTTP server that replays recorded responses of Overpass,
+    Nominatim, and DBpedia's SPARQL endpoint, degraded by `faults`, so that
+    the concurrency, retries, and streaming of clients can be tested without
+    network access.
+
+    Recordings are entries of a response cache (see `common.cache`), so the
+    cache of any run against the public endpoints can be replayed:
+
+        $ POWDB_CACHE_DIR=data/recordings powdb
+        $ python -m powdb.common.replay data/recordings
+
+    Clients are pointed at the server by the environment variables in
+    `endpoints` (see `SERVICES`).  Requests without a recording get a 404.
+
+    The server counts the requests for each path, and the most that were in
+    flight at once, in `requests` and `max_in_flight`.
+
+    NOTE: clients replaying recordings should not share the cache that they
+    are replayed from, or they will never reach the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        recordings: Path,
+        faults: Faults | None = None,
+        address: tuple[str, int] = ("127.0.0.1", 0),
+    ):
+        super().__init__(address, _Handler)
+        self.recordings = Cache(Path(recordings))
+        self.faults = faults or Faults()
+        self.requests: Counter[str] = Counter()
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._attempts: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def endpoints(self) -> dict[str, str]:
+        """
+        The environment variables that point clients at this server.
+        """
+        return {var: self.url + path for path, (var, _) in SERVICES.items()}
+
+    def __enter__(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def _fails(self, key: str) -> bool:
+        with self._lock:
+            attempt = self._attempts[key]
+            self._attempts[key] += 1
+
+        f = self.faults
+        if attempt < f.errors:
+            return True
+        rng = random.Random(f"{f.seed}:{key}:{attempt}")
+        return rng.random() < f.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests, as the public endpoints do
+    protocol_version = "HTTP/1.1"
+    server: ReplayServer
+
+    def do_GET(self):
+        self._replay(b"")
+
+    def do_POST(self):
+        self._replay(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def _replay(self, body: bytes):
+        s = self.server
+        path, _, query_string = self.path.partition("?")
+        with s._lock:
+            s.requests[path] += 1
+            s._in_flight += 1
+            s.max_in_flight = max(s.max_in_flight, s._in_flight)
+        try:
+            self._respond(replay_key(path, query_string, body))
+        finally:
+            with s._lock:
+                s._in_flight -= 1
+
+    def _respond(self, key: str | None):
+        s, f = self.server, self.server.faults
+        time.sleep(f.latency)
+
+        path = None if key is None else s.recordings._path(key)
+        if path is None or not path.exists():
+            self._error(404)
+            return
+        if s._fails(key):
+            self._error(f.error_status)
+            return
+
+        with gzip.open(path, "rb") as fh:
+            body = fh.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        n = len(body) if f.truncate is None else int(len(body) * f.truncate)
+        t0 = time.monotonic()
+        for i in range(0, n, f.chunk_size):
+            chunk = body[i : min(i + f.chunk_size, n)]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            if f.bandwidth:
+                # Pace the body to the bandwidth, however long writes take
+                ahead = (i + len(chunk)) / f.bandwidth - (time.monotonic() - t0)
+                time.sleep(max(ahead, 0))
+
+        if f.truncate is not None:
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _error(self, status: int):
+        body = self.responses.get(status, ("",))[0].encode()
+        self.send_response(status)
+        if status != 404 and (t := self.server.faults.retry_after) is not None:
+            self.send_header("Retry-After", f"{t:g}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m powdb.common.replay",
+        description="Replay recorded responses of the remote sources",
+    )
+    parser.add_argument(
+        "recordings",
+        type=Path,
+        nargs="?",
+        default=DEFAULT_ROOT,
+        help="response cache to replay (default: %(default)s)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    for f in fields(Faults):
+        parser.add_argument(
+            f"--{f.name.replace('_', '-')}",
+            type=int if f.type is int else float,
+            default=f.default,
+        )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = _parse_args(argv)
+    faults = Faults(**{f.name: getattr(args, f.name) for f in fields(Faults)})
+    server = ReplayServer(args.recordings, faults, (args.host, args.port))
+    for var, uri in server.endpoints.items():
+        print(f"export {var}={uri}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
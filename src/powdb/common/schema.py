@@ -0,0 +1,222 @@
+import keyword
+import re
+from collections.abc import Iterable, Mapping
+from contextlib import suppress
+from dataclasses import dataclass, field, make_dataclass
+from typing import Any
+
+from powdb.common.utils import TypeUnion
+
+# Distinct values are only counted up to this many per field, so that (e.g.) an
+# identifier does not keep every value seen
+MAX_DISTINCT = 10_000
+
+# XML Schema datatypes of SPARQL literals, and how to decode them:
+#   <www.w3.org/TR/sparql11-results-json/#select-encode-terms>
+#   <www.w3.org/TR/xmlschema-2/#built-in-datatypes>
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+_DATATYPES = {
+    **{
+        _XSD + t: int
+        for t in (
+            "integer",
+            "int",
+            "long",
+            "short",
+            "nonNegativeInteger",
+            "positiveInteger",
+            "nonPositiveInteger",
+            "negativeInteger",
+        )
+    },
+    **{_XSD + t: float for t in ("float", "double", "decimal")},
+    _XSD + "boolean": lambda v: {"true": True, "1": True}.get(v, False),
+}
+
+
+@dataclass(slots=True)
+class FieldSchema:
+    """
+    What is known of one field of some records: how many records have a value
+    for it (`count`; the rest are null), the type of those values, how many
+    distinct values they take (up to `MAX_DISTINCT`), and whether it is
+    multi-valued (see `infer_schema`).
+    """
+
+    name: str
+    count: int = 0
+    nulls: int = 0
+    multivalued: bool = False
+    # Whether values are given as lists (rather than over many records)
+    repeated: bool = False
+    types: TypeUnion = field(default_factory=TypeUnion, repr=False)
+    values: set = field(default_factory=set, repr=False)
+
+    @property
+    def type(self) -> type:
+        return self.types.type if self.types else Any
+
+    @property
+    def null_rate(self) -> float:
+        n = self.count + self.nulls
+        return self.nulls / n if n else 1.0
+
+    @property
+    def distinct(self) -> int:
+        return len(self.values)
+
+    def _add(self, value: Any):
+        self.count += 1
+        for v in value if isinstance(value, list) else (value,):
+            self.types.add(v)
+            if len(self.values) < MAX_DISTINCT:
+                # Containers (e.g., a relation's members) are not counted
+                with suppress(TypeError):
+                    self.values.add(v)
+
+
+@dataclass(slots=True)
+class Schema:
+    """
+    The fields of some records, as inferred by `infer_schema`.
+    """
+
+    n: int = 0
+    fields: dict[str, FieldSchema] = field(default_factory=dict)
+
+    def __str__(self) -> str:
+        lines = [f"{self.n} records"]
+        for f in self.fields.values():
+            multi = ", multi-valued" if f.multivalued else ""
+            t = f.type.__name__ if type(f.type) is type else f.type
+            lines.append(
+                f"  {f.name}: {t} ({f.null_rate:.1%} null, "
+                f"{f.distinct} distinct{multi})"
+            )
+        return "\n".join(lines)
+
+    def record_type(self, name: str = "Record") -> type:
+        """
+        Return a class with a (slotted) attribute for each field, typed as the
+        schema's, to hold records more compactly than as dicts.
+
+        Field names are made into identifiers (e.g., "tags.name:en" becomes
+        `tags_name_en`).  The class' `decode` method makes a record from a
+        mapping of field names to values (ignoring any other fields).
+        """
+        attrs = [_identifier(f) for f in self.fields]
+        if len(set(attrs)) != len(attrs):
+            raise ValueError(f"Fields are not distinct as identifiers: {attrs}")
+
+        specs = []
+        for attr, f in zip(attrs, self.fields.values(), strict=True):
+            t = list[f.type] if f.repeated else f.type
+            specs.append((attr, t | None, field(default=None)))
+
+        names = list(self.fields)
+
+        def decode(cls, record: Mapping[str, Any]):
+            return cls(*map(record.get, names))
+
+        return make_dataclass(
+            name,
+            specs,
+            namespace={"decode": classmethod(decode)},
+            slots=True,
+        )
+
+
+def infer_schema(
+    records: Iterable[Mapping[str, Any]],
+    key: str | None = None,
+    fields: Iterable[str] = (),
+) -> Schema:
+    """
+    Infer the schema of some flat records (e.g., from `osm_fields` or
+    `sparql_fields`) in a single pass.
+
+    A field is null in a record if it is missing or None.  It is multi-valued
+    if any record gives it as a list, or, if `key` is given, if records with
+    the same key give it different values (as a SPARQL query returns a row
+    for each value); records with the same key must then be consecutive.
+
+    `fields` are included in the schema whether or not any record has them.
+    """
+    schema = Schema()
+    for name in fields:
+        schema.fields[name] = FieldSchema(name)
+
+    group, first = object(), {}
+    for r in records:
+        schema.n += 1
+        if key is not None and r.get(key) != group:
+            group, first = r.get(key), {}
+
+        for name, v in r.items():
+            if v is None:
+                continue
+
+            if (f := schema.fields.get(name)) is None:
+                f = schema.fields[name] = FieldSchema(name)
+            f._add(v)
+
+            if isinstance(v, list):
+                f.multivalued = f.repeated = True
+            elif key is not None and first.setdefault(name, v) != v:
+                f.multivalued = True
+
+    for f in schema.fields.values():
+        f.nulls = schema.n - f.count
+
+    return schema
+
+
+def osm_fields(e: Mapping[str, Any]) -> dict[str, Any]:
+    """
+    Flatten a raw OSM element into fields, with its tags as "tags.<key>".
+
+    Tag values holding many values separated by semicolons (e.g., a building
+    of more than one religion) are split into lists:
+      <wiki.openstreetmap.org/wiki/Semi-colon_value_separator>
+    """
+    out = {k: v for k, v in e.items() if k != "tags"}
+    for k, v in e.get("tags", {}).items():
+        out[f"tags.{k}"] = v.split(";") if ";" in v else v
+    return out
+
+
+def sparql_fields(binding: Mapping[str, Mapping[str, str]]) -> dict[str, Any]:
+    """
+    Flatten a SPARQL result binding into fields, decoding typed literals
+    (e.g., an xsd:float to a float, or None if it is malformed), and keeping
+    the language of any literal as "<var>_lang".
+    """
+    out: dict[str, Any] = {}
+    for var, term in binding.items():
+        out[var] = decode_literal(term["value"], term.get("datatype"))
+
+        if (lang := term.get("xml:lang")) is not None:
+            out[f"{var}_lang"] = lang
+
+    return out
+
+
+def decode_literal(value: str, datatype: str | None) -> Any:
+    """
+    Decode the value of a SPARQL literal of the given datatype (e.g., an
+    xsd:float to a float, or None if it is malformed).  Values of any other
+    datatype (or none) are left as strings.
+    """
+    if (decode := _DATATYPES.get(datatype)) is None:
+        return value
+    try:
+        return decode(value)
+    except ValueError:
+        return None
+
+
+def _identifier(name: str) -> str:
+    name = re.sub(r"\W", "_", name)
+    if not name or name[0].isdigit() or keyword.iskeyword(name):
+        name = f"_{name}"
+    return name
@@ -0,0 +1,185 @@
+import random
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from powdb.common.metrics import METRICS
+
+USER_AGENT = "places-of-worship (github.com/jakewilliami/places-of-worship)"
+
+# Responses worth retrying, as they are (usually) transient:
+#   <developer.mozilla.org/en-US/docs/Web/HTTP/Status#server_error_responses>
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def _retry_after(resp: requests.Response) -> float | None:
+    # The Retry-After header may be given in seconds or as an HTTP date:
+    #   <developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Retry-After>
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Transport:
+    """
+    A shared HTTP transport for all remote sources.
+
+    Connections are kept alive in a pool (per host), so that repeated requests
+    (e.g., pages of a query) do not each pay for a new TCP and TLS handshake.
+    The number of concurrent requests to any one host is limited to
+    `concurrency` (or as given per host in `limits`), and requests to hosts in
+    `rates` are started no more often than the given number per second.
+
+    Requests that fail with a transient status (see `RETRY_STATUSES`) or
+    connection error are retried up to `retries` times, waiting as long as the
+    server asks in its Retry-After header, or otherwise with exponential backoff
+    and full jitter:
+      <aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter>
+
+    Either way, no wait is longer than `max_backoff` seconds (as a server may
+    ask us to wait for hours).
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        limits: dict[str, int] | None = None,
+        rates: dict[str, float] | None = None,
+        retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float | tuple[float, float | None] = (30.0, None),
+    ):
+        self.concurrency = concurrency
+        self.limits = limits or {}
+        self.rates = rates or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = USER_AGENT
+
+        # Keep at least as many connections per host as we allow concurrent
+        # requests, so that none are discarded after use
+        n = max(concurrency, *self.limits.values(), 1)
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=n)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._next: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            if host not in self._semaphores:
+                n = self.limits.get(host, self.concurrency)
+                self._semaphores[host] = threading.BoundedSemaphore(n)
+            return self._semaphores[host]
+
+    def _throttle(self, url: str):
+        # Reserve the next slot for the host, and wait until it arrives
+        host = urlsplit(url).hostname or ""
+        if not (rate := self.rates.get(host)):
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            t = max(now, self._next.get(host, now))
+            self._next[host] = t + 1 / rate
+
+        if t > now:
+            time.sleep(t - now)
+
+    def _delay(self, attempt: int, resp: requests.Response | None) -> float:
+        if resp is not None and (t := _retry_after(resp)) is not None:
+            return min(t, self.max_backoff)
+
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+    @contextmanager
+    def open(
+        self, method: str, url: str, **kwargs
+    ) -> Iterator[requests.Response]:
+        """
+        Context manager yielding the (streamed) response to a request, once any
+        transient errors have been retried.  Raises `requests.HTTPError` for
+        an unsuccessful response.
+
+        The request counts towards its host's concurrency limit until the block
+        exits, as its connection is in use until the body has been read.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        sem = self._semaphore(url)
+
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            with sem:
+                self._throttle(url)
+                try:
+                    with METRICS.stage("request"):
+                        resp = self._session.request(
+                            method, url, stream=True, **kwargs
+                        )
+                except requests.ConnectionError:
+                    if last:
+                        raise
+                    resp = None
+                else:
+                    if last or resp.status_code not in RETRY_STATUSES:
+                        with resp:
+                            resp.raise_for_status()
+                            yield resp
+                        return
+
+                    resp.close()
+
+            # Wait without holding our place in the queue for the host
+            METRICS.add("request", retries=1)
+            time.sleep(self._delay(attempt, resp))
+
+    def stream(
+        self, method: str, url: str, chunk_size: int = _CHUNK_SIZE, **kwargs
+    ) -> Iterator[bytes]:
+        """
+        Yield the body of the response to a request in raw chunks of bytes.
+        """
+        with self.open(method, url, **kwargs) as resp:
+            chunks = resp.iter_content(chunk_size=chunk_size)
+            yield from METRICS.timed(chunks, "transfer", size=len)
+
+
+# Shared transport used by all sources by default.  The public Overpass
+# instance allows only a couple of concurrent queries per IP address,
+# Nominatim allows at most one request per second, and the OSM API is not for
+# bulk downloads, so we keep to a modest rate:
+#   <wiki.openstreetmap.org/wiki/Overpass_API#Public_Overpass_API_instances>
+#   <operations.osmfoundation.org/policies/nominatim>
+#   <operations.osmfoundation.org/policies/api>
+TRANSPORT = Transport(
+    limits={"overpass-api.de": 2, "api.openstreetmap.org": 2},
+    rates={"nominatim.openstreetmap.org": 1.0, "api.openstreetmap.org": 2.0},
+)
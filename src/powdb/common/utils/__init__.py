@@ -1,4 +1,4 @@
-from .eltype import eltype
+from .eltype import TypeUnion, eltype
 from .findfirst import findfirst
 from .only import only
 from .partition import partition
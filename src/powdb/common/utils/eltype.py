@@ -1,6 +1,5 @@
 from collections.abc import Container, Iterable, Iterator, Mapping
-from functools import reduce
-from itertools import chain
+from functools import cache, reduce
 from types import GenericAlias
 from typing import Any, Never, NoReturn, get_args, get_origin
 
@@ -23,125 +22,266 @@ def _is_immutable_container[T](x: Container[T]) -> bool:
 
 
 def _type_union_t(types: Iterable[type]) -> type:
+    return _reduce_union(tuple(types))
+
+
+@cache
+def _reduce_union(types: tuple[type, ...]) -> type:
+    # The same unions recur across elements, and building one is not free
     return reduce(lambda a, b: a | b, types)
 
 
-def _type_union[T](x: Iterable[T]) -> type:
-    # Given a collection of types, find their union type
+# How to type a value of each class; see `_type`.  Checking a class against the
+# ABCs is slow, so is done once per class rather than once per value
+_SCALAR, _STR, _MAPPING, _TUPLE, _COLLECTION = range(5)
+_KINDS: dict[type, int] = {}
 
-    # As we need to iterate over x more than once, we must make a greedy copy
-    # of it so that it is not consumed
-    if isinstance(x, Iterator):
-        x = list(x)
+
+def _kind(t: type) -> int:
+    if (k := _KINDS.get(t)) is not None:
+        return k
+
+    if not issubclass(t, Container):
+        k = _SCALAR
+    elif issubclass(t, str):
+        k = _STR
+    elif issubclass(t, Mapping):
+        k = _MAPPING
+    elif issubclass(t, tuple):
+        k = _TUPLE
+    else:
+        k = _COLLECTION
+
+    _KINDS[t] = k
+    return k
+
+
+# Types of containers, keyed by their "shape": the classes of their elements,
+# where those are all scalars or strings (so each is its own type).  Many
+# containers share a shape (e.g., every OSM element's tags are all strings), so
+# this spares typing each of their elements one by one.  Only the most recent
+# `_MAX_SHAPES` are kept, as the values typed may have no end of shapes
+_SHAPES: dict[tuple, type] = {}
+_MAX_SHAPES = 1024
+
+
+def _add_shape(shape: tuple, t: type):
+    # Forget the oldest shape (dicts keep their keys in insertion order)
+    if len(_SHAPES) >= _MAX_SHAPES:
+        _SHAPES.pop(next(iter(_SHAPES)), None)
+    _SHAPES[shape] = t
+
+
+def _is_flat(types: Iterable[type]) -> bool:
+    return all(_kind(t) <= _STR for t in types)
+
+
+def _type_union[T](x: Iterable[T], stable: int | None = None) -> type:
+    # Given a collection of types, find their union type
 
     # If the iterable is invalid, we can't infer the type, so we return Any
     #
     # However, we must give special handling to the possibility that we have
     # an empty tuple whose element type cannot be inferred.  In this case, we
-    # return the bottom type; see case 2 in `_typeof_tuples`.  In fact, this
-    # is true for any empty immutable container.  Another example of this in
-    # base Python is the frozenset
-    if not x:
+    # return the bottom type; see case 2 in `TypeUnion._tuple_type`.  In fact,
+    # this is true for any empty immutable container.  Another example of this
+    # in base Python is the frozenset
+    u = TypeUnion().update(x, stable)
+    if not u:
         if _is_immutable_container(x):
             return Never
 
         return Any
 
-    # Special dispatch required for union-ing of tuples
-    #
-    # We use a for-append pattern rather than list comprehension twice:
-    #     tuple_types = [e for e in x if isinstance(e, tuple)]
-    #     rest = set(_type(e) for e in x if not isinstance(e, tuple))
-    #
-    # This is preferrable so that we don't have to iterate more than once, and
-    # so that order is easier to ensure with uniqueness.
-    rest, tuple_types = [], []
-    for e in x:
-        if isinstance(e, tuple):
-            tuple_types.append(e)
+    return u.type
+
+
+class TypeUnion:
+    """
+    The union of the types of some values, computed incrementally as they are
+    added, so that `eltype` can infer the element type of a collection (or an
+    iterator) in a single pass, without keeping its elements.
+
+    Tuples are not typed one by one, but counted towards running unions of
+    their elements (per position, for each length of tuple seen), so that many
+    tuples are typed as quickly as their elements.
+    """
+
+    __slots__ = ("n", "_types", "_tuples", "_empty_tuple")
+
+    def __init__(self):
+        self.n = 0
+        # Distinct types, in the order first seen (as keys of a dict, so that
+        # membership is a hash lookup rather than a scan)
+        self._types: dict[type, None] = {}
+        self._tuples: dict[int, list[TypeUnion]] = {}
+        self._empty_tuple = False
+
+    def __len__(self) -> int:
+        return self.n
+
+    def add[T](self, x: T) -> bool:
+        """
+        Add the type of `x` to the union, and return whether the union changed.
+        """
+        self.n += 1
+
+        # Special dispatch required for union-ing of tuples
+        if _kind(type(x)) == _TUPLE:
+            if not x:
+                changed = not self._empty_tuple
+                self._empty_tuple = True
+                return changed
+
+            cols = self._tuples.get(len(x))
+            changed = cols is None
+            if changed:
+                cols = self._tuples[len(x)] = [TypeUnion() for _ in x]
+
+            # Every element must be added, so this can't short-circuit
+            for u, e in zip(cols, x, strict=True):
+                changed |= u.add(e)
+            return changed
+
+        t = _type(x)
+        if t in self._types:
+            return False
+
+        self._types[t] = None
+        return True
+
+    def update[T](self, x: Iterable[T], stable: int | None = None):
+        """
+        Add the types of the values in `x` to the union.
+
+        If `stable` is given, stop early once that many consecutive values have
+        not changed the union (leaving the rest of `x` unread, if an iterator).
+        The result is then only inferred from a prefix of `x`, so may omit the
+        types of rarer values.
+        """
+        if stable is None:
+            for e in x:
+                self.add(e)
+            return self
+
+        unchanged = 0
+        for e in x:
+            unchanged = 0 if self.add(e) else unchanged + 1
+            if unchanged >= stable:
+                break
+
+        return self
+
+    def merge(self, other: "TypeUnion"):
+        """
+        Add the types of the values of another union to this one.
+        """
+        self.n += other.n
+        self._types.update(other._types)
+        self._empty_tuple |= other._empty_tuple
+        for n, cols in other._tuples.items():
+            if n not in self._tuples:
+                self._tuples[n] = [TypeUnion() for _ in cols]
+            for u, v in zip(self._tuples[n], cols, strict=True):
+                u.merge(v)
+        return self
+
+    @property
+    def type(self) -> type:
+        types = list(self._types)
+        if self._tuples or self._empty_tuple:
+            types.append(self._tuple_type())
+
+        # Final reduced union type
+        return _type_union_t(types)
+
+    def _tuple_type(self) -> type:
+        # Case 2: special handling for empty tuples
+        #
+        # As tuples are immutable, an empty tuple cannot change type.  However,
+        # we can't know its element type at compile time, so it must be a
+        # "bottom" type.  That is, a type ⊥, that is the subtype of all other
+        # types.
+        #
+        # In Julia, the eltype(()) == Base.Bottom == Union{}.  The empty union
+        # of types represents a type that has no values.
+        #
+        # Although there are make-shift bottom types in Python (Never and
+        # NoReturn), PEP 484 specifies a special type for the empty tuple:
+        # tuple[()].
+        #
+        #   <en.wikipedia.org/wiki/Bottom_type>
+        #   <https://docs.python.org/3/library/typing.html#typing.Never>
+        #   <https://docs.python.org/3/library/typing.html#typing.NoReturn>
+        #   <github.com/python/mypy/issues/4211#issuecomment-342377880>
+        #   <peps.python.org/pep-0484>
+        if not self._tuples:
+            return tuple[()]
+
+        if len(self._tuples) == 1:
+            # Case 3: all (non-empty) tuples are a fixed length
+            #
+            # In this case, the union of each position's elements has been
+            # kept as they were added (i.e., the tuples have been transposed)
+            (cols,) = self._tuples.values()
+            t = tuple[tuple(u.type for u in cols)]
         else:
-            t = _type(e)
-            if t not in rest:
-                rest.append(t)
+            # Case 4: tuple lengths differ, so we must return variable-length
+            # tuple, of the union of every element at every position
+            u = TypeUnion()
+            for cols in self._tuples.values():
+                for v in cols:
+                    u.merge(v)
+            t = tuple[u.type, ...]
 
-    if tuple_types:
-        rest.append(_typeof_tuples(tuple_types))
+        # Continued special handling for empty tuples: applying the union
+        if self._empty_tuple:
+            t |= tuple[()]
 
-    # Final reduced union type
-    return _type_union_t(rest)
+        return t
 
 
-def _eltype_mapping(x: Mapping) -> type:
-    kt = _eltype(x.keys())
-    vt = _eltype(x.values())
+def _eltype_mapping(x: Mapping, stable: int | None = None) -> type:
+    kt = _eltype(x.keys(), stable)
+    vt = _eltype(x.values(), stable)
     return tuple[kt, vt]
 
 
-def _typeof_tuples(x: tuple | list[tuple]) -> type[tuple]:
+def _typeof_tuples(x: tuple) -> type[tuple]:
     # Case 1: optimised dispatch when passed a single tuple
     #
     # This works for the case of an empty tuple as the `for e in x` generator
     # wrapped in `tuple()` will be empty.
-    if isinstance(x, tuple):
-        return tuple[tuple(_type(e) for e in x)]
-
-    # Now we can handle more complex cases of tuple typing
-    ns = {len(t) for t in x}
-    tt = [[e for e in t] for t in x]
-
-    # Case 2: special handling for empty tuples
-    #
-    # As tuples are immutable, an empty tuple cannot change type.  However, we
-    # can't know its element type at compile time, so it must be a "bottom" type
-    # That is, a type ⊥, that is the subtype of all other types.
-    #
-    # In Julia, the eltype(()) == Base.Bottom == Union{}.  The empty union of
-    # types represents a type that has no values.
-    #
-    # Although there are make-shift bottom types in Python (Never and NoReturn),
-    # PEP 484 specifies a special type for the empty tuple: tuple[()].
     #
-    #   <en.wikipedia.org/wiki/Bottom_type>
-    #   <https://docs.python.org/3/library/typing.html#typing.Never>
-    #   <https://docs.python.org/3/library/typing.html#typing.NoReturn>
-    #   <github.com/python/mypy/issues/4211#issuecomment-342377880>
-    #   <peps.python.org/pep-0484>
-    has_empty = 0 in ns
-    if len(ns) == 1 and has_empty:
-        return tuple[()]
-
-    if has_empty:
-        # Remove the empty tuple and recompute lengths
-        tt[:] = [t for t in tt if len(t) > 0]
-        ns = {len(t) for t in tt}
-
-    if len(ns) == 1:
-        # Case 3: all tuples are a fixed length
-        #
-        # In this case, we have to organise these by column (i.e., transpose).
-        # E.g., into tuples of the first element, and then the second, and so on
-        #
-        # We can zip these stictly because we know that they all have the same
-        # number of elements.
-        tt_trans = zip(*tt, strict=True)
-        t = tuple[tuple(_type_union(col) for col in tt_trans)]
-    else:
-        # Case 4: tuple lengths differ, so we must return variable-length tuple
-        t = tuple[_type_union(chain.from_iterable(tt)), ...]
-
-    # Continued special handling for empty tuples: applying the union
-    if has_empty:
-        t |= tuple[()]
-
+    # Collections of tuples (cases 2 to 4) are typed by `TypeUnion`
+    shape = tuple(map(type, x))
+    if (t := _SHAPES.get(shape)) is not None:
+        return t
+
+    t = tuple[tuple(_type(e) for e in x)]
+    if _is_flat(shape):
+        _add_shape(shape, t)
     return t
 
 
 def _typeof_dict(x: dict) -> type[dict]:
+    shape = (
+        dict,
+        frozenset(map(type, x.keys())),
+        frozenset(map(type, x.values())),
+    )
+    if (t := _SHAPES.get(shape)) is not None:
+        return t
+
     kt = _eltype(x.keys())
     vt = _eltype(x.values())
-    return dict[kt, vt]
+    t = dict[kt, vt]
+    if x and _is_flat(shape[1] | shape[2]):
+        _add_shape(shape, t)
+    return t
 
 
+@cache
 def _collection_type(ct: type, et: type) -> type:
     # Case 1: generic container type as we cannot infer element type
     if et == Any:
@@ -154,16 +294,18 @@ def _collection_type(ct: type, et: type) -> type:
 def _type[T](x: T) -> type:
     # TODO: in future, expose an interface to this function so that I can
     #   make a `typeof` method.
-    if not isinstance(x, Container):
-        return type(x)
+    t = type(x)
+    k = _kind(t)
+    if k == _SCALAR:
+        return t
 
-    if isinstance(x, str):
+    if k == _STR:
         return str
 
-    if isinstance(x, Mapping):
+    if k == _MAPPING:
         return _typeof_dict(x)
 
-    if isinstance(x, tuple):
+    if k == _TUPLE:
         return _typeof_tuples(x)
 
     # As `_type` is only used internally, it is safe to assume that once we get
@@ -171,15 +313,21 @@ def _type[T](x: T) -> type:
     # as a parameterised generic.  However, calling something like
     # `_type(range(10))` will not work, so if I expose a `typeof` method in
     # future, extended types will need to be accounted for.
-    t = _eltype(x)
-    return _collection_type(type(x), t)
+    shape = (t, frozenset(map(type, x)))
+    if (ct := _SHAPES.get(shape)) is not None:
+        return ct
 
+    ct = _collection_type(t, _eltype(x))
+    if x and _is_flat(shape[1]):
+        _add_shape(shape, ct)
+    return ct
 
-def _eltype[T](x: Container[T]) -> type:
+
+def _eltype[T](x: Container[T], stable: int | None = None) -> type:
     if isinstance(x, Mapping):
-        return _eltype_mapping(x)
+        return _eltype_mapping(x, stable)
 
-    return _type_union(x)
+    return _type_union(x, stable)
 
 
 # TODO: support this in future
@@ -213,12 +361,17 @@ def _eltype_t(t: type) -> type:
     return only(args) or Any
 
 
-def eltype[T](x: T) -> type:
+def eltype[T](x: T, stable: int | None = None) -> type:
     """
     Return the element type of the given collection,
 
     If there are no elements,
 
+    Elements are typed in a single pass, so an iterator is consumed but not
+    kept in memory.  If `stable` is given, inference stops early once that
+    many consecutive elements have all been of types already seen (see
+    `TypeUnion.update`), which suits large collections of few types.
+
     Inspired by Julia's `eltype` function:
       <github.com/JuliaLang/julia/blob/7fa26f01/base/abstractarray.jl#L219-L242>
 
@@ -239,24 +392,23 @@ def eltype[T](x: T) -> type:
     if isinstance(x, (type, GenericAlias)) or get_origin(t) is not None:
         return _eltype_t(x)
 
-    # If we are given an iterator, we cannot conveniently review its contents
-    # without consuming it, so we load it into memory.  Despite the potential
-    # memory cost of this, it is required to check all elements so that we can
-    # infer all types in the container.
+    # If we are given an iterator, we cannot review its contents without
+    # consuming it, but as elements are typed in one pass, it need not be
+    # loaded into memory
     if isinstance(x, Iterator):
-        x = list(x)
+        return _type_union(x, stable)
 
     # Dispatch into recursive `_eltype` method for containers.
     if isinstance(x, Container):
-        return _eltype(x)
+        return _eltype(x, stable)
 
     # Any non-iterable type has element type `Any`.  This is the "top type",
     # which includes all other types as subtypes.
     #
-    # Returning the bottom type (see case 2 in `_typeof_tuples`) as a default
-    # might seem appealing, but that would mean "this type has no elements,"
-    # which isn't necessarily true for non-iterables.  The concept of having
-    # elements for non-iterables is undefined, not empty.
+    # Returning the bottom type (see case 2 in `TypeUnion._tuple_type`) as a
+    # default might seem appealing, but that would mean "this type has no
+    # elements," which isn't necessarily true for non-iterables.  The concept
+    # of having elements for non-iterables is undefined, not empty.
     #
     #   <en.wikipedia.org/wiki/Any_type>
     #   <docs.python.org/3/library/typing.html#typing.Any>
@@ -1,8 +1,8 @@
-from collections.abc import Iterator, Sequence
+from collections.abc import Iterable, Iterator
 from itertools import batched
 
 
-def partition[T](x: Sequence[T], n: int) -> Iterator[tuple[T]]:
+def partition[T](x: Iterable[T], n: int) -> Iterator[tuple[T]]:
     """
     Helper metthod to partition an array `x` into equal blocks of size `n`,
     with the final block containing potentially fewer than `n` elements if the
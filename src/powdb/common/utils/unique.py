@@ -1,7 +1,7 @@
-from collections.abc import Iterable, Iterator, Mapping
+from collections.abc import Callable, Iterable, Iterator, Mapping
 
 
-def in_mut[T](x: T, s: list[T]) -> bool:
+def in_mut[T](x: T, s: set[T] | list[T]) -> bool:
     """
     If `x` is in `s`, return true.  If not, push `x` into `s` and return false.
 
@@ -11,13 +11,20 @@ def in_mut[T](x: T, s: list[T]) -> bool:
     Or in Julia:
         x in s ? true : (push!(s, x); false)
 
+    `s` may be a set (for hashable elements, with constant-time lookup) or a
+    list (for unhashable elements, with linear-time lookup).
+
     Inspired by Julia's `in!` function:
       <github.com/JuliaLang/julia/blob/7fa26f01/base/set.jl#L94-L135>
     """
     if x in s:
         return True
 
-    s.append(x)
+    if isinstance(s, set):
+        s.add(x)
+    else:
+        s.append(x)
+
     return False
 
 
@@ -28,13 +35,42 @@ def _items[T, U](x: Iterable[T]) -> Iterator[U]:
         yield from x
 
 
-def unique[T](x: Iterable[T]) -> list[T]:
+def _seen_mut[T](x: T, hashed: set[T], unhashed: list[T]) -> bool:
+    # Fast path: hashable values are checked against the set in constant time.
+    # Hashing an unhashable value (including, e.g., a tuple containing a list)
+    # raises a `TypeError`, which we use to dispatch to the slow path, rather
+    # than pre-emptively checking each value's hashability
+    try:
+        if x in hashed:
+            return True
+
+        # We must still check the (usually empty) list of unhashable values, as
+        # a hashable value may compare equal to one of those
+        if unhashed and x in unhashed:
+            return True
+
+        hashed.add(x)
+        return False
+    except TypeError:
+        # Likewise, an unhashable value may compare equal to a hashable one
+        # that we have already seen (e.g., `{1} == frozenset({1})`), so we
+        # fall back to a linear scan of both
+        return any(x == e for e in hashed) or in_mut(x, unhashed)
+
+
+def unique[T, K](x: Iterable[T], by: Callable[[T], K] | None = None) -> list[T]:
     """
     Return an array containing only the unique elements of the collection, as
     determed by their hash, in the order that the first of each set of
     equivalent elements originally apprars.
 
-    The container type of the input is preserved with `empty`.
+    If `by` is given, it is applied to each element, and elements are
+    considered equivalent when the results of `by` are equal.  This is useful
+    for deduplicating records on some identifying key (e.g., an OSM element
+    ID or DBpedia URI) without comparing the records in full.
+
+    Hashable elements (or keys) are tracked in a set; we only fall back to a
+    (linear) list lookup for elements that cannot be hashed.
 
     `x` must be some container that implements the `__len__()` and `__getitem__`
     methods.
@@ -43,14 +79,18 @@ def unique[T](x: Iterable[T]) -> list[T]:
       <github.com/JuliaLang/julia/blob/7fa26f01/base/set.jl#L200-L478>
       <github.com/JuliaLang/julia/blob/7fa26f01/base/multidimensional.jl#L1714-L1834>
     """
-    # TODO
     if not isinstance(x, Iterable):
         raise TypeError("Cannot compute unique elements of non-iterable type")
 
-    # NOTE: `seen` must be a list as items of x may be unhashable
-    seen, out = list(), list()
+    if by is not None and not callable(by):
+        raise TypeError("Cannot compute unique elements with non-callable key")
+
+    # NOTE: items of x may be unhashable, so we keep a list of those that are
+    # alongside the set of those that are not
+    hashed, unhashed, out = set(), list(), list()
 
     for e in _items(x):
-        in_mut(e, seen) or out.append(e)
+        k = e if by is None else by(e)
+        _seen_mut(k, hashed, unhashed) or out.append(e)
 
     return out
@@ -0,0 +1,3 @@
+from powdb.linkage.names import NameIndex, link, normalise_name, place_names
+from powdb.linkage.regions import Polygon, RegionIndex, load_regions
+from powdb.linkage.spatial import GridIndex, candidate_pairs
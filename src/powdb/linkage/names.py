@@ -0,0 +1,222 @@
+import math
+import re
+import unicodedata
+from collections.abc import Iterable, Sequence
+
+from powdb.common.record import Place
+from powdb.linkage.spatial import candidate_pairs
+
+# Common abbreviations in the names of places of worship, expanded so that
+# (e.g.) "St Paul's" and "Saint Paul's" normalise alike
+_ABBREVIATIONS = {
+    "st": "saint",
+    "sts": "saints",
+    "ste": "sainte",
+    "mt": "mount",
+    "&": "and",
+}
+
+# Tags holding other names of a place (including its names in other
+# languages, such as DBpedia's labels):
+#   <wiki.openstreetmap.org/wiki/Names#Key_Variations>
+_NAME_TAGS = ("official_name", "alt_name", "old_name", "short_name")
+
+_TOKEN = re.compile(r"[^\W_]+|&")
+
+
+def normalise_name(name: str) -> str:
+    """
+    Normalise a name for comparison: case-folded, without accents or
+    punctuation (apostrophes are dropped, so "Paul's" becomes "pauls"), with
+    common abbreviations expanded, and with single spaces between words.
+    """
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = name.replace("'", "").replace("’", "")
+    return " ".join(_ABBREVIATIONS.get(t, t) for t in _TOKEN.findall(name))
+
+
+def ngrams(name: str, n: int = 3) -> frozenset[str]:
+    """
+    Return the set of character n-grams of a (normalised) name, padded with
+    spaces so that the start and end of each word are grams of their own.
+    """
+    padded = f" {name} "
+    return frozenset(padded[i : i + n] for i in range(len(padded) - n + 1))
+
+
+def place_names(p: Place) -> list[str]:
+    """
+    Return the distinct normalised names of a place, from its name and any
+    name tags (e.g., "name:mi" or "alt_name").
+    """
+    names = [p.name] if p.name else []
+    for k, v in p.tags.items():
+        if k.startswith("name:") or k in _NAME_TAGS:
+            names.extend(v.split(";"))
+    return list(dict.fromkeys(filter(None, map(normalise_name, names))))
+
+
+class NameIndex:
+    """
+    An inverted index of n-grams over the names of some records, to find the
+    records with names similar to a query without comparing it to every name.
+
+    Similarity is the Dice coefficient of the two names' sets of n-grams,
+    each weighted by its inverse document frequency among the indexed names,
+    so that words common to many names (e.g., "saint" or "church") count for
+    less than those that distinguish them:
+      <en.wikipedia.org/wiki/Dice-S%C3%B8rensen_coefficient>
+      <en.wikipedia.org/wiki/Tf%E2%80%93idf#Inverse_document_frequency>
+
+    A name must share at least a certain weight of n-grams with a query to be
+    similar enough, so only the postings of the query's rarest n-grams need
+    to be read to find every candidate ("prefix filtering"):
+      <doi.org/10.1145/1367497.1367516>
+
+    Each record may have many names (e.g., from `place_names`), and records
+    are identified by their position in `names`.
+    """
+
+    def __init__(self, names: Iterable[Iterable[str]], n: int = 3):
+        self.n = n
+        self._records: list[int] = []
+        self._grams: list[frozenset[str]] = []
+        self._postings: dict[str, list[int]] = {}
+
+        for i, record in enumerate(names):
+            for name in record:
+                entry = len(self._grams)
+                grams = ngrams(name, n)
+                self._records.append(i)
+                self._grams.append(grams)
+                for g in grams:
+                    self._postings.setdefault(g, []).append(entry)
+
+        # Grams absent from the index are the rarest of all
+        size = len(self._grams)
+        self._max_weight = math.log1p(size)
+        self._weights = {
+            g: math.log1p(size / len(entries))
+            for g, entries in self._postings.items()
+        }
+        self._sizes = [self.weight(grams) for grams in self._grams]
+
+    def weight(self, grams: Iterable[str]) -> float:
+        return math.fsum(self._weights.get(g, self._max_weight) for g in grams)
+
+    def search(
+        self, names: Iterable[str], threshold: float = 0.6
+    ) -> dict[int, float]:
+        """
+        Return the records with a name whose similarity with any of `names`
+        is at least `threshold` (which must be positive), mapped to the best
+        such similarity.
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Threshold must be in (0, 1]; got {threshold}")
+
+        hits: dict[int, float] = {}
+        for name in names:
+            q = ngrams(name, self.n)
+            a = self.weight(q)
+
+            # The Dice coefficient of sets of weights a and b sharing weight c
+            # is 2c/(a + b), which (as c <= b) is at least t only if c >= at/
+            # (2 - t).  So a match must share one of the query's rarest grams,
+            # enough that those remaining weigh less than that
+            overlap = a * threshold / (2 - threshold)
+            rest = a
+            candidates = set()
+            for g in sorted(q, key=lambda g: len(self._postings.get(g, ()))):
+                if rest < overlap - 1e-9:
+                    break
+                candidates.update(self._postings.get(g, ()))
+                rest -= self._weights.get(g, self._max_weight)
+
+            for entry in candidates:
+                c = self.weight(q & self._grams[entry])
+                score = 2 * c / (a + self._sizes[entry])
+                i = self._records[entry]
+                if score >= threshold and score > hits.get(i, 0):
+                    hits[i] = score
+
+        return hits
+
+    def similarity(self, a: str, b: str) -> float:
+        """
+        Return the similarity of two (normalised) names.
+        """
+        x, y = ngrams(a, self.n), ngrams(b, self.n)
+        return 2 * self.weight(x & y) / (self.weight(x) + self.weight(y))
+
+
+def link(
+    left: Sequence[Place],
+    right: Sequence[Place],
+    threshold: float = 0.6,
+    radius: float | None = None,
+) -> list[tuple[int, int, float]]:
+    """
+    Link the places in `left` to those in `right` with similar names, as the
+    (left index, right index, similarity) of each pair whose best similarity
+    between any of their names (see `NameIndex`) is at least `threshold`.
+
+    If `radius` is given, only places within that many metres of one another
+    are compared (see `spatial.candidate_pairs`); places without coordinates
+    are then never linked.
+
+    Names are compared in one batch per distinct name set, so that places
+    sharing a name (e.g., the many "St Mary's Church"es) are searched once.
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError(f"Threshold must be in (0, 1]; got {threshold}")
+
+    if radius is not None:
+        return _link_nearby(left, right, threshold, radius)
+
+    index = NameIndex(map(place_names, right))
+
+    batches: dict[tuple[str, ...], list[int]] = {}
+    for i, p in enumerate(left):
+        batches.setdefault(tuple(place_names(p)), []).append(i)
+
+    links = []
+    for names, members in batches.items():
+        hits = sorted(index.search(names, threshold).items())
+        links.extend((i, j, score) for i in members for j, score in hits)
+
+    links.sort()
+    return links
+
+
+def _link_nearby(
+    left: Sequence[Place],
+    right: Sequence[Place],
+    threshold: float,
+    radius: float,
+) -> list[tuple[int, int, float]]:
+    def coords(places: Sequence[Place]) -> tuple[list[float], list[float]]:
+        return (
+            [math.nan if p.lat is None else p.lat for p in places],
+            [math.nan if p.lon is None else p.lon for p in places],
+        )
+
+    right_names = [place_names(p) for p in right]
+    index = NameIndex(right_names)
+
+    links = []
+    for i, j, _ in candidate_pairs(coords(left), coords(right), radius):
+        score = max(
+            (
+                index.similarity(a, b)
+                for a in place_names(left[i])
+                for b in right_names[j]
+            ),
+            default=0,
+        )
+        if score >= threshold:
+            links.append((i, j, score))
+
+    links.sort()
+    return links
@@ -0,0 +1,283 @@
+import json
+import math
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import pairwise
+from pathlib import Path
+from typing import Any
+
+from powdb.common.geo import BBox
+from powdb.store.columns import Categorical
+
+# A ring is a closed sequence of (lon, lat) positions, as in GeoJSON:
+#   <datatracker.ietf.org/doc/html/rfc7946#section-3.1.6>
+type Ring = Sequence[Sequence[float]]
+
+# How far (in cells) a polygon's grid starts beyond its bounding box, to the
+# south and to the west: the fractional parts of the golden ratio and of the
+# square root of 2, as far as can be from any simple fraction, and from each
+# other (so that corners of the grid do not fall along the diagonal of the
+# bounding box; see `Polygon`)
+_OFFSET_SOUTH = (3 - math.sqrt(5)) / 2
+_OFFSET_WEST = math.sqrt(2) - 1
+
+
+class Polygon:
+    """
+    A (multi)polygon, prepared for testing whether it contains many points.
+
+    Its bounding box is divided into a grid of cells, about as many as it has
+    edges, and each edge is indexed by the cells that it may cross.  Whether
+    each corner of the grid is inside is known from the (sorted) points at
+    which edges cross each line of the grid, so a point in a cell that no edge
+    crosses is inside if the cell's corner is, and otherwise only the (few)
+    edges of its cell need be tested, along a path from the corner to it.
+
+    Rings are all treated alike (by the even-odd rule), so holes and parts
+    need not be told apart.  Coordinates are taken as planar.
+
+    NOTE: a point on the boundary of the polygon may be found to be inside or
+    out of it.
+    """
+
+    def __init__(self, rings: Iterable[Ring]):
+        x1, y1, x2, y2 = array("d"), array("d"), array("d"), array("d")
+        for ring in rings:
+            # Closing the ring, if it is not already
+            for (ax, ay, *_), (bx, by, *_) in pairwise([*ring, *ring[:1]]):
+                if (ax, ay) != (bx, by):
+                    x1.append(ax)
+                    y1.append(ay)
+                    x2.append(bx)
+                    y2.append(by)
+        self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
+        n = len(x1)
+        if not n:
+            raise ValueError("Polygon has no edges")
+
+        west, east = min(min(x1), min(x2)), max(max(x1), max(x2))
+        south, north = min(min(y1), min(y2)), max(max(y1), max(y2))
+        self.bbox = BBox(south, west, north, east)
+        self.cell = max(
+            math.sqrt((east - west) * (north - south) / n),
+            (east - west) / n,
+            (north - south) / n,
+            1e-9,
+        )
+        # The grid starts (by an irrational fraction of a cell) beyond the
+        # bounding box, so that its lines do not run along the polygon's edges
+        # (as they would along the bounding box, and as they might along
+        # round coordinates), where crossings cannot be counted
+        self._south = south - _OFFSET_SOUTH * self.cell
+        self._west = west - _OFFSET_WEST * self.cell
+        self.cols = math.ceil((east - self._west) / self.cell)
+        self.rows = math.ceil((north - self._south) / self.cell)
+
+        # Edges by the cells that they cross, within a whisker (so that none
+        # is missed to rounding)
+        self._cells: dict[int, list[int]] = {}
+        # The sorted longitudes at which edges cross each line of latitude
+        # between rows (counting an edge that ends on the line only if it
+        # lies above it, so that each crossing is counted once)
+        self._lines: list[list[float]] = [[] for _ in range(self.rows + 1)]
+        for k in range(n):
+            self._index(k)
+        for xs in self._lines:
+            xs.sort()
+
+    def _index(self, k: int):
+        ax, ay, bx, by = self.x1[k], self.y1[k], self.x2[k], self.y2[k]
+        south, west, cell = self._south, self._west, self.cell
+        eps = cell * 1e-9
+        ymin, ymax = (ay, by) if ay < by else (by, ay)
+        i0 = max(0, math.floor((ymin - eps - south) / cell))
+        i1 = min(self.rows - 1, math.floor((ymax + eps - south) / cell))
+        for i in range(i0, i1 + 1):
+            # The part of the edge within the row (most edges are shorter
+            # than a cell, so lie within one row)
+            if i0 == i1 or ay == by:
+                xa, xb = ax, bx
+            else:
+                lo, hi = max(ymin, self._y(i)), min(ymax, self._y(i + 1))
+                xa = ax + (lo - ay) * (bx - ax) / (by - ay)
+                xb = ax + (hi - ay) * (bx - ax) / (by - ay)
+            xmin, xmax = (xa, xb) if xa < xb else (xb, xa)
+            j0 = max(0, math.floor((xmin - eps - west) / cell))
+            j1 = min(self.cols - 1, math.floor((xmax + eps - west) / cell))
+            row = i * self.cols
+            for j in range(j0, j1 + 1):
+                self._cells.setdefault(row + j, []).append(k)
+
+        for i in range(i0, i1 + 2):
+            y = self._y(i)
+            if (ay > y) != (by > y):
+                self._lines[i].append(ax + (y - ay) * (bx - ax) / (by - ay))
+
+    def _y(self, i: int) -> float:
+        return self._south + i * self.cell
+
+    def _x(self, j: int) -> float:
+        return self._west + j * self.cell
+
+    def _cell(self, x: float, y: float) -> tuple[int, int]:
+        i = math.floor((y - self._south) / self.cell)
+        j = math.floor((x - self._west) / self.cell)
+        return min(max(i, 0), self.rows - 1), min(max(j, 0), self.cols - 1)
+
+    def __contains__(self, point: tuple[float, float]) -> bool:
+        # A (lat, lon) point, as elsewhere
+        y, x = point
+        south, west, north, east = self.bbox
+        if not (south <= y <= north and west <= x <= east):
+            return False
+
+        i, j = self._cell(x, y)
+        cx, cy = self._x(j), self._y(i)
+        # Crossings of a ray from the cell's corner to the west...
+        inside = bisect_left(self._lines[i], cx) % 2 == 1
+        # ...and of the path from the corner, north to the point's latitude,
+        # then east to the point.  As for the lines of the grid, an edge that
+        # ends at the point's latitude is only counted going east if it lies
+        # above it, as if the path ran just above, so the path going north
+        # must cross edges that lie along that latitude (and others that
+        # reach it at the corner of the path, which the path east does not)
+        x1, y1, x2, y2 = self.x1, self.y1, self.x2, self.y2
+        for k in self._cells.get(i * self.cols + j, ()):
+            ax, ay, bx, by = x1[k], y1[k], x2[k], y2[k]
+            if (ax > cx) != (bx > cx) and (
+                cy <= ay + (cx - ax) * (by - ay) / (bx - ax) <= y
+            ):
+                inside = not inside
+            if (ay > y) != (by > y) and (
+                cx < ax + (y - ay) * (bx - ax) / (by - ay) < x
+            ):
+                inside = not inside
+        return inside
+
+    @classmethod
+    def from_geojson(cls, geometry: dict[str, Any]) -> "Polygon":
+        """
+        Prepare a GeoJSON Polygon or MultiPolygon geometry.
+        """
+        match geometry:
+            case {"type": "Polygon", "coordinates": rings}:
+                return cls(rings)
+            case {"type": "MultiPolygon", "coordinates": polygons}:
+                return cls(r for rings in polygons for r in rings)
+        raise ValueError(f"Not a polygon: {geometry.get('type')}")
+
+
+class RegionIndex:
+    """
+    An index of named regions (e.g., regional councils, territorial
+    authorities, or census areas), for finding the region containing each of
+    many points.
+
+    Regions are found by their bounding boxes, from a grid of cells of `cell`
+    degrees, each listing the regions whose bounding boxes overlap it, before
+    the (prepared) polygons of the few candidates are tested (see `Polygon`).
+    Where regions overlap, a point is in the first given.
+    """
+
+    def __init__(
+        self, regions: Iterable[tuple[str, Polygon]], cell: float = 0.5
+    ):
+        self.names: list[str] = []
+        self.polygons: list[Polygon] = []
+        self.cell = cell
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        for name, polygon in regions:
+            r = len(self.names)
+            self.names.append(name)
+            self.polygons.append(polygon)
+
+            south, west, north, east = polygon.bbox
+            i0, j0 = self._cell(south, west)
+            i1, j1 = self._cell(north, east)
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    self._cells.setdefault((i, j), []).append(r)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
+
+    def locate(self, lat: float, lon: float) -> str | None:
+        """
+        Return the name of the region containing a point, if any.
+        """
+        if math.isnan(lat) or math.isnan(lon):
+            return None
+
+        for r in self._cells.get(self._cell(lat, lon), ()):
+            if (lat, lon) in self.polygons[r]:
+                return self.names[r]
+        return None
+
+    def assign(
+        self, lats: Sequence[float], lons: Sequence[float]
+    ) -> Categorical:
+        """
+        Return the region containing each point (e.g., of the columns of a
+        `PlaceTable`), as a column to count places by (see `Counts.update`).
+        Points with unknown (NaN) coordinates, or in no region, have none.
+        """
+        if len(lats) != len(lons):
+            raise ValueError("Must have as many latitudes as longitudes")
+
+        # Codes follow the order of the regions, whatever order they are found
+        out = Categorical(categories=list(dict.fromkeys(self.names)))
+        codes = [out.code(name) for name in self.names]
+        cells, polygons = self._cells, self.polygons
+        for lat, lon in zip(lats, lons, strict=True):
+            c = -1
+            if not (math.isnan(lat) or math.isnan(lon)):
+                for r in cells.get(self._cell(lat, lon), ()):
+                    if (lat, lon) in polygons[r]:
+                        c = codes[r]
+                        break
+            out.codes.append(c)
+        return out
+
+
+def _name_key(properties: dict[str, Any]) -> str:
+    # The property that names a region: "name", or otherwise one ending in
+    # "_NAME", as in Stats NZ's boundaries (e.g., "REGC2023_V1_00_NAME"):
+    #   <datafinder.stats.govt.nz>
+    if "name" in properties:
+        return "name"
+    for key in properties:
+        if key.upper().endswith("_NAME"):
+            return key
+    raise ValueError(f"No name among properties: {', '.join(properties)}")
+
+
+def _features(
+    data: dict[str, Any], name: str | None
+) -> Iterator[tuple[str, Polygon]]:
+    for f in data["features"]:
+        if f.get("geometry") is None:
+            continue
+        props = f.get("properties") or {}
+        key = name or _name_key(props)
+        if key not in props:
+            raise ValueError(f"Feature {f.get('id')} has no {key}")
+        yield str(props[key]), Polygon.from_geojson(f["geometry"])
+
+
+def load_regions(
+    path: Path, name: str | None = None, cell: float = 0.5
+) -> RegionIndex:
+    """
+    Load the regions of a GeoJSON FeatureCollection of polygons (in WGS 84, as
+    GeoJSON always is) into an index, each named by its property `name` (by
+    default, "name", or any ending "_NAME").
+    """
+    with open(path, "rb") as f:
+        data = json.load(f)
+    if data.get("type") != "FeatureCollection":
+        raise ValueError(f"Not a GeoJSON FeatureCollection: {path}")
+    return RegionIndex(_features(data, name), cell)
@@ -0,0 +1,138 @@
+import math
+from collections.abc import Iterator, Sequence
+
+from powdb.common.geo import EARTH_RADIUS, METRES_PER_DEGREE, haversine
+
+# Furthest that any two points can be apart, in metres
+_MAX_DISTANCE = math.pi * EARTH_RADIUS
+
+
+class GridIndex:
+    """
+    A spatial index of points on a regular grid of latitude and longitude.
+
+    Each point is kept in the bucket of the grid cell containing it, so that
+    finding points near some location only requires checking the few cells
+    around it, rather than every point.  Cells are `cell` metres high (and
+    as many degrees wide as they are high), so queries are cheapest when the
+    cell size is near the typical radius queried.
+
+    Points are identified by their position in the `lats` and `lons` given
+    (e.g., the columns of a `PlaceTable`); those with unknown (NaN)
+    coordinates are not indexed.  Longitude wraps around the antimeridian.
+    """
+
+    def __init__(
+        self,
+        lats: Sequence[float],
+        lons: Sequence[float],
+        cell: float = 250.0,
+    ):
+        if len(lats) != len(lons):
+            raise ValueError("Must have as many latitudes as longitudes")
+
+        self.lats, self.lons = lats, lons
+        self.cell = cell / METRES_PER_DEGREE
+        self._ncols = math.ceil(360 / self.cell)
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        self._n = 0
+
+        for i, (lat, lon) in enumerate(zip(lats, lons, strict=True)):
+            if math.isnan(lat) or math.isnan(lon):
+                continue
+
+            self._cells.setdefault(self._key(lat, lon), []).append(i)
+            self._n += 1
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _key(self, lat: float, lon: float) -> tuple[int, int]:
+        return (
+            math.floor((lat + 90) / self.cell),
+            math.floor((lon + 180) / self.cell) % self._ncols,
+        )
+
+    def _candidates(
+        self, lat: float, lon: float, radius: float
+    ) -> Iterator[int]:
+        # Cells overlapping the bounding box of the circle of `radius` around
+        # the point.  A degree of longitude shrinks towards the poles, so
+        # the box is wider (in degrees) at higher latitudes
+        dlat = radius / METRES_PER_DEGREE
+        coslat = math.cos(math.radians(min(89.0, abs(lat) + dlat)))
+        dlon = min(180.0, dlat / max(coslat, 1e-9))
+
+        i0 = math.floor((lat - dlat + 90) / self.cell)
+        i1 = math.floor((lat + dlat + 90) / self.cell)
+        j0 = math.floor((lon - dlon + 180) / self.cell)
+        j1 = math.floor((lon + dlon + 180) / self.cell)
+
+        # Don't visit any column twice if the box wraps the whole way around
+        cols = range(j0, j1 + 1)
+        if len(cols) >= self._ncols:
+            cols = range(self._ncols)
+
+        for i in range(i0, i1 + 1):
+            for j in cols:
+                yield from self._cells.get((i, j % self._ncols), ())
+
+    def within(
+        self, lat: float, lon: float, radius: float
+    ) -> list[tuple[float, int]]:
+        """
+        Return the (distance, index) of every point within `radius` metres of
+        the given location, nearest first.
+        """
+        out = []
+        for k in self._candidates(lat, lon, radius):
+            d = haversine(lat, lon, self.lats[k], self.lons[k])
+            if d <= radius:
+                out.append((d, k))
+
+        out.sort()
+        return out
+
+    def nearest(
+        self, lat: float, lon: float, k: int = 1
+    ) -> list[tuple[float, int]]:
+        """
+        Return the (distance, index) of the `k` nearest points to the given
+        location, nearest first.
+        """
+        if k < 1 or not self._n:
+            return []
+
+        # Search ever larger circles until one holds at least k points; the k
+        # nearest within it are then the k nearest overall
+        radius = self.cell * METRES_PER_DEGREE
+        while True:
+            found = self.within(lat, lon, radius)
+            if len(found) >= min(k, self._n) or radius >= _MAX_DISTANCE:
+                return found[:k]
+            radius *= 2
+
+
+def candidate_pairs(
+    left: tuple[Sequence[float], Sequence[float]],
+    right: tuple[Sequence[float], Sequence[float]] | GridIndex,
+    radius: float = 250.0,
+) -> Iterator[tuple[int, int, float]]:
+    """
+    Propose candidate matches between two sets of points (e.g., places from two
+    sources), as the (left index, right index, distance) of every pair of
+    points that are within `radius` metres of one another.
+
+    Each set is given as a pair of sequences of latitudes and longitudes; the
+    right-hand set is indexed (unless it already is), and each left-hand point
+    is looked up in it.
+    """
+    if not isinstance(right, GridIndex):
+        right = GridIndex(*right, cell=radius)
+
+    for i, (lat, lon) in enumerate(zip(*left, strict=True)):
+        if math.isnan(lat) or math.isnan(lon):
+            continue
+
+        for d, j in right.within(lat, lon, radius):
+            yield i, j, d
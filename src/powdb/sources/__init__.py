@@ -0,0 +1,28 @@
+from typing import TYPE_CHECKING
+
+from powdb.common.lazy import LazyMapping, lazy
+
+if TYPE_CHECKING:
+    from powdb.sources.base import Source
+
+# Registry of all sources, by name.  Each source is only imported when it is
+# looked up, so that running one does not pay to import the others
+SOURCES: LazyMapping[type["Source"]] = LazyMapping(
+    {
+        "osm": "powdb.sources.osm:OSM",
+        "dbpedia": "powdb.sources.dbpedia:DBpedia",
+    }
+)
+
+__getattr__, __dir__ = lazy(
+    __name__,
+    {
+        "Source": ".base",
+        "load_watermarks": ".base",
+        "save_watermarks": ".base",
+        "DBpedia": ".dbpedia",
+        "OSM": ".osm",
+        "Outcome": ".runner",
+        "run_sources": ".runner",
+    },
+)
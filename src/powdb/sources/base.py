@@ -0,0 +1,53 @@
+import json
+import os
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Protocol, runtime_checkable
+
+from powdb.common.record import Place
+
+# Where watermarks from the last successful harvest of each source are kept,
+# following the convention of persisting generated data under `data/`
+DEFAULT_WATERMARKS = Path(
+    os.environ.get("POWDB_WATERMARKS", "data/watermarks.json")
+)
+
+
+@runtime_checkable
+class Source(Protocol):
+    """
+    The interface shared by all sources of places of worship.
+
+    `fetch` yields the places known to the source.  If `since` is given (as
+    the `watermark` of a previous fetch), a source may yield only those places
+    that changed after it; sources that cannot do so yield everything.
+
+    Once `fetch` has been consumed, `watermark` describes the state of the
+    source at the time (e.g., the timestamp of the OSM data), to be passed as
+    `since` to the next fetch.  It is None if the source has no such notion.
+    """
+
+    name: str
+    watermark: str | None
+
+    def fetch(self, since: str | None = None) -> Iterator[Place]: ...
+
+
+def load_watermarks(path: Path = DEFAULT_WATERMARKS) -> dict[str, str]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(
+    watermarks: dict[str, str], path: Path = DEFAULT_WATERMARKS
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write atomically, so that an interrupted run can't lose the watermarks
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(watermarks, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
@@ -1,51 +1,100 @@
+import contextvars
+import csv
+import json
+import os
+import re
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from enum import StrEnum
+from functools import partial
+from itertools import chain, groupby, starmap
+from typing import Any
 from urllib.parse import urlencode
+from xml.etree import ElementTree
 
-import requests
+from powdb.common.cache import CACHE, TTL, Cache
+from powdb.common.jsonstream import JSONArrayStream
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.common.schema import decode_literal, infer_schema, sparql_fields
+from powdb.common.transport import TRANSPORT, Transport
+
+# The public SPARQL endpoint, unless pointed elsewhere (e.g., at a local
+# `common.replay` server for testing)
+DBPEDIA_URI = os.environ.get("POWDB_DBPEDIA_URI", "https://dbpedia.org/sparql")
+
+# Size of chunks read from the HTTP body
+_CHUNK_SIZE = 64 * 1024
+
+# Number of rows from which to infer the record type of a query's rows
+_SAMPLE_SIZE = 1000
+
+
+# https://dbpedia.org/ontology/placeOfWorship
+# TODO: https://sparqlwrapper.readthedocs.io/en/latest/main.html
+CHURCH_QUERY = """
+    PREFIX dbo: <http://dbpedia.org/ontology/>
+    PREFIX dbp: <http://dbpedia.org/property/>
+    PREFIX dbr: <http://dbpedia.org/resource/>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX geo: <http://www.w3.org/2003/01/geo/wgs84_pos#>
+    SELECT ?building ?label ?country ?location ?locationCountry ?address
+           ?lat ?long ?denomination
+    WHERE {
+      ?building a dbo:ReligiousBuilding .
+      OPTIONAL { ?building rdfs:label ?label }
+      OPTIONAL { ?building geo:lat ?lat ; geo:long ?long }
+      OPTIONAL { ?building dbo:denomination ?denomination }
+      OPTIONAL { ?building dbo:country ?country }
+      OPTIONAL {
+        ?building dbo:location ?location .
+        OPTIONAL { ?location dbo:country ?locationCountry }
+      }
+      OPTIONAL { ?building dbo:address ?address }
+    }
+    # LIMIT 1
+"""
+
+
+class DBpediaError(RuntimeError):
+    pass
+
+
+class LossyResultsError(DBpediaError):
+    pass
 
 
 def get_church_data():
-    # https://dbpedia.org/ontology/placeOfWorship
-    # TODO: https://sparqlwrapper.readthedocs.io/en/latest/main.html
-    query = """
-        PREFIX dbo: <http://dbpedia.org/ontology/>
-        PREFIX dbp: <http://dbpedia.org/property/>
-        PREFIX dbr: <http://dbpedia.org/resource/>
-        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-        SELECT ?building ?label ?country ?location ?locationCountry ?address
-        WHERE {
-          ?building a dbo:ReligiousBuilding .
-          OPTIONAL { ?building rdfs:label ?label }
-          OPTIONAL { ?building dbo:country ?country }
-          OPTIONAL {
-            ?building dbo:location ?location .
-            OPTIONAL { ?location dbo:country ?locationCountry }
-          }
-          OPTIONAL { ?building dbo:address ?address }
-        }
-        # LIMIT 1
-    """
-
-    results = query_dbpedia(query)
-    print(f"Received {len(str(results))} bytes from DBpedia")
-    print(results)
-    return results
+    n = 0
+    for _ in query_pages(CHURCH_QUERY, order_by="?building"):
+        n += 1
+
+    print(f"Received {n} rows from DBpedia")
 
 
 class MIMEType(StrEnum):
     HTML = "text/html"
     JSON = "application/json"
+    # Compact result formats, which can be decoded as they arrive:
+    #   <www.w3.org/TR/sparql11-results-csv-tsv>
+    #   <www.w3.org/TR/rdf-sparql-XMLres>
+    TSV = "text/tab-separated-values"
+    CSV = "text/csv"
+    XML = "application/sparql-results+xml"
 
 
-def build_dbpedia_query(query: str, out_type: MIMEType) -> str:
+def build_dbpedia_query(
+    query: str, out_type: MIMEType, timeout: int = 30000
+) -> str:
     trimmed_query = "\n".join(line.strip() for line in query.splitlines())
-    base_uri = "https://dbpedia.org/sparql"
+    base_uri = DBPEDIA_URI
     params = {
         "default-graph-uri": "http://dbpedia.org",
         # "query": strings.ReplaceAll(query, "\n", " "),
         "query": trimmed_query,
         "format": str(out_type),
-        "timeout": "30000",
+        "timeout": str(timeout),
         "signal_void": "on",
         "signal_unconnected": "on",
     }
@@ -53,12 +102,526 @@ def build_dbpedia_query(query: str, out_type: MIMEType) -> str:
     return f"{base_uri}?{urlencode(params, doseq=True)}"
 
 
-def query_dbpedia(query: str) -> str:
+def query_dbpedia(
+    query: str,
+    timeout: int = 30000,
+    cache: Cache = CACHE,
+    transport: Transport = TRANSPORT,
+) -> dict[str, Any]:
     # TODO: MIMETextHTML is not yet supported
-    uri = build_dbpedia_query(query, MIMEType.JSON)
-    resp = requests.get(uri)
-    resp.raise_for_status()
-    return resp.json()
+    uri = build_dbpedia_query(query, MIMEType.JSON, timeout)
+    fetch = partial(_get, uri, transport)
+    with cache.stream(uri, query, fetch, TTL["dbpedia"]) as chunks:
+        return json.loads(b"".join(chunks))
+
+
+def query_rows(
+    query: str,
+    out_type: MIMEType = MIMEType.JSON,
+    timeout: int = 30000,
+    cache: Cache = CACHE,
+    transport: Transport = TRANSPORT,
+) -> Iterator[tuple]:
+    """
+    Yield the results of a SELECT query: first the names of its variables (as
+    a header), then a flat tuple for each row, of the value of each variable
+    followed by the language of each (see `decode_tsv`).  Results are decoded
+    as they arrive, without holding the whole response.
+
+    NOTE: Virtuoso (which DBpedia runs) writes TSV with every value quoted,
+    losing the languages and datatypes of literals, so TSV results of that
+    form are requested again as JSON.
+    """
+    if out_type == MIMEType.TSV:
+        decode = partial(decode_tsv, quoted=False)
+    elif (decode := _DECODERS.get(out_type)) is None:
+        raise ValueError(f"Cannot decode results as {out_type}")
+
+    uri = build_dbpedia_query(query, out_type, timeout)
+    fetch = partial(_get, uri, transport)
+    try:
+        with cache.stream(uri, query, fetch, TTL["dbpedia"]) as chunks:
+            yield from decode(chunks)
+    except LossyResultsError:
+        # Raised by the header, before any row is yielded
+        yield from query_rows(query, MIMEType.JSON, timeout, cache, transport)
+
+
+def _get(uri: str, transport: Transport) -> Iterator[bytes]:
+    with transport.open("GET", uri) as resp:
+        # Virtuoso returns partial results, with a successful status code, when
+        # a query hits its timeout; we must not mistake these for the complete
+        # result (nor cache them):
+        #   <docs.openlinksw.com/virtuoso/anytimequeries>
+        if state := resp.headers.get("X-SQL-State"):
+            msg = resp.headers.get("X-SQL-Message", "")
+            raise DBpediaError(f"Incomplete results ({state}): {msg}")
+
+        chunks = resp.iter_content(chunk_size=_CHUNK_SIZE)
+        yield from METRICS.timed(chunks, "transfer", size=len)
+
+
+def _lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    # Lines of text, as the chunks they span arrive (splitting UTF-8 on a
+    # newline never splits a character)
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode()
+    if rest:
+        yield rest.decode()
+
+
+# Escape sequences in literals (as of Turtle) in TSV results:
+#   <www.w3.org/TR/turtle/#sec-escapes>
+_ESCAPE = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))")
+_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f"}
+
+
+def _unescape(m: re.Match) -> str:
+    if (c := m[3]) is not None:
+        return _ESCAPES.get(c, c)
+    return chr(int(m[1] or m[2], 16))
+
+
+def _tsv_term(s: str) -> tuple[Any, str | None]:
+    # The value and language of an RDF term, as written in TSV results
+    if not s:
+        return None, None
+
+    c = s[0]
+    if c == "<":
+        return s[1:-1], None
+    if c == '"':
+        end = s.rindex('"')
+        v = s[1:end]
+        if "\\" in v:
+            v = _ESCAPE.sub(_unescape, v)
+        if end == len(s) - 1:
+            return v, None
+        if s[end + 1] == "@":
+            return v, s[end + 2 :]
+        # A typed literal: "<value>"^^<datatype>
+        return decode_literal(v, s[end + 4 : -1]), None
+    if c == "_":
+        return s, None
+
+    # Numbers and booleans may be written bare, as in Turtle
+    if s in ("true", "false"):
+        return s == "true", None
+    for t in (int, float):
+        try:
+            return t(s), None
+        except ValueError:
+            pass
+    return s, None
+
+
+def decode_tsv(chunks: Iterable[bytes], quoted: bool = True) -> Iterator[tuple]:
+    """
+    Decode SPARQL results in TSV, as the chunks of the response arrive:
+      <www.w3.org/TR/sparql11-results-csv-tsv/#tsv>
+
+    The first tuple is of the names of the variables.  Every other is a row,
+    of the value of each variable (or None if it is unbound) followed by the
+    language of each (or None), matching the fields of `row_type`.  Typed
+    literals are decoded (see `decode_literal`).
+
+    NOTE: TSV keeps the language and datatype of every literal, whereas CSV
+    keeps only their values; some servers write every value as a quoted
+    string (as Virtuoso does, losing both), which is decoded as such, unless
+    not `quoted`, in which case `LossyResultsError` is raised (by the header,
+    which such servers quote too).
+    """
+    lines = _lines(chunks)
+    if (header := next(lines, None)) is None:
+        raise DBpediaError("Empty results")
+    if not quoted and header.startswith('"'):
+        raise LossyResultsError("TSV results have every value quoted")
+
+    variables = [
+        v.strip('"').lstrip("?") for v in header.rstrip("\r").split("\t")
+    ]
+    yield tuple(variables)
+
+    n = len(variables)
+    unbound = [None] * (2 * n)
+    for line in lines:
+        line = line.rstrip("\r")
+        if not line and n > 1:
+            continue
+        terms = line.split("\t")
+        if len(terms) != n:
+            raise DBpediaError(f"Expected {n} values in row: {line!r}")
+
+        # Most terms are unbound or IRIs, so are decoded here
+        row = unbound.copy()
+        for i, s in enumerate(terms):
+            if s:
+                if s[0] == "<":
+                    row[i] = s[1:-1]
+                else:
+                    row[i], row[n + i] = _tsv_term(s)
+        yield tuple(row)
+
+
+def decode_csv(chunks: Iterable[bytes]) -> Iterator[tuple]:
+    """
+    Decode SPARQL results in CSV, as the chunks of the response arrive (in
+    the form of `decode_tsv`):
+      <www.w3.org/TR/sparql11-results-csv-tsv/#csv>
+
+    NOTE: CSV keeps only the values of terms, as strings, so literals are not
+    decoded, their languages are lost, and an empty string is unbound.
+    """
+    # Values may span lines within quotes, so the reader needs their ends
+    reader = csv.reader(f"{line}\n" for line in _lines(chunks))
+    if (header := next(reader, None)) is None:
+        raise DBpediaError("Empty results")
+
+    yield tuple(header)
+    unbound = (None,) * len(header)
+    for row in reader:
+        if row:
+            yield tuple(v or None for v in row) + unbound
+
+
+_SPARQL = "{http://www.w3.org/2005/sparql-results#}"
+_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+
+def decode_xml(chunks: Iterable[bytes]) -> Iterator[tuple]:
+    """
+    Decode SPARQL results in XML, as the chunks of the response arrive (in
+    the form of `decode_tsv`):
+      <www.w3.org/TR/rdf-sparql-XMLres>
+
+    Each result is discarded once decoded, so memory does not grow with the
+    number of results.
+    """
+    parser = ElementTree.XMLPullParser(("start", "end"))
+    variables: list[str] = []
+    index: dict[str, int] = {}
+    results = None
+
+    def events() -> Iterator[tuple[str, ElementTree.Element]]:
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    for event, elem in events():
+        if event == "start":
+            # The head, and so all variables, comes before the results
+            if elem.tag == f"{_SPARQL}results":
+                results = elem
+                index = {v: i for i, v in enumerate(variables)}
+                yield tuple(variables)
+        elif elem.tag == f"{_SPARQL}variable":
+            variables.append(elem.get("name"))
+        elif elem.tag == f"{_SPARQL}result":
+            n = len(variables)
+            row: list[Any] = [None] * (2 * n)
+            for binding in elem:
+                i, term = index[binding.get("name")], binding[0]
+                if term.tag == f"{_SPARQL}literal":
+                    row[i] = decode_literal(
+                        term.text or "", term.get("datatype")
+                    )
+                    row[n + i] = term.get(_LANG)
+                else:
+                    row[i] = term.text
+            yield tuple(row)
+            results.clear()
+
+    if results is None:
+        yield tuple(variables)
+
+
+def decode_json(chunks: Iterable[bytes]) -> Iterator[tuple]:
+    """
+    Decode SPARQL results in JSON, as the chunks of the response arrive (in the
+    form of `decode_tsv`):
+      <www.w3.org/TR/sparql11-results-json>
+
+    Each binding is discarded once decoded, so memory does not grow with the
+    number of results.
+    """
+    stream = JSONArrayStream(chunks, ("results", "bindings"))
+    bindings = iter(stream)
+
+    # The head comes before the results (as Virtuoso writes them), but if it
+    # does not then bindings are held until the end, where it must be
+    held = []
+    for binding in bindings:
+        held.append(binding)
+        if "head" in stream.meta:
+            break
+
+    variables = stream.meta["head"]["vars"]
+    yield tuple(variables)
+
+    langs = [f"{v}_lang" for v in variables]
+    for binding in chain(held, bindings):
+        fields = sparql_fields(binding)
+        yield (*map(fields.get, variables), *map(fields.get, langs))
+
+
+_DECODERS: dict[MIMEType, Callable[[Iterable[bytes]], Iterator[tuple]]] = {
+    MIMEType.TSV: decode_tsv,
+    MIMEType.CSV: decode_csv,
+    MIMEType.XML: decode_xml,
+    MIMEType.JSON: decode_json,
+}
+
+
+# The variables that a SELECT query projects (or "*")
+_PROJECTION = re.compile(
+    r"\bSELECT\b(.*?)(?:\bWHERE\b|\{)", flags=re.IGNORECASE | re.DOTALL
+)
+
+
+def paginate_query(query: str, order_by: str, limit: int, offset: int) -> str:
+    """
+    Rewrite a SELECT query to return one page of `limit` rows from `offset`.
+
+    Paging is only stable if the rows are in a total order, but no one
+    variable need be unique to a row (e.g., a building has a row for each of
+    its labels), so rows are ordered by `order_by` and then by every other
+    variable that the query selects (unless it selects "*").  Virtuoso refuses
+    to sort more than a fixed number of rows for a page, so we must order the
+    rows in a sub-query and page over that:
+      <vos.openlinksw.com/owiki/wiki/VOS/VirtTipsAndTricksHowToHandleBandwidthLimitExceed>
+    """
+    # The prologue (e.g., PREFIX declarations) must remain at the start of
+    # the query, outside of the sub-query
+    m = re.search(r"\bSELECT\b", query, flags=re.IGNORECASE)
+    if m is None:
+        raise ValueError("Can only paginate SELECT queries")
+
+    prologue, select = query[: m.start()], query[m.start() :]
+    keys = order_by.split()
+    if p := _PROJECTION.match(select):
+        for v in re.findall(r"[?$](\w+)", p[1]):
+            if (k := f"?{v}") not in keys:
+                keys.append(k)
+
+    return (
+        f"{prologue.rstrip()}\n"
+        "SELECT * WHERE {\n"
+        f"{{ {select.rstrip()}\nORDER BY {' '.join(keys)}\n}}\n"
+        "}\n"
+        f"LIMIT {limit}\n"
+        f"OFFSET {offset}\n"
+    )
+
+
+def query_pages(
+    query: str,
+    order_by: str,
+    page_size: int = 10_000,
+    workers: int = 4,
+    timeout: int = 30000,
+) -> Iterator[Any]:
+    """
+    Yield the rows of a SELECT query, fetching it in pages of `page_size` rows
+    concurrently on a pool of `workers` threads.
+
+    `order_by` is one or more variables (e.g., "?building ?label"), which
+    rows are ordered by first (see `paginate_query`).  Rows are yielded as
+    each page completes, so they are not in order, but the rows of any one
+    value of the first (e.g., of a building) are yielded together, even if
+    they span pages (see `_Seams`).  As we don't know the
+    number of rows in advance, we keep `workers` pages in flight until one of
+    them comes back short.
+
+    Rows are decoded (see `query_rows`) into records of a compact, typed
+    layout with an attribute per variable (see `row_type`), rather than kept
+    as dicts of dicts.
+
+    NOTE: DBpedia returns at most 10,000 rows for any one query, so a larger
+    `page_size` would be mistaken for the last page.
+    """
+    # Rows are keyed by a variable, so they must be ordered by variables alone
+    # (e.g., not by "DESC(?label)"), which we check before fetching anything
+    keys = order_by.split()
+    if not keys or not all(re.fullmatch(r"[?$]\w+", k) for k in keys):
+        raise ValueError(f"Can only order pages by variables: {order_by!r}")
+    key = keys[0][1:]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: dict[Future, int] = {}
+        offset, last = 0, False
+        row = seams = None
+
+        def submit():
+            nonlocal offset
+            q = paginate_query(query, order_by, page_size, offset)
+            # Pages are fetched on behalf of the caller's source
+            ctx = contextvars.copy_context()
+            f = pool.submit(ctx.run, _fetch_page, q, timeout)
+            pending[f] = offset // page_size
+            offset += page_size
+
+        for _ in range(workers):
+            submit()
+
+        # Pages yet to be fetched are cancelled if we fail, or if the caller
+        # stops early (closing this generator), rather than fetched for nothing
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    page = pending.pop(f)
+                    variables, rows = f.result()
+
+                    if len(rows) < page_size:
+                        last = True
+                    elif not last:
+                        submit()
+
+                    if row is None:
+                        fields = _fields(variables)
+                        records = (
+                            dict(zip(fields, r, strict=True))
+                            for r in rows[:_SAMPLE_SIZE]
+                        )
+                        row = row_type(variables, records, key)
+                        seams = _Seams(variables.index(key))
+                    end = len(rows) < page_size
+                    yield from starmap(row, seams.add(page, rows, end))
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+# The key of a page with no rows
+_EMPTY = object()
+
+
+class _Seams:
+    """
+    Rows of consecutive pages (of rows ordered by the value at `key`), which
+    may arrive in any order, with the rows of each key kept together.
+
+    The rows of a key may continue from the end of one page to the start of
+    the next, so those at either end of each page are held back until the
+    pages either side of it have arrived.
+    """
+
+    def __init__(self, key: int):
+        self.key = key
+        # The key at one side of each seam (the start of page i being seam i)
+        # whose other side has yet to arrive
+        self.seams: dict[int, Any] = {}
+        # Rows held back by key, by page, and the number of seams each awaits
+        self.held: dict[Any, list[tuple[int, list[tuple]]]] = {}
+        self.waiting: Counter[Any] = Counter()
+
+    def add(self, page: int, rows: list[tuple], end: bool) -> Iterator[tuple]:
+        """
+        Yield the rows of `page` (the last if `end`) that can be, and any
+        held back that it releases.
+        """
+        first = rows[0][self.key] if rows else _EMPTY
+        last = rows[-1][self.key] if rows else _EMPTY
+        for seam, k in ((page, first), (page + 1, last)):
+            if seam == 0 or (seam > page and end):
+                continue
+            if seam in self.seams:
+                self.waiting[self.seams.pop(seam)] -= 1
+            else:
+                self.seams[seam] = k
+                self.waiting[k] += 1
+
+        for k, group in groupby(rows, key=lambda r: r[self.key]):
+            if k in (first, last) and (self.waiting[k] > 0 or k in self.held):
+                self.held.setdefault(k, []).append((page, list(group)))
+            else:
+                yield from group
+
+        for k in [k for k in self.held if self.waiting[k] <= 0]:
+            del self.waiting[k]
+            for _, group in sorted(self.held.pop(k), key=lambda p: p[0]):
+                yield from group
+
+
+def _fetch_page(query: str, timeout: int) -> tuple[list[str], list[tuple]]:
+    # Results list every variable, even those bound in no row:
+    #   <www.w3.org/TR/sparql11-results-json/#select-head>
+    with METRICS.stage("parse") as counts:
+        rows = query_rows(query, timeout=timeout)
+        variables = list(next(rows))
+        rows = list(rows)
+        counts["records"] = len(rows)
+    return variables, rows
+
+
+def _fields(variables: list[str]) -> list[str]:
+    # Fields of rows as decoded (see `decode_tsv`)
+    return [*variables, *(f"{v}_lang" for v in variables)]
+
+
+def row_type(
+    variables: list[str], rows: Iterable[dict[str, Any]], key: str | None
+) -> type:
+    """
+    Return the record type for rows of a query with the given variables, as
+    inferred from some (decoded) rows of it.
+
+    Every variable, and the language of each, has an attribute, as later rows
+    may bind those that these rows do not.
+    """
+    return infer_schema(rows, key, _fields(variables)).record_type("Row")
 
 
 # NOTE: sometimes we know roughtly the area but not specifically
+
+
+def _float(v: Any) -> float | None:
+    # Coordinates are typed literals, so are usually decoded already
+    try:
+        return None if v is None else float(v)
+    except ValueError:
+        return None
+
+
+def normalise(rows: Iterable[Any]) -> Iterator[Place]:
+    """
+    Normalise rows of `CHURCH_QUERY` (as from `query_pages`) into places.
+
+    A building has a row for every combination of its optional values (e.g.,
+    a label in each language), so consecutive rows for the same building (as
+    `query_pages` keeps them, even across pages) are collapsed into one place.
+    Its name is its English label, if it has one, and labels in each language
+    are kept in tags (as "name:<lang>").
+    """
+    p = None
+    for row in rows:
+        uri = row.building
+        if p is None or p.id != uri:
+            if p is not None:
+                yield p
+            p = Place(source="dbpedia", id=uri)
+
+        if (label := row.label) is not None:
+            lang = row.label_lang
+            p.tags.setdefault(f"name:{lang}" if lang else "name", label)
+            if p.name is None or lang == "en":
+                p.name = label
+
+        if p.lat is None:
+            p.lat, p.lon = _float(row.lat), _float(row.long)
+
+        if p.denomination is None:
+            p.denomination = row.denomination
+
+        for var in ("country", "location", "locationCountry", "address"):
+            if (v := getattr(row, var)) is not None:
+                p.tags.setdefault(var, v)
+
+    if p is not None:
+        yield p
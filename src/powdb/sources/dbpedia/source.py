@@ -0,0 +1,27 @@
+from collections.abc import Iterator
+
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.sources.dbpedia.remote import CHURCH_QUERY, normalise, query_pages
+
+
+class DBpedia:
+    """
+    Religious buildings from DBpedia, via its public SPARQL endpoint.
+
+    DBpedia is rebuilt in periodic releases, and does not record when each
+    resource changed, so it cannot be fetched incrementally: `since` is
+    ignored, and there is no watermark.
+
+    `options` are passed to `query_pages`.
+    """
+
+    name = "dbpedia"
+
+    def __init__(self, **options):
+        self.options = options
+        self.watermark: str | None = None
+
+    def fetch(self, since: str | None = None) -> Iterator[Place]:
+        rows = query_pages(CHURCH_QUERY, order_by="?building", **self.options)
+        yield from METRICS.timed(normalise(rows), "normalise")
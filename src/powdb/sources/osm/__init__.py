@@ -1 +1,14 @@
-from powdb.sources.osm.remote import get_church_data
+from powdb.common.lazy import lazy
+
+# The source is only imported when first used (see `lazy`), as it needs an
+# HTTP client
+__getattr__, __dir__ = lazy(
+    __name__,
+    {
+        "get_church_data": ".remote",
+        "OSM": ".source",
+        "enrich": ".history",
+        "harvest": ".tiles",
+        "read_pbf": ".pbf",
+    },
+)
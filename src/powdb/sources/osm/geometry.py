@@ -0,0 +1,106 @@
+from array import array
+from collections.abc import Iterable, Iterator
+from itertools import chain, repeat
+from math import fsum
+from typing import Any
+
+# The Overpass query returns each tagged way and relation with only the IDs of
+# its members, followed (after `>; out skel qt;`) by those members, so a way or
+# relation can only be located once every node has been read:
+#   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Recurse_down_(%3E)>
+#
+# Rather than building a dict per node, node coordinates are kept in flat
+# arrays (indexed by a single ID -> position dict), and the node references of
+# every way in one array, sliced by way.  Resolving references and computing
+# centroids and bounds are then bulk operations over these arrays
+
+
+def collapse(elements: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+    """
+    Collapse raw Overpass elements into one element per tagged node, way, or
+    relation, dropping the untagged (skeleton) elements that they reference.
+
+    Ways and relations are given a `center` (the mean of their distinct
+    nodes) and `bounds`, in the same form as Overpass' `out center bb`:
+      <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#out>
+
+    Tagged nodes are yielded as they arrive; ways and relations once every
+    element has been read.  A relation's location is that of its outer
+    members, if any (e.g., a multipolygon), or else of all its node and way
+    members; member relations are not followed.  References to nodes not
+    returned are ignored, and an element with none returned has no location.
+    """
+    node_ids, lats, lons = array("q"), array("d"), array("d")
+    refs = array("q")
+    ways: dict[int, tuple[int, int]] = {}
+    pending: list[dict[str, Any]] = []
+
+    for e in elements:
+        t = e["type"]
+        if t == "node":
+            if "lat" in e:
+                node_ids.append(e["id"])
+                lats.append(e["lat"])
+                lons.append(e["lon"])
+            if e.get("tags"):
+                yield e
+            continue
+
+        # A way may be returned both tagged and as a member of a relation
+        if t == "way" and e["id"] not in ways:
+            start = len(refs)
+            refs.extend(e.get("nodes", ()))
+            ways[e["id"]] = (start, len(refs))
+        if e.get("tags"):
+            pending.append(e)
+
+    # The position of each referenced node in the coordinate arrays, or -1 if
+    # it was not returned
+    index = dict(zip(node_ids, range(len(node_ids)), strict=True))
+    pos = array("q", map(index.get, refs, repeat(-1)))
+
+    def way_nodes(way: int) -> array:
+        start, end = ways.get(way, (0, 0))
+        return pos[start:end]
+
+    def member_nodes(m: dict[str, Any]) -> Iterable[int]:
+        if m["type"] == "way":
+            return way_nodes(m["ref"])
+        if m["type"] == "node":
+            return (index.get(m["ref"], -1),)
+        return ()
+
+    for e in pending:
+        if e["type"] == "way":
+            nodes = way_nodes(e["id"])
+        else:
+            members = e.get("members", ())
+            outer = [m for m in members if m.get("role") == "outer"]
+            nodes = array(
+                "q", chain.from_iterable(map(member_nodes, outer or members))
+            )
+
+        yield _locate(e, nodes, lats, lons)
+
+
+def _locate(
+    e: dict[str, Any], nodes: array, lats: array, lons: array
+) -> dict[str, Any]:
+    # Closed ways repeat their first node, and the ways of a relation share
+    # their ends, so each node is only counted once
+    nodes = list(dict.fromkeys(filter((-1).__ne__, nodes)))
+    if not nodes:
+        return e
+
+    ys = list(map(lats.__getitem__, nodes))
+    xs = list(map(lons.__getitem__, nodes))
+    return {
+        **e,
+        "center": {"lat": fsum(ys) / len(ys), "lon": fsum(xs) / len(xs)},
+        "bounds": {
+            "minlat": min(ys),
+            "minlon": min(xs),
+            "maxlat": max(ys),
+            "maxlon": max(xs),
+        },
+    }
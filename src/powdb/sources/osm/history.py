@@ -0,0 +1,391 @@
+import contextvars
+import json
+import os
+import sqlite3
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlencode
+
+import requests
+
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.common.transport import TRANSPORT, Transport
+from powdb.common.utils import partition
+
+# The public OSM API, unless pointed elsewhere (e.g., at a mirror):
+#   <wiki.openstreetmap.org/wiki/API_v0.6>
+OSM_API_URI = os.environ.get(
+    "POWDB_OSM_API_URI", "https://api.openstreetmap.org/api/0.6"
+)
+
+# Default location of the history cache, alongside the response cache
+DEFAULT_HISTORY = Path(os.environ.get("POWDB_HISTORY", "data/history.sqlite"))
+
+# The API answers these when any element of a multi-fetch was never created,
+# or any version asked for has been redacted, so the batch must be split to
+# find those that can be fetched
+_MISSING_STATUSES = frozenset({403, 404, 410})
+
+# The most changesets the API returns for any one query:
+#   <wiki.openstreetmap.org/wiki/API_v0.6#Query:_GET_/api/0.6/changesets>
+_MAX_CHANGESETS = 100
+
+type Key = tuple[str, int]
+
+
+@dataclass(slots=True)
+class Version:
+    """
+    One version of an OSM element: when it was made, in which changeset, and
+    by whom.
+    """
+
+    type: str
+    id: int
+    version: int
+    timestamp: str
+    changeset: int
+    user: str | None = None
+
+
+@dataclass(slots=True)
+class Changeset:
+    """
+    A (closed) OSM changeset: a group of edits by one user, with tags giving
+    (e.g.) the editor used and the source of the data:
+      <wiki.openstreetmap.org/wiki/Changeset>
+    """
+
+    id: int
+    created_at: str
+    closed_at: str | None = None
+    user: str | None = None
+    tags: dict[str, str] = field(default_factory=dict)
+
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS first_versions (
+        type TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        changeset INTEGER NOT NULL,
+        user TEXT,
+        PRIMARY KEY (type, id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS changesets (
+        id INTEGER PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        closed_at TEXT,
+        user TEXT,
+        tags TEXT NOT NULL
+    );
+"""
+
+# Bound parameters per lookup, well within SQLite's limit:
+#   <sqlite.org/limits.html#max_variable_number>
+_LOOKUP_SIZE = 500
+
+
+class HistoryStore:
+    """
+    A local cache, in SQLite, of the first versions of elements and the
+    changesets fetched from the OSM API.  Neither ever changes (once the
+    changeset is closed), so they are kept for good, and each is only ever
+    fetched once.
+    """
+
+    def __init__(self, path: Path = DEFAULT_HISTORY):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self) -> "HistoryStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def first_versions(self, keys: Iterable[Key]) -> dict[Key, Version]:
+        out = {}
+        for batch in partition(keys, _LOOKUP_SIZE):
+            rows = self._conn.execute(
+                "SELECT * FROM first_versions WHERE (type, id) IN "
+                f"(VALUES {', '.join(['(?, ?)'] * len(batch))})",
+                [x for k in batch for x in k],
+            )
+            for row in rows:
+                v = Version(*row)
+                out[v.type, v.id] = v
+        return out
+
+    def add_first_versions(self, versions: Iterable[Version]):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO first_versions "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (v.type, v.id, v.version, v.timestamp, v.changeset, v.user)
+                    for v in versions
+                ),
+            )
+
+    def changesets(self, ids: Iterable[int]) -> dict[int, Changeset]:
+        out = {}
+        for batch in partition(ids, _LOOKUP_SIZE):
+            rows = self._conn.execute(
+                "SELECT * FROM changesets "
+                f"WHERE id IN ({', '.join(['?'] * len(batch))})",
+                batch,
+            )
+            for id_, created_at, closed_at, user, tags in rows:
+                out[id_] = Changeset(
+                    id_, created_at, closed_at, user, json.loads(tags)
+                )
+        return out
+
+    def add_changesets(self, changesets: Iterable[Changeset]):
+        # Open changesets may yet change, so are not kept
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO changesets VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        c.id,
+                        c.created_at,
+                        c.closed_at,
+                        c.user,
+                        json.dumps(c.tags),
+                    )
+                    for c in changesets
+                    if c.closed_at is not None
+                ),
+            )
+
+
+def _get_json(uri: str, transport: Transport) -> dict[str, Any]:
+    return json.loads(b"".join(transport.stream("GET", uri)))
+
+
+def _version(e: dict[str, Any]) -> Version:
+    return Version(
+        e["type"],
+        e["id"],
+        e["version"],
+        e["timestamp"],
+        e["changeset"],
+        e.get("user"),
+    )
+
+
+def _fetch_first_versions(
+    keys: tuple[Key, ...], transport: Transport
+) -> list[Version]:
+    # Multi-fetch the first version of every element (all of one type), as
+    # "<id>v1" (see `_MISSING_STATUSES`)
+    t = keys[0][0]
+    ids = ",".join(f"{id_}v1" for _, id_ in keys)
+    uri = f"{OSM_API_URI}/{t}s.json?{urlencode({f'{t}s': ids})}"
+    try:
+        data = _get_json(uri, transport)
+    except requests.HTTPError as e:
+        if (
+            e.response is None
+            or e.response.status_code not in _MISSING_STATUSES
+        ):
+            raise
+        if len(keys) == 1:
+            return _fetch_history(keys[0], transport)
+
+        mid = len(keys) // 2
+        return _fetch_first_versions(
+            keys[:mid], transport
+        ) + _fetch_first_versions(keys[mid:], transport)
+
+    with METRICS.stage("parse") as counts:
+        versions = [_version(e) for e in data["elements"]]
+        counts["records"] = len(versions)
+    return versions
+
+
+def _fetch_history(key: Key, transport: Transport) -> list[Version]:
+    # The earliest version of an element whose first version is redacted
+    # (and so omitted from its history), if it was ever created
+    t, id_ = key
+    try:
+        data = _get_json(f"{OSM_API_URI}/{t}/{id_}/history.json", transport)
+    except requests.HTTPError as e:
+        if (
+            e.response is None
+            or e.response.status_code not in _MISSING_STATUSES
+        ):
+            raise
+        return []
+
+    versions = [_version(e) for e in data["elements"] if "timestamp" in e]
+    return [min(versions, key=lambda v: v.version)] if versions else []
+
+
+def _fetch_changesets(
+    ids: tuple[int, ...], transport: Transport
+) -> list[Changeset]:
+    # Query many changesets at once, by ID
+    q = urlencode({"changesets": ",".join(map(str, ids))})
+    data = _get_json(f"{OSM_API_URI}/changesets.json?{q}", transport)
+    with METRICS.stage("parse") as counts:
+        changesets = [
+            Changeset(
+                c["id"],
+                c["created_at"],
+                c.get("closed_at"),
+                c.get("user"),
+                c.get("tags", {}),
+            )
+            for c in data["changesets"]
+        ]
+        counts["records"] = len(changesets)
+    return changesets
+
+
+def _fetch_all[T, R](
+    batches: Iterable[T], fetch: Callable[[T], list[R]], workers: int
+) -> Iterator[R]:
+    # Fetch batches concurrently (as limited by the transport), on behalf of
+    # the caller's source, yielding results as each batch completes
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, fetch, b)
+            for b in batches
+        ]
+        try:
+            for f in as_completed(futures):
+                yield from f.result()
+        finally:
+            for f in futures:
+                f.cancel()
+
+
+def first_versions(
+    keys: Iterable[Key],
+    store: HistoryStore,
+    transport: Transport = TRANSPORT,
+    batch_size: int = 200,
+    workers: int = 4,
+) -> dict[Key, Version]:
+    """
+    Return the first version of each element, by type and ID, fetching those
+    not in `store` in batches of `batch_size` on `workers` threads.
+
+    Elements that never existed are left out.  If an element's first version
+    has been redacted, its earliest visible version is given instead.
+
+    NOTE: the IDs of a batch are given in its URL, which servers limit in
+    length (to about 8 KiB), so batches should not be much larger.
+    """
+    keys = set(keys)
+    out = store.first_versions(keys)
+
+    # Multi-fetches are of one type of element
+    missing = sorted(keys - out.keys())
+    batches = [
+        batch
+        for _, group in groupby(missing, key=itemgetter(0))
+        for batch in partition(group, batch_size)
+    ]
+    fetch = partial(_fetch_first_versions, transport=transport)
+    fetched = list(_fetch_all(batches, fetch, workers))
+
+    store.add_first_versions(fetched)
+    out.update(((v.type, v.id), v) for v in fetched)
+    return out
+
+
+def changesets(
+    ids: Iterable[int],
+    store: HistoryStore,
+    transport: Transport = TRANSPORT,
+    batch_size: int = 100,
+    workers: int = 4,
+) -> dict[int, Changeset]:
+    """
+    Return each changeset by ID (once, however often it is given), fetching
+    those not in `store` in batches of `batch_size` on `workers` threads.
+
+    NOTE: the API returns at most 100 changesets for any one query, so larger
+    batches are limited to that.
+    """
+    ids = set(ids)
+    out = store.changesets(ids)
+
+    batch_size = min(batch_size, _MAX_CHANGESETS)
+    batches = list(partition(sorted(ids - out.keys()), batch_size))
+    fetch = partial(_fetch_changesets, transport=transport)
+    fetched = list(_fetch_all(batches, fetch, workers))
+
+    store.add_changesets(fetched)
+    out.update((c.id, c) for c in fetched)
+    return out
+
+
+def _key(p: Place) -> Key:
+    t, _, id_ = p.id.partition("/")
+    return t, int(id_)
+
+
+def enrich(
+    places: Iterable[Place],
+    store: HistoryStore | None = None,
+    chunk_size: int = 10_000,
+    **options,
+) -> Iterator[Place]:
+    """
+    Add when each OSM place was first seen and last modified to its tags (as
+    "first_seen" and "last_modified"), with the source of its data as given
+    by the changeset that created it (as "first_seen:source"), if any.
+
+    Places are enriched in chunks of `chunk_size` at a time, so each first
+    version and changeset is fetched in as few requests as possible (see
+    `first_versions` and `changesets`, to which `options` are passed); a
+    changeset is only looked up once however many places it created.  The
+    history is cached in `store` (by default, at `DEFAULT_HISTORY`), so only
+    new places need be fetched by the next run.
+
+    A place is last modified with its current version, which Overpass gives
+    already (see `church_query`), so only first versions need be fetched.
+    Places that are not from OSM are passed through as they are.
+    """
+    with nullcontext(store) if store is not None else HistoryStore() as store:
+        for chunk in partition(places, chunk_size):
+            keys = [_key(p) for p in chunk if p.source == "osm"]
+            firsts = first_versions(keys, store, **options)
+            sets = changesets(
+                (v.changeset for v in firsts.values()), store, **options
+            )
+
+            for p in chunk:
+                if p.source != "osm":
+                    continue
+                if p.timestamp is not None:
+                    p.tags["last_modified"] = p.timestamp
+                if (v := firsts.get(_key(p))) is None:
+                    continue
+
+                p.tags["first_seen"] = v.timestamp
+                c = sets.get(v.changeset)
+                if c is not None and (source := c.tags.get("source")):
+                    p.tags["first_seen:source"] = source
+
+            yield from chunk
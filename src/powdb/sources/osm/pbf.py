@@ -0,0 +1,554 @@
+import lzma
+import multiprocessing
+import os
+import zlib
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from datetime import UTC, datetime
+from functools import partial
+from itertools import accumulate
+from pathlib import Path
+from typing import Any
+
+from powdb.sources.osm.tags import PLACE_TAGS
+
+# Reading an OSM extract (e.g., of a country, from download.geofabrik.de) in
+# the PBF format:
+#   <wiki.openstreetmap.org/wiki/PBF_Format>
+#
+# A file is a sequence of blobs, each of which (after the header) is a block
+# of a few thousand elements, compressed independently, so blocks can be
+# decoded in parallel on a pool of processes.  Each is a Protocol Buffers
+# message, which we decode by hand (as only a few fields are needed):
+#   <protobuf.dev/programming-guides/encoding>
+#
+# Elements of interest are found by their tags in a first pass over every
+# block, without decoding any others in full.  As in Overpass' response (see
+# `remote.church_query`), ways and relations are located by the nodes that
+# they reference, which may be in any block, so the ways referenced by
+# relations, and then the nodes referenced by every way, are found in later
+# passes over only those blocks that hold ways or nodes.  The elements are
+# given in the same form as Overpass', so they are normalised the same way
+# (see `remote.normalise`)
+
+_MEMBER_TYPES = ("node", "way", "relation")
+
+# Features that a file may require of its reader (of those that are defined,
+# we cannot read history or "LocationsOnWays")
+_FEATURES = frozenset({"OsmSchema-V0.6", "DenseNodes"})
+
+
+class PBFError(RuntimeError):
+    pass
+
+
+# Protocol Buffers wire format
+
+
+def _varint(buf: bytes, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _fields(buf: bytes) -> Iterator[tuple[int, int | bytes]]:
+    # The number and value of each field of a message, as an int (for varints)
+    # or bytes (for length-delimited fields); PBF uses no others
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            n, pos = _varint(buf, pos)
+            value, pos = buf[pos : pos + n], pos + n
+        else:
+            raise PBFError(f"Unexpected wire type {wire}")
+        yield key >> 3, value
+
+
+def _packed(buf: bytes) -> list[int]:
+    # Most values of packed fields fit in a byte each (e.g., deltas of IDs)
+    if buf.isascii():
+        return list(buf)
+
+    out = []
+    append = out.append
+    n = shift = 0
+    for b in buf:
+        if b < 0x80:
+            append(n | (b << shift))
+            n = shift = 0
+        else:
+            n |= (b & 0x7F) << shift
+            shift += 7
+    return out
+
+
+def _zigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def _signed(buf: bytes) -> list[int]:
+    return [(n >> 1) ^ -(n & 1) for n in _packed(buf)]
+
+
+def _deltas(buf: bytes) -> list[int]:
+    return list(accumulate(_signed(buf)))
+
+
+def _int64(n: int) -> int:
+    # Negative int64 (not sint64) varints are encoded in two's complement
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+# File structure
+
+
+def blobs(path: Path) -> Iterator[tuple[str, int, int]]:
+    """
+    Yield the type ("OSMHeader" or "OSMData"), offset, and size of each blob
+    in a PBF file, without reading the blobs themselves.
+    """
+    with open(path, "rb") as f:
+        while size := f.read(4):
+            header = f.read(int.from_bytes(size, "big"))
+            kind, datasize = "", 0
+            for field, value in _fields(header):
+                if field == 1:
+                    kind = value.decode()
+                elif field == 3:
+                    datasize = value
+
+            offset = f.tell()
+            f.seek(datasize, os.SEEK_CUR)
+            yield kind, offset, datasize
+
+
+def _read_blob(path: Path, offset: int, size: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        blob = f.read(size)
+
+    for field, value in _fields(blob):
+        if field == 1:
+            return value
+        if field == 3:
+            return zlib.decompress(value)
+        if field == 4:
+            return lzma.decompress(value)
+        if field in (5, 6, 7):
+            # bzip2 (obsolete), LZ4, and Zstandard are not in the standard
+            # library, and are rarely used
+            raise PBFError(f"Unsupported compression of blob (field {field})")
+    return b""
+
+
+def header(path: Path) -> dict[str, Any]:
+    """
+    Return what the header of a PBF file says of its data: its features, the
+    program that wrote it, and the time up to which it includes OSM edits (if
+    it is kept up to date with replication diffs, as Geofabrik's are), as
+    "timestamp" (in ISO 8601).
+    """
+    out: dict[str, Any] = {"required_features": [], "optional_features": []}
+    for kind, offset, size in blobs(path):
+        if kind != "OSMHeader":
+            continue
+
+        for field, value in _fields(_read_blob(path, offset, size)):
+            if field == 4:
+                out["required_features"].append(value.decode())
+            elif field == 5:
+                out["optional_features"].append(value.decode())
+            elif field == 16:
+                out["writingprogram"] = value.decode()
+            elif field == 32:
+                out["timestamp"] = _isoformat(value)
+        break
+    return out
+
+
+def _isoformat(seconds: int) -> str:
+    # As Overpass gives timestamps
+    t = datetime.fromtimestamp(seconds, UTC)
+    return t.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# Blocks
+
+
+class _Block:
+    """
+    A decoded PrimitiveBlock: its string table (of bytes, decoded to str only
+    as needed), and the messages of its groups, by field.
+    """
+
+    def __init__(self, data: bytes):
+        self.strings: list[bytes] = []
+        self.groups: list[list[tuple[int, bytes]]] = []
+        self.granularity, self.date_granularity = 100, 1000
+        self.lat_offset = self.lon_offset = 0
+
+        for field, value in _fields(data):
+            if field == 1:
+                self.strings = [s for _, s in _fields(value)]
+            elif field == 2:
+                self.groups.append(list(_fields(value)))
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = _int64(value)
+            elif field == 20:
+                self.lon_offset = _int64(value)
+
+    def messages(self, kind: int) -> Iterator[bytes]:
+        # Fields of a group: 1 nodes, 2 dense nodes, 3 ways, 4 relations
+        for group in self.groups:
+            for field, value in group:
+                if field == kind:
+                    yield value
+
+    def tag_filter(self) -> set[tuple[int, int]]:
+        # The (key, value) pairs of the string table that mark a place
+        index = {s: i for i, s in enumerate(self.strings)}
+        return {
+            (index[k.encode()], index[v.encode()])
+            for k, values in PLACE_TAGS.items()
+            if k.encode() in index
+            for v in values
+            if v.encode() in index
+        }
+
+    def tags(self, keys: Iterable[int], vals: Iterable[int]) -> dict[str, str]:
+        s = self.strings
+        return {
+            s[k].decode(): s[v].decode()
+            for k, v in zip(keys, vals, strict=True)
+        }
+
+    def coord(self, offset: int, n: int) -> float:
+        return round(1e-9 * (offset + self.granularity * n), 7)
+
+    def info(self, buf: bytes) -> dict[str, Any]:
+        out: dict[str, Any] = {}
+        for field, value in _fields(buf):
+            if field == 1:
+                out["version"] = value
+            elif field == 2:
+                out["timestamp"] = self.timestamp(value)
+            elif field == 3:
+                out["changeset"] = value
+            elif field == 4:
+                out["uid"] = value
+            elif field == 5:
+                out["user"] = self.strings[value].decode()
+        return out
+
+    def timestamp(self, n: int) -> str:
+        return _isoformat(n * self.date_granularity // 1000)
+
+
+def _dense(
+    block: _Block,
+    buf: bytes,
+    keep: Callable[[int, list[int]], bool],
+    meta: bool = True,
+) -> Iterator[dict[str, Any]]:
+    # Nodes of a DenseNodes message that are kept (given their ID and their
+    # interleaved keys and values), with their tags and metadata if `meta`, or
+    # otherwise only their coordinates (as Overpass' skeletons).  Metadata are
+    # only decoded for the (few) nodes kept
+    fields = dict(_fields(buf))
+    ids = _deltas(fields[1])
+    if meta:
+        tags = _split(_packed(fields.get(10, b"")), len(ids))
+    else:
+        tags = [[]] * len(ids)
+    kept = [
+        i
+        for i, (id_, kv) in enumerate(zip(ids, tags, strict=True))
+        if keep(id_, kv)
+    ]
+    if not kept:
+        return
+
+    lats, lons = _deltas(fields[8]), _deltas(fields[9])
+    info = _dense_info(fields.get(5)) if meta else {}
+    for i in kept:
+        e = {
+            "type": "node",
+            "id": ids[i],
+            "lat": block.coord(block.lat_offset, lats[i]),
+            "lon": block.coord(block.lon_offset, lons[i]),
+        }
+        if meta:
+            e |= {k: v[i] for k, v in info.items()}
+            if "timestamp" in e:
+                e["timestamp"] = block.timestamp(e["timestamp"])
+            if "user" in e:
+                e["user"] = block.strings[e["user"]].decode()
+            kv = tags[i]
+            e["tags"] = block.tags(kv[::2], kv[1::2])
+        yield e
+
+
+def _split(keys_vals: list[int], n: int) -> list[list[int]]:
+    # The keys and values of each of `n` nodes, each terminated by a zero (or
+    # none at all, if no node has tags)
+    if not keys_vals:
+        return [[]] * n
+
+    out, start = [], 0
+    for _ in range(n):
+        end = keys_vals.index(0, start)
+        out.append(keys_vals[start:end])
+        start = end + 1
+    return out
+
+
+def _dense_info(buf: bytes | None) -> dict[str, list[int]]:
+    # The (undecoded) metadata of every node of a DenseNodes message: their
+    # timestamps in units of the block's `date_granularity`, and their users'
+    # indices in its string table
+    if buf is None:
+        return {}
+
+    fields = dict(_fields(buf))
+    out = {}
+    if 1 in fields:
+        out["version"] = _packed(fields[1])
+    for field, key in enumerate(("timestamp", "changeset", "uid", "user"), 2):
+        if field in fields:
+            out[key] = _deltas(fields[field])
+    return out
+
+
+def _element(
+    kind: str, block: _Block, buf: bytes, keep: Callable[[int, dict], bool]
+) -> dict[str, Any] | None:
+    # A (non-dense) node, way, or relation, if kept (given its ID and fields,
+    # so that it can be rejected before its references are decoded)
+    fields: dict[int, Any] = dict(_fields(buf))
+    id_ = _zigzag(fields[1]) if kind == "node" else fields[1]
+    if not keep(id_, fields):
+        return None
+
+    e: dict[str, Any] = {"type": kind, "id": id_}
+    if kind == "node":
+        e["lat"] = block.coord(block.lat_offset, _zigzag(fields[8]))
+        e["lon"] = block.coord(block.lon_offset, _zigzag(fields[9]))
+    if 4 in fields:
+        e.update(block.info(fields[4]))
+
+    keys, vals = _packed(fields.get(2, b"")), _packed(fields.get(3, b""))
+    if keys:
+        e["tags"] = block.tags(keys, vals)
+
+    if kind == "way":
+        e["nodes"] = _deltas(fields.get(8, b""))
+    elif kind == "relation":
+        roles = _packed(fields.get(8, b""))
+        refs = _deltas(fields.get(9, b""))
+        types = _packed(fields.get(10, b""))
+        e["members"] = [
+            {
+                "type": _MEMBER_TYPES[t],
+                "ref": ref,
+                "role": block.strings[r].decode(),
+            }
+            for r, ref, t in zip(roles, refs, types, strict=True)
+        ]
+    return e
+
+
+def _scan(
+    path: Path, since: str | None, blob: tuple[int, int]
+) -> tuple[list[dict[str, Any]], bool, bool]:
+    # The places of a block (tagged as such, and changed since `since`), and
+    # whether it holds any nodes or ways
+    block = _Block(_read_blob(path, *blob))
+    places = block.tag_filter()
+    out: list[dict[str, Any]] = []
+    has_nodes = has_ways = False
+
+    def tagged(keys: list[int], vals: list[int]) -> bool:
+        return any(kv in places for kv in zip(keys, vals, strict=True))
+
+    def changed(e: dict[str, Any]) -> bool:
+        return since is None or e.get("timestamp", "") > since
+
+    for buf in block.messages(2):
+        has_nodes = True
+        if places:
+            nodes = _dense(block, buf, lambda _, kv: tagged(kv[::2], kv[1::2]))
+            out.extend(filter(changed, nodes))
+
+    def keep(_, fields: dict[int, Any]) -> bool:
+        if not places:
+            return False
+        keys, vals = fields.get(2, b""), fields.get(3, b"")
+        return tagged(_packed(keys), _packed(vals))
+
+    for field, kind in ((1, "node"), (3, "way"), (4, "relation")):
+        for buf in block.messages(field):
+            has_nodes |= kind == "node"
+            has_ways |= kind == "way"
+            if (e := _element(kind, block, buf, keep)) and changed(e):
+                out.append(e)
+
+    return out, has_nodes, has_ways
+
+
+# The IDs of the ways or nodes sought by a pass, set in each worker once (by
+# `_init`) rather than sent with every block
+_WANTED: frozenset[int] = frozenset()
+
+
+def _init(wanted: frozenset[int]):
+    global _WANTED
+    _WANTED = wanted
+
+
+def _ways(path: Path, blob: tuple[int, int]) -> list[dict[str, Any]]:
+    # The sought ways of a block, with only their node references
+    block = _Block(_read_blob(path, *blob))
+    out = []
+    for buf in block.messages(3):
+        e = _element("way", block, buf, lambda id_, _: id_ in _WANTED)
+        if e is not None:
+            out.append({"type": "way", "id": e["id"], "nodes": e["nodes"]})
+    return out
+
+
+def _nodes(path: Path, blob: tuple[int, int]) -> list[dict[str, Any]]:
+    # The sought nodes of a block, with only their coordinates
+    block = _Block(_read_blob(path, *blob))
+    out = []
+    for buf in block.messages(2):
+        out.extend(
+            _dense(block, buf, lambda id_, _: id_ in _WANTED, meta=False)
+        )
+    for buf in block.messages(1):
+        e = _element("node", block, buf, lambda id_, _: id_ in _WANTED)
+        if e is not None:
+            out.append(_skeleton(e))
+    return out
+
+
+def _skeleton(e: dict[str, Any]) -> dict[str, Any]:
+    # As from Overpass' `out skel`
+    return {"type": "node", "id": e["id"], "lat": e["lat"], "lon": e["lon"]}
+
+
+def _map[T, R](
+    fn: Callable[[T], R],
+    items: list[T],
+    workers: int | None,
+    wanted: frozenset[int] = frozenset(),
+) -> Iterator[R]:
+    # Map over blocks on a pool of processes (or in this process, if `workers`
+    # is 0), in order.  Processes are spawned rather than forked, as sources
+    # run on threads, which forking would not copy
+    if workers == 0:
+        _init(wanted)
+        try:
+            yield from map(fn, items)
+        finally:
+            _init(frozenset())
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        workers, mp_context=ctx, initializer=_init, initargs=(wanted,)
+    ) as pool:
+        yield from pool.map(fn, items, chunksize=4)
+
+
+def read_pbf(
+    path: Path,
+    workers: int | None = None,
+    since: str | None = None,
+    meta: dict[str, Any] | None = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Yield raw elements for places of worship (see `PLACE_TAGS`) from an OSM
+    extract in the PBF format, in the same form as Overpass gives them for
+    `church_query` (with `out meta`): tagged nodes, ways, and relations,
+    followed by the untagged ways and nodes that they reference.
+
+    Blocks are decoded in parallel on `workers` processes (by default, one
+    per CPU), or in this process if `workers` is 0.  Tagged nodes are yielded
+    as their blocks are decoded; ways and relations once the nodes that they
+    reference have been found.
+
+    If `since` (an ISO 8601 timestamp) is given, only elements changed after
+    it are yielded, as by `church_query`.  `meta`, if given, is updated with
+    the state of the data, as "osm3s" (as in Overpass' response), if the file
+    says (see `header`).
+    """
+    path = Path(path)
+    head = header(path)
+    if unknown := set(head["required_features"]) - _FEATURES:
+        raise PBFError(f"Unsupported features: {', '.join(sorted(unknown))}")
+
+    data = [(o, s) for kind, o, s in blobs(path) if kind == "OSMData"]
+
+    # Places, as each block is decoded
+    pending: list[dict[str, Any]] = []
+    node_blobs, way_blobs = [], []
+    scan = partial(_scan, path, since)
+    for blob, (elements, has_nodes, has_ways) in zip(
+        data, _map(scan, data, workers), strict=True
+    ):
+        if has_nodes:
+            node_blobs.append(blob)
+        if has_ways:
+            way_blobs.append(blob)
+        for e in elements:
+            if e["type"] == "node":
+                yield e
+            else:
+                pending.append(e)
+
+    yield from pending
+
+    # Ways referenced by relations, then the nodes of every way
+    ways = {e["id"] for e in pending if e["type"] == "way"}
+    wanted = frozenset(
+        m["ref"]
+        for e in pending
+        for m in e.get("members", ())
+        if m["type"] == "way" and m["ref"] not in ways
+    )
+    members = []
+    if wanted:
+        for elements in _map(partial(_ways, path), way_blobs, workers, wanted):
+            members.extend(elements)
+    yield from members
+
+    wanted = frozenset(
+        ref
+        for e in (*pending, *members)
+        for ref in (
+            e.get("nodes", ())
+            if e["type"] == "way"
+            else (m["ref"] for m in e.get("members", ()) if m["type"] == "node")
+        )
+    )
+    if wanted:
+        for elements in _map(
+            partial(_nodes, path), node_blobs, workers, wanted
+        ):
+            yield from elements
+
+    if meta is not None and "timestamp" in head:
+        meta["osm3s"] = {"timestamp_osm_base": head["timestamp"]}
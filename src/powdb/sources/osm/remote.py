@@ -1,45 +1,193 @@
-from OSMPythonTools.nominatim import Nominatim
-from OSMPythonTools.overpass import Overpass
+import json
+import os
+from collections.abc import Callable, Iterable, Iterator
+from functools import partial
+from typing import Any
+from urllib.parse import urlencode
 
+from powdb.common.cache import CACHE, TTL, Cache
+from powdb.common.geo import BBox
+from powdb.common.jsonstream import JSONArrayStream
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.common.transport import TRANSPORT, Transport
+from powdb.sources.osm.geometry import collapse
+from powdb.sources.osm.tags import overpass_filters
 
-def nz():
-    nominatim = Nominatim()
-    return nominatim.query("NZ")
+# Endpoints default to the public instances, but may be pointed elsewhere (e.g.,
+# at a mirror, or at a local `common.replay` server for testing)
+OVERPASS_URI = os.environ.get(
+    "POWDB_OVERPASS_URI", "https://overpass-api.de/api/interpreter"
+)
+NOMINATIM_URI = os.environ.get(
+    "POWDB_NOMINATIM_URI", "https://nominatim.openstreetmap.org/search"
+)
 
 
-def get_church_data():
-    overpass = Overpass()
-    # query = overpassQueryBuilder(area=nz(), elementType="node", )
-    query = """
-        // [out:json][timeout:999];
-        area["ISO3166-1"="NZ"][admin_level=2]->.nz;
+def church_query(
+    country: str = "NZ", bbox: BBox | None = None, since: str | None = None
+) -> str:
+    """
+    Construct an Overpass query for places of worship (see `PLACE_TAGS`) in
+    the given country (by ISO 3166-1 code), optionally restricted to a bounding
+    box within it, and to those elements changed since the given ISO 8601
+    timestamp.
+
+    NOTE: elements deleted since then will not be returned, so an incremental
+    query cannot tell us that a place has been removed.
+    """
+    # Bounding box and date filters, applied to each statement:
+    #   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Bounding_box>
+    #   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#By_date>
+    b = "" if bbox is None else f"({bbox})"
+    if since is not None:
+        b += f'(newer:"{since}")'
+
+    # Elements matching any of the tags (each only once, as it is a union);
+    # e.g., only churches would be `["religion"="christian"]` in addition
+    statements = "\n            ".join(
+        f"{t}{f}(area.a){b};"
+        for f in overpass_filters()
+        for t in ("node", "way", "relation")
+    )
+    return f"""
+        area["ISO3166-1"="{country}"][admin_level=2]->.a;
         (
-            // node["amenity"="place_of_worship"]["religion"="christian"]
-            //   (area.nz);
-            node["amenity"="place_of_worship"](area.nz);
-            // way["amenity"="place_of_worship"]["religion"="christian"]
-            //   (area.nz);
-            way["amenity"="place_of_worship"](area.nz);
-            // relation["amenity"="place_of_worship"]["religion"="christian"]
-            //   (area.nz);
-            relation["amenity"="place_of_worship"](area.nz);
+            {statements}
         );
-        out body;
+        out meta;
         >;
         out skel qt;
     """
-    result = overpass.query(query, timeout=999, out="json")
 
-    if result.isValid():
-        data = result.toJSON()
-    else:
-        print("ERROR: invalid response from Overpass")
-        return
 
-    print(f"Received {len(str(data))} bytes from OSM (Overpass)")
+class OverpassError(RuntimeError):
+    pass
+
+
+def nominatim(
+    query: str, cache: Cache = CACHE, transport: Transport = TRANSPORT
+) -> list[dict[str, Any]]:
+    """
+    Geocode a free-form query with Nominatim:
+      <nominatim.org/release-docs/latest/api/Search>
+
+    NOTE: Nominatim's usage policy requires an identifying User-Agent, which
+    the transport provides:
+      <operations.osmfoundation.org/policies/nominatim>
+    """
+    params = urlencode({"q": query, "format": "jsonv2"})
+    uri = f"{NOMINATIM_URI}?{params}"
+    fetch = partial(transport.stream, "GET", uri)
+    with cache.stream(NOMINATIM_URI, params, fetch, TTL["nominatim"]) as chunks:
+        return json.loads(b"".join(chunks))
+
+
+def nz():
+    return nominatim("NZ")
+
+
+def get_church_data():
+    n, nbytes = 0, 0
+
+    # Count bytes as they are streamed, rather than re-serialising the result
+    def count(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        nonlocal nbytes
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+
+    for _ in normalise(stream_overpass(church_query(), wrap=count)):
+        n += 1
+
+    print(f"Received {nbytes} bytes ({n} places) from OSM (Overpass)")
+
+
+def build_overpass_query(query: str, timeout: int = 999) -> str:
+    # Overpass QL settings must precede the query body:
+    #   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Settings>
+    return f"[out:json][timeout:{timeout}];\n{query}"
 
 
-# TODO: collapse ways function
+def stream_overpass(
+    query: str,
+    timeout: int = 999,
+    wrap: Callable[[Iterator[bytes]], Iterator[bytes]] | None = None,
+    meta: dict[str, Any] | None = None,
+    cache: Cache = CACHE,
+    transport: Transport = TRANSPORT,
+) -> Iterator[dict[str, Any]]:
+    """
+    Stream raw elements from an Overpass query as its response arrives.
+
+    Elements are decoded one at a time from the HTTP body, so memory use is
+    bounded by the size of the largest element rather than the response.
+
+    `wrap`, if given, is applied to the iterator of raw chunks of bytes (for
+    example, to count bytes as they are received).
+
+    `meta`, if given, is updated with the other members of the response (such
+    as `osm3s`, which describes the state of the data) once it is consumed.
+
+    Responses are kept in `cache`, so repeated queries are streamed from disk.
+    """
+    q = build_overpass_query(query, timeout)
+    fetch = partial(transport.stream, "POST", OVERPASS_URI, data={"data": q})
+    with cache.stream(OVERPASS_URI, q, fetch, TTL["overpass"]) as chunks:
+        if wrap is not None:
+            chunks = wrap(chunks)
+
+        stream = JSONArrayStream(chunks, "elements")
+        yield from METRICS.timed(stream, "parse")
+
+        if meta is not None:
+            meta.update(stream.meta)
+
+        # Overpass reports runtime errors (such as timeouts) in a remark after
+        # the (possibly incomplete) elements, with a successful status code.
+        # Raising here also prevents the response from being cached
+        #   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Query_timeout>
+        remark = stream.meta.get("remark", "")
+        if remark.startswith("runtime error"):
+            raise OverpassError(remark)
+
+
+def normalise_element(e: dict[str, Any]) -> Place | None:
+    """
+    Normalise a raw Overpass element into a place, or return None if the
+    element is not a place in itself (e.g., an untagged skeleton node
+    referenced by a way).
+
+    Ways and relations are located at their `center`, if any (see `collapse`).
+    """
+    tags = e.get("tags")
+    if not tags:
+        return None
+
+    loc = e.get("center", e)
+
+    return Place(
+        source="osm",
+        id=f"{e['type']}/{e['id']}",
+        name=tags.get("name"),
+        lat=loc.get("lat"),
+        lon=loc.get("lon"),
+        religion=tags.get("religion"),
+        denomination=tags.get("denomination"),
+        timestamp=e.get("timestamp"),
+        tags=tags,
+    )
+
+
+def normalise(elements: Iterable[dict[str, Any]]) -> Iterator[Place]:
+    """
+    Normalise raw Overpass elements into places, one per tagged node, way, or
+    relation (located by the nodes that follow it; see `collapse`).
+    """
+    for e in collapse(elements):
+        if (p := normalise_element(e)) is not None:
+            yield p
+
 
 # def overpassQueryBuilder(
 #         area=None,
@@ -0,0 +1,84 @@
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Any
+
+from powdb.common.geo import NZ_BBOXES, BBox
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.sources.osm import history, pbf, tiles
+from powdb.sources.osm.remote import church_query, normalise, stream_overpass
+
+
+class OSM:
+    """
+    Places of worship from OpenStreetMap, via Overpass, or from an extract
+    `pbf` (in the PBF format; see `pbf.read_pbf`, to which `workers` is
+    passed) if given.
+
+    If `tiled`, the country's bounding box `bbox` (or boxes) is harvested in
+    concurrent tiles (see `tiles.harvest`, to which `options` are passed);
+    otherwise, it is queried all at once.
+
+    If `history`, each place is also tagged with when it was first seen and
+    last modified, from the OSM API (see `history.enrich`).
+
+    The watermark is the time up to which Overpass had applied OSM edits when
+    the data were queried (the earliest such time, if tiled), so fetching
+    `since` it will yield every place edited after the previous fetch.
+    """
+
+    name = "osm"
+
+    def __init__(
+        self,
+        country: str = "NZ",
+        tiled: bool = False,
+        bbox: BBox | Sequence[BBox] = NZ_BBOXES,
+        history: bool = False,
+        pbf: Path | None = None,
+        workers: int | None = None,
+        **options,
+    ):
+        self.country = country
+        self.tiled = tiled
+        self.bbox = bbox
+        self.history = history
+        self.pbf = pbf
+        self.workers = workers
+        self.options = options
+        self.watermark: str | None = None
+
+    def fetch(self, since: str | None = None) -> Iterator[Place]:
+        metas: list[dict[str, Any]] = []
+
+        if self.pbf is not None:
+            metas.append({})
+            elements = METRICS.timed(
+                pbf.read_pbf(
+                    self.pbf, self.workers, since=since, meta=metas[0]
+                ),
+                "parse",
+            )
+        elif self.tiled:
+            elements = tiles.harvest(
+                self.bbox, self.country, since=since, meta=metas, **self.options
+            )
+        else:
+            metas.append({})
+            q = church_query(self.country, since=since)
+            elements = stream_overpass(q, meta=metas[0])
+
+        places = METRICS.timed(normalise(elements), "normalise")
+        if self.history:
+            places = history.enrich(places)
+        yield from places
+
+        # Overpass describes the state of its data in the `osm3s` member (as
+        # does `read_pbf`, if the extract says):
+        #   <wiki.openstreetmap.org/wiki/OSM_JSON#Overpass_API>
+        timestamps = [
+            t
+            for m in metas
+            if (t := m.get("osm3s", {}).get("timestamp_osm_base")) is not None
+        ]
+        self.watermark = min(timestamps, default=None)
@@ -0,0 +1,42 @@
+# Tags of places of worship (and of religious buildings, which may not be
+# tagged as places of worship, such as a disused church), by which both the
+# Overpass query and a PBF extract select places, so that either gives the same
+# places under the one source:
+#   <wiki.openstreetmap.org/wiki/Tag:amenity=place_of_worship>
+#   <wiki.openstreetmap.org/wiki/Key:building#Religious>
+#
+# NOTE: building=presbytery is left out, as a priest's house is not a place of
+# worship
+PLACE_TAGS: dict[str, frozenset[str]] = {
+    "amenity": frozenset({"place_of_worship"}),
+    "building": frozenset(
+        {
+            "religious",
+            "cathedral",
+            "chapel",
+            "church",
+            "kingdom_hall",
+            "monastery",
+            "mosque",
+            "shrine",
+            "synagogue",
+            "temple",
+        }
+    ),
+    "historic": frozenset({"church"}),
+}
+
+
+def overpass_filters() -> list[str]:
+    """
+    Return the Overpass tag filters that select `PLACE_TAGS`, one per key (in
+    a fixed order, so that queries are the same from run to run):
+      <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#By_tag_(has-kv)>
+    """
+    filters = []
+    for k, values in sorted(PLACE_TAGS.items()):
+        if len(values) == 1:
+            filters.append(f'["{k}"="{next(iter(values))}"]')
+        else:
+            filters.append(f'["{k}"~"^({"|".join(sorted(values))})$"]')
+    return filters
@@ -0,0 +1,139 @@
+import contextvars
+from collections.abc import Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+import requests
+
+from powdb.common.geo import NZ_BBOXES, BBox
+from powdb.common.metrics import METRICS
+from powdb.sources.osm.remote import (
+    OverpassError,
+    church_query,
+    stream_overpass,
+)
+
+# Overpass reports these runtime errors when a query is too large for it to
+# answer, in which case it is worth splitting the query into smaller parts:
+#   <wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#Query_timeout>
+_SPLITTABLE_REMARKS = ("timed out", "out of memory")
+
+
+def _is_too_large(e: Exception) -> bool:
+    if isinstance(e, OverpassError):
+        return any(r in str(e) for r in _SPLITTABLE_REMARKS)
+
+    # Gateway timeout from the server in front of Overpass.  Timeouts of our
+    # own are not counted, as they are of connecting (the transport does not
+    # limit reading), which smaller tiles would not help
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code == 504
+
+    return False
+
+
+def _fetch_tile(
+    country: str, tile: BBox, since: str | None, timeout: int
+) -> tuple[list[dict[str, Any]], dict[str, Any]]:
+    # We must consume the tile in full before using any of its elements, as
+    # Overpass only reports that a query has timed out at the end of the
+    # response, and the elements preceding it are then incomplete
+    meta = {}
+    q = church_query(country, tile, since)
+    return list(stream_overpass(q, timeout=timeout, meta=meta)), meta
+
+
+def _tiles(boxes: Sequence[BBox], rows: int, cols: int) -> Iterator[BBox]:
+    # Tiles of about the same size in every box, as many as `rows` × `cols` in
+    # the largest (so that small outlying boxes are not split needlessly)
+    height = max(b.north - b.south for b in boxes) / rows
+    width = max(b.east - b.west for b in boxes) / cols
+    for b in boxes:
+        r = max(1, round((b.north - b.south) / height))
+        c = max(1, round((b.east - b.west) / width))
+        yield from b.grid(r, c)
+
+
+def harvest(
+    bbox: BBox | Sequence[BBox] = NZ_BBOXES,
+    country: str = "NZ",
+    rows: int = 4,
+    cols: int = 4,
+    workers: int = 2,
+    timeout: int = 180,
+    max_depth: int = 4,
+    since: str | None = None,
+    meta: list[dict[str, Any]] | None = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Harvest raw Overpass elements for places of worship in a country, by
+    splitting its bounding box (or boxes, as for a country that spans the
+    antimeridian) into a grid of `rows` × `cols` tiles (with as many tiles of
+    about the same size in any smaller boxes) and querying these concurrently
+    on a pool of `workers` threads.
+
+    Elements are yielded as each tile completes, deduplicated by element type
+    and ID (as ways and relations, and the nodes they reference, will appear
+    in every tile that they intersect).
+
+    Tiles whose queries time out (or run out of memory) within `timeout`
+    seconds are split into quadrants and retried, up to `max_depth` times.
+
+    `since` is passed to `church_query`.  `meta`, if given, is extended with
+    the other members of each tile's response (see `stream_overpass`).
+
+    NOTE: the public Overpass instance allows only a couple of concurrent
+    queries per IP address, so more workers only help against an instance
+    with more slots:
+      <wiki.openstreetmap.org/wiki/Overpass_API#Public_Overpass_API_instances>
+    """
+    seen = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: dict[Future, tuple[BBox, int]] = {}
+
+        def submit(tile: BBox, depth: int):
+            # Tiles are fetched on behalf of the caller's source
+            ctx = contextvars.copy_context()
+            f = pool.submit(ctx.run, _fetch_tile, country, tile, since, timeout)
+            pending[f] = (tile, depth)
+
+        boxes = [bbox] if isinstance(bbox, BBox) else bbox
+        for tile in _tiles(boxes, rows, cols):
+            submit(tile, 0)
+
+        # Tiles yet to be fetched are cancelled if we fail, or if the caller
+        # stops early (closing this generator), rather than fetched for nothing
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    tile, depth = pending.pop(f)
+
+                    try:
+                        elements, tile_meta = f.result()
+                    except Exception as e:
+                        if depth >= max_depth or not _is_too_large(e):
+                            raise
+
+                        for subtile in tile.split():
+                            submit(subtile, depth + 1)
+
+                        continue
+
+                    if meta is not None:
+                        meta.append(tile_meta)
+
+                    with METRICS.stage("dedupe") as counts:
+                        fresh = []
+                        for e in elements:
+                            k = (e["type"], e["id"])
+                            if k not in seen:
+                                seen.add(k)
+                                fresh.append(e)
+                        counts["records"] = len(elements)
+
+                    yield from fresh
+        finally:
+            for f in pending:
+                f.cancel()
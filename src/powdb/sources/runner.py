@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+from collections.abc import Callable, Iterable, Mapping
+from dataclasses import dataclass
+
+from powdb.common.metrics import METRICS
+
+
+@dataclass
+class Outcome:
+    """
+    The result of running a single source: how many records it produced, how
+    long it took, and the error that stopped it (if any).
+    """
+
+    name: str
+    count: int = 0
+    elapsed: float = 0.0
+    error: BaseException | None = None
+
+
+class _Stopped(Exception):
+    pass
+
+
+async def run_sources[T](
+    sources: Mapping[str, Callable[[], Iterable[T]]],
+    consume: Callable[[str, T], None],
+    batch_size: int = 1000,
+    queue_size: int = 16,
+) -> dict[str, Outcome]:
+    """
+    Run all `sources` concurrently, calling `consume(name, record)` for every
+    record that each produces, in whatever order they arrive.
+
+    Sources are (blocking) iterables, such as those that stream records from
+    remote APIs, so each is iterated on its own thread, and its records are
+    passed to the consumer (on the event loop) in batches of `batch_size`.  At
+    most `queue_size` batches are buffered, so that a slow consumer applies
+    backpressure to the sources rather than allowing them to fill memory.
+
+    A source that raises does not stop the others; its error is recorded in its
+    `Outcome`.  An error raised by the consumer, however, stops all sources.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tuple[str, list[T]] | None] = asyncio.Queue(queue_size)
+    outcomes = {name: Outcome(name) for name in sources}
+    stop = threading.Event()
+
+    def put(item: tuple[str, list[T]]):
+        if stop.is_set():
+            raise _Stopped
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce(name: str, fetch: Callable[[], Iterable[T]]):
+        outcome, batch = outcomes[name], []
+        try:
+            for record in fetch():
+                batch.append(record)
+                outcome.count += 1
+                if len(batch) >= batch_size:
+                    put((name, batch))
+                    batch = []
+        finally:
+            # Pass on what we have, even if the source fails part way
+            if batch and not stop.is_set():
+                put((name, batch))
+
+    async def run(name: str, fetch: Callable[[], Iterable[T]]):
+        t0 = time.perf_counter()
+        try:
+            # Work on the source's thread (and any that it copies its context
+            # to) is attributed to it
+            with METRICS.source(name):
+                await asyncio.to_thread(produce, name, fetch)
+        except _Stopped:
+            pass
+        except Exception as e:
+            outcomes[name].error = e
+        finally:
+            outcomes[name].elapsed = time.perf_counter() - t0
+
+    async def drain():
+        while (item := await queue.get()) is not None:
+            name, batch = item
+            for record in batch:
+                consume(name, record)
+
+    producers = asyncio.gather(*(run(n, f) for n, f in sources.items()))
+    consumer = asyncio.create_task(drain())
+
+    await asyncio.wait(
+        [producers, consumer], return_when=asyncio.FIRST_COMPLETED
+    )
+
+    if consumer.done():
+        # The consumer can only finish early by raising, in which case we must
+        # stop the sources, and unblock any that are waiting to put a batch
+        stop.set()
+        while not producers.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+        consumer.result()
+
+    await queue.put(None)
+    await consumer
+    return outcomes
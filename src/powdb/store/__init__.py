@@ -0,0 +1,12 @@
+from powdb.common.lazy import lazy
+
+__getattr__, __dir__ = lazy(
+    __name__,
+    {
+        "Counts": ".aggregate",
+        "Categorical": ".columns",
+        "Strings": ".columns",
+        "Database": ".sqlite",
+        "PlaceTable": ".table",
+    },
+)
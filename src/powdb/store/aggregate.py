@@ -0,0 +1,150 @@
+from collections import Counter
+from collections.abc import Iterable
+
+from powdb.store.columns import Categorical
+from powdb.store.table import PlaceTable
+
+# What places are counted by, unless told otherwise.  Tables have no regions
+# of their own, so these are given alongside them (see `Counts.update`)
+DIMENSIONS = ("religion", "denomination", "source", "region")
+
+type Key = tuple[str | None, ...]
+
+
+class Counts:
+    """
+    Counts of places by every combination of the values of some categorical
+    columns (`DIMENSIONS`, by default), from which counts by any of them are
+    rolled up (see `by`).
+
+    Places are counted by their columns' codes rather than their values, in
+    one pass over all of the columns at once, as a `Counter` of the codes'
+    tuples (which is counted in C).  Only then are the (few) distinct tuples
+    decoded, into codes of the counts' own categories, as every table has its
+    own.  Counts are kept up to date as places are added to a table (or
+    replaced) by counting (or discounting) only those rows (see `update` and
+    `subtract`), so reports need never recount every place.
+    """
+
+    def __init__(self, by: Iterable[str] = DIMENSIONS):
+        self.dimensions = tuple(by)
+        self.categories = {d: Categorical() for d in self.dimensions}
+        self.counts: Counter[tuple[int, ...]] = Counter()
+
+    def __len__(self) -> int:
+        # The number of places counted
+        return self.counts.total()
+
+    def _count(
+        self,
+        table: PlaceTable,
+        start: int,
+        stop: int | None,
+        columns: dict[str, Categorical],
+    ) -> Counter[tuple[int, ...]]:
+        cols = []
+        for d in self.dimensions:
+            col = columns.get(d, getattr(table, d, None))
+            if col is not None and len(col) != len(table):
+                raise ValueError(
+                    f"Column {d} has {len(col)} rows, not {len(table)}"
+                )
+            cols.append(col)
+
+        stop = len(table) if stop is None else stop
+        present = [c for c in cols if c is not None]
+        if present:
+            # Views, rather than slices, so that no codes are copied
+            rows = (memoryview(c.codes)[start:stop] for c in present)
+            counts = Counter(zip(*rows, strict=True))
+        else:
+            counts = Counter({(): max(0, stop - start)})
+
+        # Map each table's codes to ours (with the missing code, -1, last, so
+        # that it maps to itself), and count dimensions that neither the table
+        # nor `columns` have as missing
+        remaps = [
+            [*map(self.categories[d].code, c.categories), -1]
+            for d, c in zip(self.dimensions, cols, strict=True)
+            if c is not None
+        ]
+        missing = [i for i, c in enumerate(cols) if c is None]
+        out: Counter[tuple[int, ...]] = Counter()
+        for codes, n in counts.items():
+            key = [r[c] for r, c in zip(remaps, codes, strict=True)]
+            for i in missing:
+                key.insert(i, -1)
+            out[tuple(key)] += n
+        return out
+
+    def update(
+        self,
+        table: PlaceTable,
+        start: int = 0,
+        stop: int | None = None,
+        **columns: Categorical,
+    ):
+        """
+        Count the places of `table` from row `start` up to `stop` (by default,
+        every place; or, e.g., from the length of the table before it was
+        extended, only those since added).
+
+        Columns are taken from the table, or from `columns` by name (e.g., a
+        "region" of each row of the table).  Dimensions that neither has are
+        counted as missing.
+        """
+        self.counts.update(self._count(table, start, stop, columns))
+
+    def subtract(
+        self,
+        table: PlaceTable,
+        start: int = 0,
+        stop: int | None = None,
+        **columns: Categorical,
+    ):
+        """
+        Discount the places of `table` from row `start` up to `stop`, as
+        counted by `update` (e.g., before they are replaced by newer records).
+        """
+        self.counts.subtract(self._count(table, start, stop, columns))
+        self.counts = +self.counts
+
+    def by(self, *dimensions: str) -> Counter[Key]:
+        """
+        Return the number of places with each combination of values of
+        `dimensions` (with None for a missing value), over all the others.
+        """
+        idx = [self.dimensions.index(d) for d in dimensions]
+        cats = [self.categories[d].categories for d in dimensions]
+        out: Counter[Key] = Counter()
+        for codes, n in self.counts.items():
+            out[
+                tuple(
+                    None if (c := codes[i]) < 0 else cs[c]
+                    for i, cs in zip(idx, cats, strict=True)
+                )
+            ] += n
+        return out
+
+    def report(self, *dimensions: str, top: int | None = None) -> str:
+        """
+        Return the counts by `dimensions` (see `by`) as a table, most common
+        first, with their shares of all places.
+        """
+        counts = self.by(*dimensions)
+        total = max(1, counts.total())
+        widths = [
+            max([len(d), *(len(str(k[i])) for k in counts)])
+            for i, d in enumerate(dimensions)
+        ]
+
+        header = " ".join(
+            f"{d:<{w}}" for d, w in zip(dimensions, widths, strict=True)
+        )
+        lines = [f"{header} {'places':>9} {'share':>6}"]
+        for key, n in counts.most_common(top):
+            row = " ".join(
+                f"{str(v):<{w}}" for v, w in zip(key, widths, strict=True)
+            )
+            lines.append(f"{row} {n:>9} {n / total:>6.1%}")
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+from array import array
+from collections.abc import Iterable, Iterator
+
+# Any column's data are either an `array` (while it is being built in memory)
+# or a read-only `memoryview` (when it is loaded from a mapped file).  Both are
+# indexable buffers of machine values, so columns need not distinguish them
+type Buffer = array | memoryview
+
+
+class Categorical:
+    """
+    A dictionary-encoded column of (optional) strings.
+
+    Each distinct value is stored once in `categories`, and each row is stored
+    as its (32-bit) code into these, with -1 for a missing value.  This suits
+    columns with few distinct values, such as religion or source.
+    """
+
+    def __init__(
+        self,
+        values: Iterable[str | None] = (),
+        categories: list[str] | None = None,
+        codes: Buffer | None = None,
+    ):
+        self.categories = categories if categories is not None else []
+        self.codes = codes if codes is not None else array("i")
+        self._index = {c: i for i, c in enumerate(self.categories)}
+        self.extend(values)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> str | None:
+        c = self.codes[i]
+        return None if c < 0 else self.categories[c]
+
+    def __iter__(self) -> Iterator[str | None]:
+        cats = self.categories
+        for c in self.codes:
+            yield None if c < 0 else cats[c]
+
+    def code(self, value: str | None) -> int:
+        """
+        Return the code of `value`, adding it as a new category if required.
+        """
+        if value is None:
+            return -1
+
+        if (c := self._index.get(value)) is None:
+            c = self._index[value] = len(self.categories)
+            self.categories.append(value)
+
+        return c
+
+    def append(self, value: str | None):
+        self.codes.append(self.code(value))
+
+    def extend(self, values: Iterable[str | None]):
+        for v in values:
+            self.append(v)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.codes) * self.codes.itemsize + sum(
+            len(c) for c in self.categories
+        )
+
+
+class Strings:
+    """
+    A column of (optional) strings, packed end-to-end as UTF-8 in one buffer.
+
+    The value of row `i` is found between `offsets[i]` and `offsets[i + 1]`,
+    and `valid[i]` is zero if the value is missing.  This stores each value
+    without the per-object overhead of a Python string, and is only decoded on
+    access.
+    """
+
+    def __init__(
+        self,
+        values: Iterable[str | None] = (),
+        data: Buffer | None = None,
+        offsets: Buffer | None = None,
+        valid: Buffer | None = None,
+    ):
+        self.data = data if data is not None else bytearray()
+        self.offsets = offsets if offsets is not None else array("q", [0])
+        self.valid = valid if valid is not None else bytearray()
+        self.extend(values)
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    def __getitem__(self, i: int) -> str | None:
+        if not self.valid[i]:
+            return None
+
+        return bytes(self.data[self.offsets[i] : self.offsets[i + 1]]).decode()
+
+    def __iter__(self) -> Iterator[str | None]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value: str | None):
+        if value is not None:
+            self.data += value.encode()
+        self.offsets.append(len(self.data))
+        self.valid.append(value is not None)
+
+    def extend(self, values: Iterable[str | None]):
+        for v in values:
+            self.append(v)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            len(self.data)
+            + len(self.offsets) * self.offsets.itemsize
+            + len(self.valid)
+        )
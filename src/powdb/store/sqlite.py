@@ -0,0 +1,319 @@
+import json
+import os
+import sqlite3
+import struct
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from powdb.common.metrics import METRICS
+from powdb.common.record import Place
+from powdb.common.utils import partition
+
+# Where places are published, following the convention of persisting generated
+# data under `data/`
+DEFAULT_DATABASE = Path(os.environ.get("POWDB_DATABASE", "data/places.gpkg"))
+
+_TABLE = "places"
+_RTREE = f"rtree_{_TABLE}_geom"
+
+# The columns of each place, in the order they are inserted
+_COLUMNS = (
+    "source",
+    "id",
+    "name",
+    "religion",
+    "denomination",
+    "timestamp",
+    "lat",
+    "lon",
+    "tags",
+    "geom",
+)
+
+_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS {_TABLE} (
+        fid INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        id TEXT NOT NULL,
+        name TEXT,
+        religion TEXT,
+        denomination TEXT,
+        timestamp TEXT,
+        lat REAL,
+        lon REAL,
+        tags TEXT,
+        geom BLOB,
+        UNIQUE (source, id)
+    );
+"""
+
+_CREATE_RTREE = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {_RTREE}
+        USING rtree(id, minx, maxx, miny, maxy)
+"""
+
+# Secondary indexes, which are dropped while places are loaded and built once
+# afterwards, as this is much faster than updating them row by row
+_INDEXES = {
+    f"{_TABLE}_name": "name",
+    f"{_TABLE}_religion": "religion, denomination",
+}
+
+_UPSERT = f"""
+    INSERT INTO {_TABLE} ({", ".join(_COLUMNS)})
+    VALUES ({", ".join("?" * len(_COLUMNS))})
+    ON CONFLICT (source, id) DO UPDATE SET
+        {", ".join(f"{c} = excluded.{c}" for c in _COLUMNS[2:])}
+"""
+
+# GeoPackage metadata, so that the database can be opened by GIS tools (e.g.,
+# QGIS) as a layer of points:
+#   <www.geopackage.org/spec140/index.html>
+_APPLICATION_ID = 0x47504B47  # "GPKG"
+_USER_VERSION = 10400  # 1.4.0
+_WGS84 = 4326
+
+_GEOPACKAGE = f"""
+    CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+        srs_name TEXT NOT NULL,
+        srs_id INTEGER PRIMARY KEY,
+        organization TEXT NOT NULL,
+        organization_coordsys_id INTEGER NOT NULL,
+        definition TEXT NOT NULL,
+        description TEXT
+    );
+    INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES
+        ('Undefined Cartesian SRS', -1, 'NONE', -1, 'undefined', NULL),
+        ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL),
+        (
+            'WGS 84 geodetic', {_WGS84}, 'EPSG', {_WGS84},
+            'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+            || '298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG",'
+            || '"6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+            || 'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+            || 'AUTHORITY["EPSG","4326"]]',
+            'longitude/latitude coordinates in decimal degrees on the WGS 84 '
+            || 'spheroid'
+        );
+    CREATE TABLE IF NOT EXISTS gpkg_contents (
+        table_name TEXT NOT NULL PRIMARY KEY,
+        data_type TEXT NOT NULL,
+        identifier TEXT UNIQUE,
+        description TEXT DEFAULT '',
+        last_change DATETIME NOT NULL
+            DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+        min_x DOUBLE,
+        min_y DOUBLE,
+        max_x DOUBLE,
+        max_y DOUBLE,
+        srs_id INTEGER
+    );
+    INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier,
+        description, srs_id)
+    VALUES ('{_TABLE}', 'features', '{_TABLE}', 'Places of worship', {_WGS84});
+    CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+        table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        geometry_type_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL,
+        z TINYINT NOT NULL,
+        m TINYINT NOT NULL,
+        PRIMARY KEY (table_name, column_name)
+    );
+    INSERT OR IGNORE INTO gpkg_geometry_columns
+    VALUES ('{_TABLE}', 'geom', 'POINT', {_WGS84}, 0, 0);
+    CREATE TABLE IF NOT EXISTS gpkg_extensions (
+        table_name TEXT,
+        column_name TEXT,
+        extension_name TEXT NOT NULL,
+        definition TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        UNIQUE (table_name, column_name, extension_name)
+    );
+    INSERT OR IGNORE INTO gpkg_extensions
+    VALUES (
+        '{_TABLE}', 'geom', 'gpkg_rtree_index',
+        'http://www.geopackage.org/spec/#extension_rtree', 'write-only'
+    );
+"""
+
+
+class Database:
+    """
+    A SQLite database of places, published by upserting them in bulk.
+
+    Places are keyed by (source, id), so publishing a place again (e.g., in a
+    nightly refresh) updates it in place.  Places are written in batches of
+    `batch_size`, each with a single `executemany` in its own transaction.
+    Secondary indexes and the R*Tree spatial index of coordinates are dropped
+    when places are first written, and rebuilt when the database is closed,
+    rather than updated with every row.
+
+    If the path ends in ".gpkg" (or `geopackage` is set), the database is also
+    a GeoPackage, with each place's location as a point geometry, so that it
+    can be opened directly by GIS tools.
+
+    NOTE: GeoPackage's R*Tree triggers require spatial SQL functions that
+    plain SQLite lacks, so the tree is only rebuilt by this class; writes by
+    other tools will not update it.
+    """
+
+    def __init__(
+        self,
+        path: Path = DEFAULT_DATABASE,
+        batch_size: int = 10_000,
+        geopackage: bool | None = None,
+    ):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.path = path
+        self.batch_size = batch_size
+        self.geopackage = (
+            path.suffix == ".gpkg" if geopackage is None else geopackage
+        )
+        self._pending: list[Place] = []
+
+        # Transactions are managed explicitly, one per batch
+        self._conn = sqlite3.connect(path, isolation_level=None)
+
+        # Write-ahead logging lets readers query the database while it is
+        # being written, and makes each commit cheaper:
+        #   <sqlite.org/wal.html>
+        #   <sqlite.org/pragma.html#pragma_synchronous>
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA temp_store = MEMORY")
+
+        # Keep more of the (source, id) index in memory, as upserts look up
+        # every row in it (the default cache is only 2 MiB)
+        self._conn.execute("PRAGMA cache_size = -262144")
+
+        script = f"{_SCHEMA}; {_CREATE_RTREE};"
+        if self.geopackage:
+            script = f"""
+                PRAGMA application_id = {_APPLICATION_ID};
+                PRAGMA user_version = {_USER_VERSION};
+                {_GEOPACKAGE}
+                {script}
+            """
+        self._conn.executescript(f"BEGIN; {script} COMMIT;")
+        self._loading = False
+
+    def __enter__(self) -> "Database":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        self.flush()
+        (n,) = self._conn.execute(f"SELECT count(*) FROM {_TABLE}").fetchone()
+        return n
+
+    def add(self, place: Place):
+        """
+        Add a place to be published with the next batch.
+        """
+        self._pending.append(place)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        self.upsert(pending)
+
+    def upsert(self, places: Iterable[Place]) -> int:
+        """
+        Publish places in batches, and return how many were written.
+        """
+        n = 0
+        for batch in partition(places, self.batch_size):
+            with METRICS.stage("publish") as counts, self._transaction():
+                counts["records"] = len(batch)
+                if not self._loading:
+                    self._loading = True
+                    for index in _INDEXES:
+                        self._conn.execute(f"DROP INDEX IF EXISTS {index}")
+                self._conn.executemany(_UPSERT, map(self._row, batch))
+            n += len(batch)
+        return n
+
+    def close(self):
+        """
+        Publish any places added, build the indexes, and close the database.
+        """
+        self.flush()
+        if self._loading:
+            with METRICS.stage("publish"), self._transaction():
+                for index, columns in _INDEXES.items():
+                    self._conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS {index} "
+                        f"ON {_TABLE} ({columns})"
+                    )
+                self._build_rtree()
+            self._loading = False
+
+        # Fold the write-ahead log back into the database, so that it is a
+        # single, self-contained file
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._conn.close()
+
+    def _build_rtree(self):
+        # Rebuilding the tree from scratch is much faster than deleting every
+        # entry from it
+        self._conn.execute(f"DROP TABLE {_RTREE}")
+        self._conn.execute(_CREATE_RTREE)
+        self._conn.execute(
+            f"""
+            INSERT INTO {_RTREE}
+            SELECT fid, lon, lon, lat, lat FROM {_TABLE}
+            WHERE lat IS NOT NULL AND lon IS NOT NULL
+            """
+        )
+        if self.geopackage:
+            self._conn.execute(
+                f"""
+                UPDATE gpkg_contents SET
+                    (min_x, min_y, max_x, max_y) = (
+                        SELECT min(lon), min(lat), max(lon), max(lat)
+                        FROM {_TABLE}
+                    ),
+                    last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+                WHERE table_name = '{_TABLE}'
+                """
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        self._conn.execute("BEGIN")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _row(self, p: Place) -> tuple:
+        has_point = p.lat is not None and p.lon is not None
+        return (
+            p.source,
+            p.id,
+            p.name,
+            p.religion,
+            p.denomination,
+            p.timestamp,
+            p.lat,
+            p.lon,
+            json.dumps(p.tags, ensure_ascii=False) if p.tags else None,
+            _point(p.lon, p.lat) if has_point and self.geopackage else None,
+        )
+
+
+def _point(x: float, y: float) -> bytes:
+    # A GeoPackage geometry: a header ("GP", version 0, and flags for a
+    # little-endian geometry without an envelope) and SRS ID, then the point
+    # as well-known binary (little-endian, of type 1):
+    #   <www.geopackage.org/spec140/index.html#gpb_format>
+    return b"GP\x00\x01" + struct.pack("<iBIdd", _WGS84, 1, 1, x, y)
@@ -0,0 +1,216 @@
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+from powdb.common.record import Place
+from powdb.store.columns import Buffer, Categorical, Strings
+
+# File format:
+#
+#   magic (8 bytes) | header length (8 bytes) | header (JSON) | sections...
+#
+# The header records the number of rows and, for each column, the offset
+# (from the end of the header), length, and (`array`) type code of each of its
+# sections.  The header and sections are aligned to 8 bytes, so that each can
+# be cast in place to the machine values it contains when the file is mapped
+_MAGIC = b"POWDB\x00\x01\x00"
+_ALIGN = 8
+
+_CATEGORICALS = ("source", "religion", "denomination")
+_STRINGS = ("id", "name")
+_FLOATS = ("lat", "lon")
+
+
+class PlaceTable:
+    """
+    A columnar table of places.
+
+    Coordinates are stored as arrays of 64-bit floats (with NaN if unknown),
+    low-cardinality fields (source, religion, denomination) as dictionary-
+    encoded categoricals, and identifiers and names as packed strings.  Source-
+    specific tags and timestamps are not kept.
+
+    Tables can be saved to a single file, and loaded again by mapping that file
+    into memory, so that loading takes the same (negligible) time regardless of
+    size, and only the pages of the file actually read are brought into memory.
+    Loaded tables are read-only.
+    """
+
+    def __init__(self, places: Iterable[Place] = ()):
+        self.id = Strings()
+        self.name = Strings()
+        self.source = Categorical()
+        self.religion = Categorical()
+        self.denomination = Categorical()
+        self.lat = array("d")
+        self.lon = array("d")
+        self._mmap: mmap.mmap | None = None
+        self.extend(places)
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def __getitem__(self, i: int) -> Place:
+        if i < 0:
+            i += len(self)
+
+        lat, lon = self.lat[i], self.lon[i]
+        return Place(
+            source=self.source[i],
+            id=self.id[i],
+            name=self.name[i],
+            lat=None if math.isnan(lat) else lat,
+            lon=None if math.isnan(lon) else lon,
+            religion=self.religion[i],
+            denomination=self.denomination[i],
+        )
+
+    def __iter__(self) -> Iterator[Place]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, p: Place):
+        if self._mmap is not None:
+            raise TypeError("Cannot append to a table loaded from file")
+
+        self.id.append(p.id)
+        self.name.append(p.name)
+        self.source.append(p.source)
+        self.religion.append(p.religion)
+        self.denomination.append(p.denomination)
+        self.lat.append(math.nan if p.lat is None else p.lat)
+        self.lon.append(math.nan if p.lon is None else p.lon)
+
+    def extend(self, places: Iterable[Place]):
+        for p in places:
+            self.append(p)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Return the (approximate) size of the table's data, in bytes.
+        """
+        return sum(
+            getattr(self, c).nbytes for c in _STRINGS + _CATEGORICALS
+        ) + sum(len(getattr(self, c)) * 8 for c in _FLOATS)
+
+    def _sections(self) -> dict[str, dict[str, Buffer]]:
+        sections = {c: {"values": getattr(self, c)} for c in _FLOATS}
+        for c in _STRINGS:
+            col = getattr(self, c)
+            sections[c] = {
+                "data": col.data,
+                "offsets": col.offsets,
+                "valid": col.valid,
+            }
+        for c in _CATEGORICALS:
+            sections[c] = {"codes": getattr(self, c).codes}
+        return sections
+
+    def save(self, path: Path):
+        """
+        Write the table to `path`, atomically.
+        """
+        path = Path(path)
+        sections = self._sections()
+
+        # Lay out the sections, relative to the (aligned) end of the header
+        layout, offset = {}, 0
+        for c, parts in sections.items():
+            layout[c] = {}
+            for part, buf in parts.items():
+                nbytes = memoryview(buf).nbytes
+                typecode = buf.typecode if isinstance(buf, array) else "B"
+                layout[c][part] = [offset, nbytes, typecode]
+                offset = _align(offset + nbytes)
+
+        header = {
+            "n": len(self),
+            "byteorder": sys.byteorder,
+            "columns": layout,
+            "categories": {
+                c: getattr(self, c).categories for c in _CATEGORICALS
+            },
+        }
+        raw = json.dumps(header).encode()
+        start = _align(len(_MAGIC) + 8 + len(raw))
+
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(_MAGIC)
+            f.write(struct.pack("<Q", len(raw)))
+            f.write(raw)
+            for c, parts in sections.items():
+                for part, buf in parts.items():
+                    _write_at(f, buf, start + layout[c][part][0])
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "PlaceTable":
+        """
+        Load a table saved to `path` by mapping it into memory, without copying
+        its columns.
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[: len(_MAGIC)] != _MAGIC:
+            mm.close()
+            raise ValueError(f"Not a place table: {path}")
+
+        (n,) = struct.unpack_from("<Q", mm, len(_MAGIC))
+        header = json.loads(mm[len(_MAGIC) + 8 : len(_MAGIC) + 8 + n])
+        start = _align(len(_MAGIC) + 8 + n)
+
+        if header["byteorder"] != sys.byteorder:
+            mm.close()
+            raise ValueError("Place table was written with another byte order")
+
+        buf = memoryview(mm)
+
+        def section(c: str, part: str) -> memoryview:
+            offset, nbytes, typecode = header["columns"][c][part]
+            return buf[start + offset : start + offset + nbytes].cast(typecode)
+
+        t = cls.__new__(cls)
+        t._mmap = mm
+        for c in _FLOATS:
+            setattr(t, c, section(c, "values"))
+        for c in _STRINGS:
+            setattr(
+                t,
+                c,
+                Strings(
+                    data=section(c, "data"),
+                    offsets=section(c, "offsets"),
+                    valid=section(c, "valid"),
+                ),
+            )
+        for c in _CATEGORICALS:
+            setattr(
+                t,
+                c,
+                Categorical(
+                    categories=header["categories"][c],
+                    codes=section(c, "codes"),
+                ),
+            )
+
+        return t
+
+
+def _align(n: int) -> int:
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _write_at(f: BinaryIO, buf: Buffer, offset: int):
+    # Pad up to the (aligned) offset of the section
+    f.write(b"\0" * (offset - f.tell()))
+    f.write(memoryview(buf).cast("B"))
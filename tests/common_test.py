@@ -1,9 +1,26 @@
+import contextlib
+import contextvars
+import json
+import pstats
+import threading
+import time
 from collections.abc import Sequence
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Any, Never
 
 import pytest
+import requests
 
 from powdb import common
+from powdb.common import cache, metrics, profiler, replay, transport
+from powdb.common.cache import Cache
+from powdb.common.geo import BBox
+from powdb.common.jsonstream import JSONArrayStream
+from powdb.common.schema import infer_schema, osm_fields, sparql_fields
+from powdb.common.utils.eltype import _MAX_SHAPES, _SHAPES
+from powdb.sources.dbpedia import remote as dbpedia
+from powdb.sources.osm import remote as osm
 
 
 def test_only_works():
@@ -205,10 +222,26 @@ def test_unique():
     xs = [object(), object()]
     assert common.unique(xs) == xs
 
+    # Works for mixed hashable and unhashable elements, including those which
+    # compare equal across the two
+    assert common.unique([1, [1], 2, [1], 1]) == [1, [1], 2]
+    assert common.unique([(1, [2]), (1, [2]), (1, 2)]) == [(1, [2]), (1, 2)]
+    assert common.unique([frozenset({1}), {1}]) == [frozenset({1})]
+    assert common.unique([{1}, frozenset({1})]) == [{1}]
+
+    # Works with a key function, keeping the first of each equivalent element
+    records = [{"id": 1, "v": "a"}, {"id": 2, "v": "b"}, {"id": 1, "v": "c"}]
+    assert common.unique(records, by=lambda r: r["id"]) == records[:2]
+    assert common.unique(["a", "B", "A", "b"], by=str.lower) == ["a", "B"]
+    assert common.unique([[1, 2], [1, 3]], by=lambda e: e[:1]) == [[1, 2]]
+
     # Raises type errors where appropriate
     with pytest.raises(TypeError, match="non-iterable type"):
         common.unique(123)
 
+    with pytest.raises(TypeError, match="non-callable key"):
+        common.unique([1, 2], by=1)
+
     with pytest.raises(TypeError, match="non-iterable type"):
         common.unique(None)
 
@@ -319,9 +352,587 @@ def test_eltype():
         ]
     )  # very complex and nested
 
+    # Iterators are typed in a single pass, without being kept
+    def gen():
+        yield from range(10)
+        yield (1, "a")
+        yield from ((i, str(i)) for i in range(10))
+        yield ()
+
+    assert common.eltype(gen()) == int | tuple[int, str] | tuple[()]
+    assert common.eltype(iter([])) is Any
+
+    # Inference can stop early once no new types are seen
+    def ints():
+        yield 1.0
+        while True:
+            yield 1
+
+    assert common.eltype(ints(), stable=100) == float | int
+    x = [1] * 1000 + ["a"]
+    assert common.eltype(x, stable=100) is int
+    assert common.eltype(x, stable=1001) == int | str
+    assert (
+        common.eltype({i: "a" for i in range(1000)}, stable=10)
+        == tuple[int, str]
+    )
+
+    # Unions of types can be built up incrementally, and combined
+    u = common.TypeUnion()
+    assert not u
+    assert u.add(1)
+    assert not u.add(2)
+    assert u.add((1, 2))
+    assert not u.add((3, 4))
+    assert u.add((3, "a"))
+    assert u.type == int | tuple[int, int | str]
+    v = common.TypeUnion().update([(1,), "a"])
+    assert u.merge(v).type == int | str | tuple[int | str, ...]
+    assert len(u) == 7
+
+    # The types of containers are remembered by shape, but only so many
+    classes = [type(f"C{i}", (), {}) for i in range(_MAX_SHAPES + 10)]
+    assert common.eltype([{c()} for c in classes[:2]]) == (
+        set[classes[0]] | set[classes[1]]
+    )
+    common.eltype([{c()} for c in classes])
+    assert len(_SHAPES) <= _MAX_SHAPES
+    assert (set, frozenset({classes[-1]})) in _SHAPES
+
     # TODO: fails on list[int, ...] because who would ever type this?
     # TODO: raises
     # TODO: what is the eltype of
     #       list(tuple[int | str, str]).
     #   it should be type?  or type[tuple[...]]?
     # TODO: copy this function for typeof
+
+
+def test_jsonstream():
+    doc = {
+        "version": 0.6,
+        "osm3s": {"copyright": "ODbL «OSM»"},
+        "elements": [
+            {"type": "node", "id": 1, "lat": -41.2, "lon": 174.7},
+            {"type": "way", "id": 22, "nodes": [1, 2], "tags": {"a": "ā"}},
+            [],
+            123,
+        ],
+        "remark": "runtime error: Query timed out",
+    }
+    raw = json.dumps(doc, ensure_ascii=False).encode()
+
+    # Works regardless of where the chunk boundaries fall, including within
+    # multi-byte characters and numbers
+    for n in (1, 2, 3, 7, len(raw)):
+        chunks = (raw[i : i + n] for i in range(0, len(raw), n))
+        stream = JSONArrayStream(chunks, "elements")
+        assert list(stream) == doc["elements"]
+        assert stream.meta == {k: v for k, v in doc.items() if k != "elements"}
+
+    # Yields elements lazily, before the rest of the stream is read
+    def chunks():
+        yield b'{"elements": [{"id": 1}, '
+        raise AssertionError("Read too far")
+
+    assert next(iter(JSONArrayStream(chunks(), "elements"))) == {"id": 1}
+
+    # Works for empty objects and arrays, and missing keys
+    assert list(JSONArrayStream([b"{}"], "elements")) == []
+    assert list(JSONArrayStream([b'{"elements": []}'], "elements")) == []
+    stream = JSONArrayStream([b'{"a": 1}'], "elements")
+    assert list(stream) == [] and stream.meta == {"a": 1}
+
+    # Raises on truncated or malformed input
+    with pytest.raises(ValueError, match="end of JSON stream"):
+        list(JSONArrayStream([b'{"elements": [1, 2'], "elements"))
+
+    with pytest.raises(ValueError, match="Expected '{'"):
+        list(JSONArrayStream([b"[]"], "elements"))
+
+    with pytest.raises(ValueError, match="after end of JSON"):
+        list(JSONArrayStream([b'{"elements": []}\n', b"  {}"], "elements"))
+
+    # Yields elements of arrays nested within objects, collecting the other
+    # members at each level, and none if the path leads elsewhere
+    raw = (
+        b'{"head": {"vars": ["a"]}, "results": {"distinct": false, '
+        b'"bindings": [{"a": 1}, {"a": 2}], "ordered": true}, "n": 0}'
+    )
+    for n in (1, 5, len(raw)):
+        chunks = (raw[i : i + n] for i in range(0, len(raw), n))
+        stream = JSONArrayStream(chunks, ("results", "bindings"))
+        items = iter(stream)
+        assert next(items) == {"a": 1}
+        assert stream.meta == {
+            "head": {"vars": ["a"]},
+            "results": {"distinct": False},
+        }
+        assert list(items) == [{"a": 2}]
+        assert stream.meta == {
+            "head": {"vars": ["a"]},
+            "results": {"distinct": False, "ordered": True},
+            "n": 0,
+        }
+
+    stream = JSONArrayStream([b'{"results": [1], "a": {}}'], ["results", "x"])
+    assert list(stream) == [] and stream.meta == {"results": [1], "a": {}}
+
+    # Consumes the stream in full, including trailing whitespace
+    chunks = iter([b'{"elements": []}', b"\n", b"\n"])
+    assert list(JSONArrayStream(chunks, "elements")) == []
+    assert next(chunks, None) is None
+
+
+def test_schema():
+    elements = [
+        {
+            "type": "node",
+            "id": 1,
+            "lat": -41.0,
+            "lon": 174.0,
+            "tags": {"name": "A", "religion": "christian"},
+        },
+        {
+            "type": "way",
+            "id": 2,
+            "nodes": [1, 3],
+            "tags": {"name": "B", "religion": "christian;buddhist"},
+        },
+        {"type": "node", "id": 3, "lat": -41.5, "lon": 174.5},
+    ]
+    schema = infer_schema(map(osm_fields, elements))
+    assert schema.n == 3
+    assert list(schema.fields) == [
+        "type",
+        "id",
+        "lat",
+        "lon",
+        "tags.name",
+        "tags.religion",
+        "nodes",
+    ]
+
+    f = schema.fields["lat"]
+    assert f.type is float
+    assert (f.count, f.nulls, f.null_rate) == (2, 1, 1 / 3)
+    assert not f.multivalued
+
+    # Semicolon-separated tags are split into many values
+    f = schema.fields["tags.religion"]
+    assert f.type is str
+    assert f.distinct == 2
+    assert f.multivalued and f.repeated
+    assert schema.fields["nodes"].type is int
+    assert "tags.religion: str (33.3% null, 2 distinct, multi" in str(schema)
+
+    # Records of the schema's layout are slotted and typed
+    Record = schema.record_type("Element")
+    r = Record.decode(osm_fields(elements[1]))
+    assert (r.type, r.id, r.tags_name) == ("way", 2, "B")
+    assert r.tags_religion == ["christian", "buddhist"]
+    assert r.lat is None
+    assert not hasattr(r, "__dict__")
+    assert Record.__annotations__["lat"] == float | None
+    assert Record.__annotations__["tags_religion"] == list[str] | None
+
+    # SPARQL results are decoded by datatype, with a row for each value
+    xsd = "http://www.w3.org/2001/XMLSchema#"
+    bindings = [
+        {
+            "s": {"type": "uri", "value": "A"},
+            "label": {"type": "literal", "value": "A", "xml:lang": "en"},
+            "n": {"type": "literal", "value": "3", "datatype": xsd + "int"},
+        },
+        {
+            "s": {"type": "uri", "value": "A"},
+            "label": {"type": "literal", "value": "Ä", "xml:lang": "de"},
+            "n": {"type": "literal", "value": "x", "datatype": xsd + "int"},
+        },
+        {"s": {"type": "uri", "value": "B"}},
+    ]
+    rows = list(map(sparql_fields, bindings))
+    assert rows[0] == {"s": "A", "label": "A", "label_lang": "en", "n": 3}
+    assert rows[1]["n"] is None
+
+    schema = infer_schema(rows, key="s", fields=["s", "label", "other"])
+    assert schema.fields["label"].multivalued
+    assert not schema.fields["label"].repeated
+    assert not schema.fields["s"].multivalued
+    assert not schema.fields["n"].multivalued
+    assert schema.fields["n"].type is int
+    assert schema.fields["other"].null_rate == 1
+    assert schema.record_type().decode(rows[0]).other is None
+
+    with pytest.raises(ValueError, match="identifiers"):
+        infer_schema([{"a.b": 1, "a_b": 2}]).record_type()
+
+
+def test_bbox():
+    bbox = BBox(-2.0, 10.0, 2.0, 13.0)
+    assert str(bbox) == "-2.0,10.0,2.0,13.0"
+
+    tiles = list(bbox.grid(2, 3))
+    assert len(tiles) == 6
+    assert tiles[0] == BBox(-2.0, 10.0, 0.0, 11.0)
+    assert tiles[-1] == BBox(0.0, 12.0, 2.0, 13.0)
+
+    # Tiles cover the box exactly
+    assert min(t.south for t in tiles) == bbox.south
+    assert max(t.east for t in tiles) == bbox.east
+
+    assert bbox.split() == list(bbox.grid(2, 2))
+    assert list(bbox.grid(1, 1)) == [bbox]
+
+    with pytest.raises(ValueError, match="at least one"):
+        list(bbox.grid(0, 1))
+
+
+def test_cache(tmp_path):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        yield b"hello, "
+        yield b"world"
+
+    def read(cache, query="q", ttl=timedelta(days=1)):
+        with cache.stream("uri", query, fetch, ttl) as chunks:
+            return b"".join(chunks)
+
+    c = Cache(tmp_path)
+
+    # Fetches on first read, and streams from the cache on the next
+    assert read(c) == b"hello, world"
+    assert read(c) == b"hello, world"
+    assert len(calls) == 1
+
+    # Insignificant whitespace in the query doesn't matter
+    assert read(c, "  q \n\n") == b"hello, world"
+    assert len(calls) == 1
+    assert cache.cache_key("uri", "q") == cache.cache_key("uri", "\n  q\n")
+    assert cache.cache_key("uri", "q") != cache.cache_key("uri2", "q")
+
+    # Stale entries are fetched again
+    assert read(c, ttl=timedelta(seconds=-1)) == b"hello, world"
+    assert len(calls) == 2
+
+    # Responses are not cached if the caller raises or does not consume them
+    with pytest.raises(ValueError), c.stream("uri", "q2", fetch, timedelta(1)):
+        raise ValueError
+
+    with c.stream("uri", "q2", fetch, timedelta(1)) as chunks:
+        next(chunks)
+
+    read(c, "q2")
+    assert len(calls) == 4
+
+    # Least recently used entries are evicted to stay within size
+    c.max_bytes = c.size() + 1
+    read(c, "q3")
+    assert len(calls) == 5
+    read(c, "q3")
+    assert len(calls) == 5
+    read(c, "q")
+    assert len(calls) == 6
+
+    c.clear()
+    assert c.size() == 0
+
+    # Disabled cache passes through
+    c = Cache(None)
+    read(c)
+    read(c)
+    assert len(calls) == 8
+
+
+def test_transport():
+    statuses = [503, 429, 200]
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.headers["User-Agent"])
+            status = statuses.pop(0) if statuses else 404
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"hello")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    try:
+        t = transport.Transport(backoff=0.01)
+
+        # Retries transient errors until it succeeds
+        assert b"".join(t.stream("GET", url)) == b"hello"
+        assert len(hits) == 3
+        assert all(ua == transport.USER_AGENT for ua in hits)
+
+        # Does not retry other errors
+        with pytest.raises(requests.HTTPError), t.open("GET", url):
+            pass
+        assert len(hits) == 4
+
+        # Gives up after too many retries
+        statuses[:] = [503] * 10
+        t.retries = 2
+        with pytest.raises(requests.HTTPError, match="503"):
+            list(t.stream("GET", url))
+        assert len(hits) == 4 + 3
+
+        # Waits as long as the server asks, but no longer than the most that
+        # it would back off
+        resp = requests.Response()
+        resp.headers["Retry-After"] = "2"
+        assert t._delay(0, resp) == 2.0
+        resp.headers["Retry-After"] = "86400"
+        assert t._delay(0, resp) == t.max_backoff
+
+        # Limits the rate of requests to a host
+        statuses[:] = [200] * 3
+        t = transport.Transport(rates={"127.0.0.1": 20.0})
+        t0 = time.monotonic()
+        for _ in range(3):
+            list(t.stream("GET", url))
+        assert time.monotonic() - t0 >= 0.1
+    finally:
+        server.shutdown()
+
+
+def test_replay(tmp_path, monkeypatch):
+    recordings = tmp_path / "recordings"
+    overpass_uri, nominatim_uri, dbpedia_uri = (
+        uri for _, uri in replay.SERVICES.values()
+    )
+
+    # Record responses as the cache of a real run would have
+    elements = [{"type": "node", "id": 1, "lat": -41.2, "lon": 174.7}]
+    body = json.dumps({"elements": elements}).encode()
+    q = osm.build_overpass_query(osm.church_query())
+    replay.record(recordings, overpass_uri, q, body)
+    replay.record(recordings, nominatim_uri, "q=NZ&format=jsonv2", b"[1]")
+
+    sparql = "SELECT ?s WHERE { ?s ?p ?o }"
+    uri = dbpedia.build_dbpedia_query(sparql, dbpedia.MIMEType.JSON)
+    uri = uri.replace(dbpedia.DBPEDIA_URI, dbpedia_uri)
+    replay.record(recordings, uri, sparql, b'{"results": {}}')
+
+    def serve(**faults):
+        server = replay.ReplayServer(recordings, replay.Faults(**faults))
+        for module, var in (
+            (osm, "OVERPASS_URI"),
+            (osm, "NOMINATIM_URI"),
+            (dbpedia, "DBPEDIA_URI"),
+        ):
+            monkeypatch.setattr(module, var, server.endpoints[f"POWDB_{var}"])
+        return server
+
+    t = transport.Transport(backoff=0.01)
+    c = Cache(None)
+
+    def fetch():
+        q = osm.church_query()
+        return list(osm.stream_overpass(q, cache=c, transport=t))
+
+    # Replays each service
+    with serve() as server:
+        assert fetch() == elements
+        assert osm.nominatim("NZ", cache=c, transport=t) == [1]
+        assert dbpedia.query_dbpedia(sparql, cache=c, transport=t) == {
+            "results": {}
+        }
+        assert server.requests == {
+            "/api/interpreter": 1,
+            "/search": 1,
+            "/sparql": 1,
+        }
+
+        # Requests without a recording are not found
+        with pytest.raises(requests.HTTPError, match="404"):
+            osm.nominatim("AU", cache=c, transport=t)
+
+    # Injected errors are retried by the transport, and are the same on
+    # every run
+    with serve(errors=2, retry_after=0) as server:
+        assert fetch() == elements
+        assert server.requests["/api/interpreter"] == 3
+
+    def attempts(**faults):
+        with serve(error_rate=0.5, **faults) as server:
+            for _ in range(4):
+                with contextlib.suppress(requests.HTTPError):
+                    fetch()
+            return server.requests["/api/interpreter"]
+
+    t.retries = 0
+    assert attempts(seed=1) == attempts(seed=1)
+    t.retries = 5
+
+    # Bodies are streamed in chunks, and paced to the bandwidth
+    with serve(chunk_size=3, bandwidth=len(body) / 0.2, latency=0.1):
+        t0 = time.monotonic()
+        chunks = list(
+            t.stream("GET", osm.NOMINATIM_URI + "?q=NZ&format=jsonv2")
+        )
+        assert chunks == [b"[1]"]
+        assert fetch() == elements
+        assert time.monotonic() - t0 >= 0.1 + 0.1 + 0.2
+
+    # Truncated responses are not mistaken for complete ones
+    with serve(truncate=0.5), pytest.raises(requests.RequestException):
+        fetch()
+
+    # The transport limits concurrent requests to a host
+    t = transport.Transport(concurrency=2)
+    with serve(latency=0.05) as server:
+        threads = [threading.Thread(target=fetch) for _ in range(6)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        assert server.requests["/api/interpreter"] == 6
+        assert server.max_in_flight == 2
+
+
+def test_metrics():
+    m = metrics.Metrics(trace=True)
+
+    def chunks():
+        for _ in range(3):
+            with m.stage("request"):
+                time.sleep(0.01)
+            yield b"abcd"
+
+    def parse():
+        for chunk in m.timed(chunks(), "transfer", size=len):
+            time.sleep(0.02)
+            yield from chunk
+
+    t0 = time.perf_counter()
+    with m.source("osm"):
+        records = list(m.timed(parse(), "parse"))
+    elapsed = time.perf_counter() - t0
+    assert len(records) == 12
+
+    # Time is counted against the innermost stage only: the stages' times add
+    # up to no more than the time taken (as they would exceed it if nested
+    # stages were counted twice), and transfer excludes the requests within it
+    s = m.summary()["osm"]
+    assert list(s) == ["request", "transfer", "parse"]
+    assert s["request"]["calls"] == 3
+    assert s["request"]["time"] >= 0.03
+    assert s["transfer"]["time"] < s["request"]["time"]
+    assert s["transfer"]["bytes"] == 12
+    assert s["parse"]["time"] >= 0.06
+    assert sum(s[k]["time"] for k in s) <= elapsed
+    assert s["parse"]["records"] == 12
+    assert s["parse"]["records_per_s"] > 0
+    assert s["parse"]["peak_rss"] > 0
+
+    # Work on other threads is attributed to the source of their context
+    def publish():
+        m.add("request", retries=1)
+        with m.stage("publish") as counts:
+            counts["records"] = 5
+
+    with m.source("dbpedia"):
+        ctx = contextvars.copy_context()
+    t = threading.Thread(target=ctx.run, args=(publish,))
+    t.start()
+    t.join()
+    publish()
+
+    s = m.summary()
+    assert s["dbpedia"]["request"]["retries"] == 1
+    assert s["dbpedia"]["publish"]["records"] == 5
+    assert s["-"]["publish"]["records"] == 5
+    assert "dbpedia" in m.report()
+
+    # Traces each block and iterator, by source and thread
+    trace = m.chrome_trace()["traceEvents"]
+    names = {e["args"]["name"] for e in trace if e["ph"] == "M"}
+    assert {"osm", "dbpedia", "-", threading.current_thread().name} <= names
+    events = [e for e in trace if e["ph"] == "X"]
+    assert len(events) == 3 + 1 + 1 + 2
+    assert all(isinstance(e["pid"], int) and e["dur"] >= 0 for e in events)
+
+    m.reset()
+    assert m.summary() == {}
+
+
+def test_profiler(tmp_path):
+    m = metrics.Metrics()
+
+    def busy(seconds):
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < seconds:
+            pass
+        yield 1
+
+    def run():
+        with m.source("osm"):
+            list(m.timed(busy(0.1), "parse"))
+            with m.stage("publish"):
+                list(busy(0.1))
+
+    # Samples the stacks of the chosen stages only, by source
+    m.profiler = profiler.Profiler("sample", ["parse"], interval=0.001)
+    with m.profiler:
+        run()
+
+    (path,) = m.profiler.write(tmp_path / "sample")
+    assert path.name == "osm.collapsed"
+    lines = path.read_text().splitlines()
+    assert len(lines) > 0
+    for line in lines:
+        stack, n = line.rsplit(" ", 1)
+        assert stack.startswith("parse;") and int(n) > 0
+        assert "metrics.py" not in stack
+    assert any(".busy (common_test.py:" in line for line in lines)
+
+    # Profiles every call within the chosen stages
+    m.profiler = profiler.Profiler("cprofile", ["publish"])
+    with m.profiler:
+        run()
+
+    (path,) = m.profiler.write(tmp_path / "cprofile")
+    assert path.name == "osm.prof"
+    stats = pstats.Stats(str(path)).stats
+    assert any(func == "busy" for _, _, func in stats)
+    assert not any(func == "run" for _, _, func in stats)
+
+    # Keeps each source's work in its own profile, though they interleave (as
+    # the store publishes each batch of a source as it arrives)
+    def fetch_step():
+        return list(busy(0.02))
+
+    def publish_step():
+        return list(busy(0.02))
+
+    m.profiler = profiler.Profiler("cprofile", ["parse", "publish"])
+    with m.profiler, m.source("osm"):
+        for _ in m.timed((fetch_step() for _ in range(3)), "parse"):
+            with m.source("store"), m.stage("publish"):
+                publish_step()
+
+    paths = m.profiler.write(tmp_path / "sources")
+    assert sorted(p.name for p in paths) == ["osm.prof", "store.prof"]
+    funcs = {
+        p.stem: {func for _, _, func in pstats.Stats(str(p)).stats}
+        for p in paths
+    }
+    assert "fetch_step" in funcs["osm"] and "publish_step" not in funcs["osm"]
+    assert "publish_step" in funcs["store"]
+    assert "fetch_step" not in funcs["store"]
+
+    with pytest.raises(ValueError, match="Unknown stages"):
+        profiler.Profiler("sample", ["parse", "nonsense"])
+    with pytest.raises(ValueError, match="Unknown profiling mode"):
+        profiler.Profiler("nonsense")
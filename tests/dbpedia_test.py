@@ -0,0 +1,370 @@
+import json
+import time
+from itertools import groupby
+
+import pytest
+
+from powdb.common.cache import Cache
+from powdb.common.schema import sparql_fields
+from powdb.sources.dbpedia import remote
+
+
+def test_paginate_query():
+    q = remote.paginate_query(remote.CHURCH_QUERY, "?building", 100, 300)
+
+    # Prologue stays at the start of the query, and the original query is
+    # ordered within a sub-query
+    assert q.lstrip().startswith("PREFIX dbo:")
+    assert q.index("PREFIX rdfs:") < q.index("SELECT * WHERE {")
+    assert q.index("SELECT * WHERE {") < q.index("SELECT ?building")
+    # Rows are in a total order: by building, then by every other variable
+    variables = "?label ?country ?location ?locationCountry ?address"
+    variables += " ?lat ?long ?denomination"
+    assert f"ORDER BY ?building {variables}\n}}" in q
+    assert q.endswith("LIMIT 100\nOFFSET 300\n")
+
+    q = remote.paginate_query("SELECT DISTINCT ?s ?o {}", "?o", 1, 0)
+    assert "ORDER BY ?o ?s\n}" in q
+    q = remote.paginate_query("SELECT * WHERE {}", "?s", 1, 0)
+    assert "ORDER BY ?s\n}" in q
+
+    with pytest.raises(ValueError, match="SELECT"):
+        remote.paginate_query("ASK { ?s ?p ?o }", "?s", 1, 0)
+
+
+def test_query_pages(monkeypatch):
+    n = 25
+    queries = []
+
+    def fetch_page(query, timeout):
+        queries.append(query)
+        offset = int(query.rsplit("OFFSET ", 1)[1])
+        limit = int(query.rsplit("LIMIT ", 1)[1].split()[0])
+        rows = [(i, None) for i in range(offset, min(offset + limit, n))]
+        return ["i"], rows
+
+    monkeypatch.setattr(remote, "_fetch_page", fetch_page)
+
+    rows = list(remote.query_pages("SELECT ?i {}", "?i", page_size=4))
+    assert sorted(r.i for r in rows) == list(range(n))
+
+    # Stops requesting pages soon after the last
+    assert len(queries) < n // 4 + 1 + 4
+
+    # Works when the number of rows is a multiple of the page size
+    rows = list(remote.query_pages("SELECT ?i {}", "?i", page_size=5))
+    assert len(rows) == n
+
+    # The rows of any one key are yielded together (and in order), even
+    # where they span pages, whatever order the pages arrive in (here, last
+    # first)
+    keys = [0, 0, 1, 1, 1, 1, 1, 1, 1, 2, 3, 3, 4]
+
+    def fetch_page(query, timeout):
+        queries.append(query)
+        offset = int(query.rsplit("OFFSET ", 1)[1])
+        limit = int(query.rsplit("LIMIT ", 1)[1].split()[0])
+        time.sleep(0.02 * max(0, 3 - offset // limit))
+        rows = [(k, j, None, None) for j, k in enumerate(keys)]
+        return ["i", "j"], rows[offset : offset + limit]
+
+    monkeypatch.setattr(remote, "_fetch_page", fetch_page)
+    rows = list(remote.query_pages("SELECT ?i ?j {}", "?i", page_size=3))
+    assert sorted(r.j for r in rows) == list(range(len(keys)))
+    assert sorted(k for k, _ in groupby(r.i for r in rows)) == [0, 1, 2, 3, 4]
+    assert [r.j for r in rows if r.i == 1] == list(range(2, 9))
+
+    # Pages may be ordered by several variables, keyed by the first, but
+    # only by variables (as is checked before any page is fetched)
+    queries.clear()
+    rows = remote.query_pages("SELECT ?i ?j {}", "?i ?j", page_size=3)
+    assert [r.j for r in rows if r.i == 1] == list(range(2, 9))
+    assert "ORDER BY ?i ?j\n}" in queries[0]
+
+    # Errors from any page are raised
+    def fetch_page(query, timeout):
+        raise remote.DBpediaError("Incomplete results")
+
+    monkeypatch.setattr(remote, "_fetch_page", fetch_page)
+    with pytest.raises(remote.DBpediaError):
+        list(remote.query_pages("SELECT ?i {}", "?i"))
+
+    queries.clear()
+    for order_by in ("DESC(?i)", "?i DESC(?j)", ""):
+        with pytest.raises(ValueError, match="only order pages by variables"):
+            next(remote.query_pages("SELECT ?i ?j {}", order_by))
+    assert queries == []
+
+    # Pages yet to be fetched are cancelled if the caller stops early
+    queries.clear()
+
+    def fetch_page(query, timeout):
+        queries.append(query)
+        return ["i"], [(i, None) for i in range(4)]
+
+    monkeypatch.setattr(remote, "_fetch_page", fetch_page)
+    rows = remote.query_pages("SELECT ?i {}", "?i", page_size=4, workers=1)
+    next(rows)
+    rows.close()
+    assert len(queries) <= 2
+
+
+def test_normalise(monkeypatch):
+    def uri(v):
+        return {"type": "uri", "value": v}
+
+    def literal(v, **kw):
+        return {"type": "literal", "value": v, **kw}
+
+    def xsd_float(v):
+        return literal(v, datatype="http://www.w3.org/2001/XMLSchema#float")
+
+    a, b = "http://dbpedia.org/resource/A", "http://dbpedia.org/resource/B"
+    rows = [
+        {"building": uri(a), "label": literal("A (de)", **{"xml:lang": "de"})},
+        {
+            "building": uri(a),
+            "label": literal("A", **{"xml:lang": "en"}),
+            "lat": xsd_float("-41.5"),
+            "long": xsd_float("174.25"),
+            "country": uri("http://dbpedia.org/resource/New_Zealand"),
+        },
+        {"building": uri(b), "lat": xsd_float("not a number")},
+    ]
+    variables = ["building", "label", "lat", "long", "denomination", "country"]
+    variables += ["location", "locationCountry", "address"]
+    rows = list(map(sparql_fields, rows))
+    row = remote.row_type(variables, rows, "building")
+
+    places = list(remote.normalise(map(row.decode, rows)))
+    assert [p.id for p in places] == [a, b]
+
+    # Prefers English names, but keeps all others
+    assert places[0].source == "dbpedia"
+    assert places[0].name == "A"
+    assert places[0].tags["name:de"] == "A (de)"
+    assert places[0].tags["name:en"] == "A"
+    assert (places[0].lat, places[0].lon) == (-41.5, 174.25)
+    assert places[0].tags["country"].endswith("New_Zealand")
+
+    assert places[1].name is None
+    assert places[1].lat is None
+
+    assert list(remote.normalise([])) == []
+
+    # A building whose rows span pages is still one place, whichever of its
+    # pages arrives first (here, a page per row, with A's pages arriving
+    # first and third)
+    fields = [*variables, *(f"{v}_lang" for v in variables)]
+    z = {"building": "http://dbpedia.org/resource/Z"}
+    table = [tuple(map(r.get, fields)) for r in [*rows, z]]
+
+    def fetch_page(query, timeout):
+        offset = int(query.rsplit("OFFSET ", 1)[1])
+        time.sleep({0: 0.04, 2: 0.06, 3: 0.02}.get(offset, 0))
+        return variables, table[offset : offset + 1]
+
+    monkeypatch.setattr(remote, "_fetch_page", fetch_page)
+    rows = remote.query_pages(remote.CHURCH_QUERY, "?building", page_size=1)
+    places = list(remote.normalise(rows))
+    assert sorted(p.id for p in places) == [a, b, z["building"]]
+    places = {p.id: p for p in places}
+    assert places[a].name == "A"
+    assert places[a].tags["name:de"] == "A (de)"
+    assert places[a].lat == -41.5
+
+
+def test_decode():
+    a = "http://dbpedia.org/resource/A"
+    xsd = "http://www.w3.org/2001/XMLSchema#"
+    header = ("building", "label", "lat", "n")
+
+    tsv = (
+        "?building\t?label\t?lat\t?n\n"
+        f'<{a}>\t"A \\"\\u00e9\\"\\tb"@en\t"-41.5"^^<{xsd}float>\t3\n'
+        f'<{a}>\t"A (de)"@de\t\t\n'
+        f'<{a}>\t"A"\t"x"^^<{xsd}float>\t"1.5e1"^^<{xsd}double>\n'
+    ).encode()
+    rows = [
+        header,
+        (a, 'A "\u00e9"\tb', -41.5, 3, None, "en", None, None),
+        (a, "A (de)", None, None, None, "de", None, None),
+        # Malformed typed literals are unbound
+        (a, "A", None, 15.0, None, None, None, None),
+    ]
+
+    # Rows are the same however the response is split into chunks
+    assert list(remote.decode_tsv([tsv])) == rows
+    assert (
+        list(remote.decode_tsv(tsv[i : i + 1] for i in range(len(tsv)))) == rows
+    )
+
+    # As are those of other formats, where they keep the same information
+    bindings = [
+        {
+            "building": {"type": "uri", "value": a},
+            "label": {
+                "type": "literal",
+                "value": 'A "\u00e9"\tb',
+                "xml:lang": "en",
+            },
+            "lat": {
+                "type": "typed-literal",
+                "value": "-41.5",
+                "datatype": xsd + "float",
+            },
+            "n": {
+                "type": "typed-literal",
+                "value": "3",
+                "datatype": xsd + "integer",
+            },
+        },
+        {
+            "building": {"type": "uri", "value": a},
+            "label": {"type": "literal", "value": "A (de)", "xml:lang": "de"},
+        },
+        {
+            "building": {"type": "uri", "value": a},
+            "label": {"type": "literal", "value": "A"},
+            "lat": {
+                "type": "typed-literal",
+                "value": "x",
+                "datatype": xsd + "float",
+            },
+            "n": {
+                "type": "typed-literal",
+                "value": "1.5e1",
+                "datatype": xsd + "double",
+            },
+        },
+    ]
+    result = {"head": {"vars": list(header)}, "results": {"bindings": bindings}}
+    raw = json.dumps(result).encode()
+    chunks = (raw[i : i + 5] for i in range(0, len(raw), 5))
+    assert list(remote.decode_json(chunks)) == rows
+    assert list(remote.decode_json([raw])) == rows
+
+    # JSON is decoded a row at a time, as it arrives
+    def chunks():
+        yield raw[: raw.index(b"}}, {") + 3]
+        raise AssertionError("Read too far")
+
+    decoded = remote.decode_json(chunks())
+    assert [next(decoded), next(decoded)] == rows[:2]
+
+    # Even if the head comes after the results (when they are held until then)
+    result = {"results": {"bindings": bindings}, "head": {"vars": list(header)}}
+    assert list(remote.decode_json([json.dumps(result).encode()])) == rows
+    result = {"results": {"bindings": []}, "head": {"vars": ["a"]}}
+    assert list(remote.decode_json([json.dumps(result).encode()])) == [("a",)]
+
+    xml = (
+        '<?xml version="1.0"?>'
+        '<sparql xmlns="http://www.w3.org/2005/sparql-results#"><head>'
+        + "".join(f'<variable name="{v}"/>' for v in header)
+        + "</head><results>"
+        f'<result><binding name="building"><uri>{a}</uri></binding>'
+        '<binding name="label"><literal xml:lang="en">A "&#233;"&#9;b'
+        "</literal></binding>"
+        f'<binding name="lat"><literal datatype="{xsd}float">-41.5</literal>'
+        f'</binding><binding name="n"><literal datatype="{xsd}integer">3'
+        "</literal></binding></result>"
+        f'<result><binding name="building"><uri>{a}</uri></binding>'
+        '<binding name="label"><literal xml:lang="de">A (de)</literal>'
+        "</binding></result>"
+        f'<result><binding name="building"><uri>{a}</uri></binding>'
+        '<binding name="label"><literal>A</literal></binding>'
+        f'<binding name="lat"><literal datatype="{xsd}float">x</literal>'
+        f'</binding><binding name="n"><literal datatype="{xsd}double">1.5e1'
+        "</literal></binding></result>"
+        "</results></sparql>"
+    ).encode()
+    assert (
+        list(remote.decode_xml(xml[i : i + 7] for i in range(0, len(xml), 7)))
+        == rows
+    )
+
+    # CSV keeps only values, as strings, which may span lines
+    csv = f'building,label,lat,n\r\n{a},"A\r\n""B""",-41.5,\r\n'.encode()
+    assert list(remote.decode_csv([csv[:30], csv[30:]])) == [
+        header,
+        (a, 'A\r\n"B"', "-41.5", None, None, None, None, None),
+    ]
+
+    # Values all written as quoted strings (as by Virtuoso) are decoded
+    tsv = f'"building"\t"n"\n"{a}"\t"3"\n'.encode()
+    assert list(remote.decode_tsv([tsv])) == [
+        ("building", "n"),
+        (a, "3", None, None),
+    ]
+
+    # Rows with missing values are malformed
+    with pytest.raises(remote.DBpediaError, match="Expected 2 values"):
+        list(remote.decode_tsv([b"?a\t?b\n<x>\n"]))
+    with pytest.raises(remote.DBpediaError, match="Empty"):
+        list(remote.decode_tsv([]))
+
+
+def test_query_rows(monkeypatch):
+    uris = []
+
+    def get(uri, transport):
+        uris.append(uri)
+        yield b"?s\n<a>\n"
+        yield b"<b>\n"
+
+    monkeypatch.setattr(remote, "_get", get)
+
+    # Rows are decoded from the format requested
+    rows = remote.query_rows("SELECT ?s {}", remote.MIMEType.TSV, Cache(None))
+    assert list(rows) == [("s",), ("a", None), ("b", None)]
+    assert "format=text%2Ftab-separated-values" in uris[0]
+
+    with pytest.raises(ValueError, match="Cannot decode"):
+        next(remote.query_rows("SELECT ?s {}", remote.MIMEType.HTML))
+
+    # Virtuoso writes TSV with every value quoted, losing the languages and
+    # datatypes of literals, so such results are requested again as JSON (as
+    # they are by default), from which English names can be told apart
+    a = "http://dbpedia.org/resource/A"
+    variables = ["building", "label", "lat", "long", "denomination", "country"]
+    variables += ["location", "locationCountry", "address"]
+    tsv = "\t".join(f'"{v}"' for v in variables) + "\n"
+    tsv += f'"{a}"\t"A (de)"\t"-41.5"\t"174.25"' + "\t" * 5 + "\n"
+    tsv += f'"{a}"\t"A"\t"-41.5"\t"174.25"' + "\t" * 5 + "\n"
+    label = {"type": "literal", "value": "A (de)", "xml:lang": "de"}
+    lat = {"type": "typed-literal", "value": "-41.5"}
+    lat["datatype"] = "http://www.w3.org/2001/XMLSchema#float"
+    bindings = [
+        {"building": {"type": "uri", "value": a}, "label": label, "lat": lat},
+        {
+            "building": {"type": "uri", "value": a},
+            "label": label | {"value": "A", "xml:lang": "en"},
+        },
+    ]
+    result = {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+    def get(uri, transport):
+        uris.append(uri)
+        yield json.dumps(result).encode() if "json" in uri else tsv.encode()
+
+    monkeypatch.setattr(remote, "_get", get)
+    uris.clear()
+    q = "SELECT ?building {}"
+    rows = list(remote.query_rows(q, remote.MIMEType.TSV, Cache(None)))
+    assert len(uris) == 2 and "format=application%2Fjson" in uris[1]
+    assert rows == list(remote.query_rows(q, cache=Cache(None)))
+
+    fields = [*variables, *(f"{v}_lang" for v in variables)]
+    records = [dict(zip(fields, r, strict=True)) for r in rows[1:]]
+    row = remote.row_type(variables, records, "building")
+    (place,) = remote.normalise(row(*r) for r in rows[1:])
+    assert place.name == "A"
+    assert place.tags["name:de"] == "A (de)"
+    assert place.lat == -41.5
+
+    # Whereas the quoted TSV alone would lose them
+    rows = list(remote.decode_tsv([tsv.encode()]))
+    assert rows[1][len(variables) + 1] is None
+    with pytest.raises(remote.LossyResultsError):
+        next(remote.decode_tsv([tsv.encode()], quoted=False))
@@ -0,0 +1,326 @@
+import json
+import math
+import random
+
+import pytest
+
+from powdb.common.geo import haversine
+from powdb.common.record import Place
+from powdb.linkage import (
+    GridIndex,
+    NameIndex,
+    Polygon,
+    candidate_pairs,
+    link,
+    load_regions,
+    normalise_name,
+    place_names,
+)
+from powdb.store import Counts, PlaceTable
+
+
+def _points(rng, n):
+    # Clustered around New Zealand, including across the antimeridian
+    lats = [rng.uniform(-48, -34) for _ in range(n)]
+    lons = [(rng.uniform(165, 185) + 180) % 360 - 180 for _ in range(n)]
+    return lats, lons
+
+
+def test_haversine():
+    assert haversine(0, 0, 0, 0) == 0
+    assert haversine(0, 0, 1, 0) == pytest.approx(111_195, rel=1e-3)
+    assert haversine(0, 179.5, 0, -179.5) == pytest.approx(111_195, rel=1e-3)
+
+    # Wellington to Auckland
+    d = haversine(-41.2865, 174.7762, -36.8485, 174.7633)
+    assert d == pytest.approx(493_400, rel=1e-2)
+
+
+def test_grid_index():
+    rng = random.Random(0)
+    lats, lons = _points(rng, 2000)
+    lats.append(math.nan)
+    lons.append(0.0)
+    index = GridIndex(lats, lons, cell=5_000)
+    assert len(index) == 2000
+
+    def brute(lat, lon):
+        return sorted(
+            (haversine(lat, lon, a, b), i)
+            for i, (a, b) in enumerate(zip(lats, lons, strict=True))
+            if not math.isnan(a)
+        )
+
+    for lat, lon in [*zip(*_points(rng, 20), strict=True), (-44.0, 180.0)]:
+        expected = brute(lat, lon)
+
+        # Finds exactly the points within a radius, nearest first
+        for radius in (1_000, 20_000, 100_000):
+            got = index.within(lat, lon, radius)
+            assert got == [(d, i) for d, i in expected if d <= radius]
+
+        # Finds the k nearest points, however far away they are
+        for k in (1, 5, 50):
+            assert index.nearest(lat, lon, k) == expected[:k]
+
+    assert index.nearest(0, 0, k=0) == []
+    assert len(index.nearest(0, 0, k=5000)) == 2000
+    assert GridIndex([], []).nearest(0, 0) == []
+
+    with pytest.raises(ValueError, match="as many"):
+        GridIndex([1.0], [])
+
+
+def test_candidate_pairs():
+    rng = random.Random(1)
+    left, right = _points(rng, 500), _points(rng, 500)
+    radius = 10_000
+
+    pairs = list(candidate_pairs(left, right, radius))
+    expected = [
+        (i, j)
+        for i, (a, b) in enumerate(zip(*left, strict=True))
+        for j, (c, d) in enumerate(zip(*right, strict=True))
+        if haversine(a, b, c, d) <= radius
+    ]
+    assert sorted((i, j) for i, j, _ in pairs) == sorted(expected)
+    assert all(d <= radius for _, _, d in pairs)
+
+    # Works with a prebuilt index
+    index = GridIndex(*right, cell=radius)
+    assert list(candidate_pairs(left, index, radius)) == pairs
+
+
+def test_names():
+    assert normalise_name("St Paul's Cathedral") == "saint pauls cathedral"
+    assert (
+        normalise_name("  Saint Paul’s Cathédrale,  Wellington ")
+        == "saint pauls cathedrale wellington"
+    )
+    assert normalise_name("Sts Peter & Paul") == "saints peter and paul"
+    assert normalise_name("Église Sainte-Anne") == "eglise sainte anne"
+    assert normalise_name("...") == ""
+
+    p = Place(
+        "dbpedia",
+        "x",
+        name="St Mary's",
+        tags={
+            "name:en": "Saint Mary's",
+            "alt_name": "Old St Mary's;",
+            "x": "y",
+        },
+    )
+    assert place_names(p) == ["saint marys", "old saint marys"]
+    assert place_names(Place("osm", "y")) == []
+
+
+def test_name_index():
+    rng = random.Random(2)
+    words = ["saint", "church", "cathedral", "chapel", "mary", "paul"]
+    words += ["peter", "john", "of", "the", "holy", "trinity", "wellington"]
+    names = [
+        [" ".join(rng.choices(words, k=rng.randint(1, 4)))] for _ in range(300)
+    ]
+    index = NameIndex(names)
+
+    # Finds exactly the names that are similar enough, however rare
+    for query in ["saint paul cathedral", "holy trinity", "mary", "xyz"]:
+        for threshold in (0.3, 0.6, 0.9, 1.0):
+            expected = {
+                i: index.similarity(query, n[0])
+                for i, n in enumerate(names)
+                if index.similarity(query, n[0]) >= threshold
+            }
+            assert index.search([query], threshold) == expected
+
+    # Common words count for less than rarer ones
+    index = NameIndex(
+        [normalise_name(f"St {n}'s {kind}"), f"{kind} wellington"]
+        for n in ["paul", "peter", "mary", "john", "luke"]
+        for kind in ["church", "cathedral", "chapel"]
+    )
+    paul = normalise_name("St Paul's Cathedral")
+    assert index.similarity(paul, paul) == 1
+    assert (
+        index.similarity(paul, "saint pauls cathedral wellington")
+        > index.similarity(paul, "saint pauls church")
+        > index.similarity(paul, "saint peters cathedral")
+        > index.similarity(paul, "cathedral")
+    )
+
+    with pytest.raises(ValueError, match="Threshold"):
+        index.search(["x"], 0)
+
+
+def test_link():
+    osm = [
+        Place("osm", "node/1", "St Paul's Cathedral", -41.2776, 174.7756),
+        Place("osm", "node/2", "St Mary's Church", -41.3, 174.8),
+        Place("osm", "node/3", "St Mary's Church", -36.9, 174.8),
+        Place("osm", "node/4", None, -41.3, 174.8),
+        Place("osm", "node/5", "St Peter's Church"),
+    ]
+    dbpedia = [
+        Place(
+            "dbpedia",
+            "Wellington_Cathedral_of_St_Paul",
+            "Wellington Cathedral of St Paul",
+            -41.2775,
+            174.7757,
+            tags={"name:en": "Saint Paul's Cathedral, Wellington"},
+        ),
+        Place("dbpedia", "St_Mary's", "Saint Mary's Church", -41.3, 174.8),
+        Place("dbpedia", "Other", "Holy Trinity Church", -41.3, 174.8),
+        Place("dbpedia", "St_Peter's", "Saint Peter's Church"),
+    ]
+
+    # By name alone, anywhere
+    pairs = {(i, j) for i, j, _ in link(osm, dbpedia)}
+    assert pairs == {(0, 0), (1, 1), (2, 1), (4, 3)}
+
+    # Only nearby places, which must have coordinates
+    links = link(osm, dbpedia, radius=1000)
+    assert [(i, j) for i, j, _ in links] == [(0, 0), (1, 1)]
+    assert all(0.6 <= score <= 1 for _, _, score in links)
+
+
+def _contains(rings, lat, lon):
+    # Whether a point is in a polygon, by testing every edge
+    inside = False
+    for ring in rings:
+        for (ax, ay), (bx, by) in zip(ring, ring[1:], strict=False):
+            if (ay > lat) != (by > lat) and (
+                lon < ax + (lat - ay) * (bx - ax) / (by - ay)
+            ):
+                inside = not inside
+    return inside
+
+
+def test_polygon():
+    square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+    p = Polygon([square, hole])
+    assert p.bbox == (0, 0, 10, 10)
+    assert (2, 2) in p
+    assert (5, 5) not in p
+    assert (5, 11) not in p
+    assert (-1, 5) not in p
+
+    # Parts of a multipolygon are in it alike
+    p = Polygon.from_geojson(
+        {
+            "type": "MultiPolygon",
+            "coordinates": [[square], [[[20, 0], [30, 0], [25, 5], [20, 0]]]],
+        }
+    )
+    assert (2, 25) in p and (2, 5) in p
+    assert (4, 21) not in p
+
+    # Points at the latitude of a horizontal edge, beyond its end
+    outer = [(-5, -5), (5, -5), (5, 5), (-5, 5)]
+    p = Polygon([[(0, 0), (1, 0), (1, 1), (0, 1)], outer])
+    assert (0.0, 1.7) in p and (1.0, 1.7) in p and (0.0, 3.0) in p
+    assert (0.0, -2.0) in p and (0.5, 0.5) not in p
+
+    # And near the diagonal of the bounding box, along which an edge may run
+    p = Polygon([outer[:3]])
+    assert (-1.4, -1.3) in p and (-1.3, -1.4) not in p
+
+    with pytest.raises(ValueError, match="Not a polygon"):
+        Polygon.from_geojson({"type": "Point", "coordinates": [0, 0]})
+    with pytest.raises(ValueError, match="no edges"):
+        Polygon([[[0, 0], [0, 0]]])
+
+    # A winding boundary, as of a coastline (with an island), agrees with
+    # testing every edge
+    rng = random.Random(0)
+    ring, r = [], 1.0
+    for k in range(500):
+        r = min(1.5, max(0.5, r + rng.gauss(0, 0.1)))
+        a = 2 * math.pi * k / 500
+        ring.append([174 + r * math.cos(a), -41 + r * math.sin(a)])
+    ring.append(ring[0])
+    island = [[176, -41], [176.1, -41], [176.1, -40.9], [176, -41]]
+    rings = [ring, island]
+    p = Polygon(rings)
+    lats, lons = _points(rng, 5000)
+    for lat, lon in zip(lats, lons, strict=True):
+        assert ((lat, lon) in p) == _contains(rings, lat, lon)
+
+
+def test_regions(tmp_path):
+    def feature(name, ring):
+        return {
+            "type": "Feature",
+            "properties": {"REGC2023_V1_00_NAME": name, "AREA": 1},
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+        }
+
+    # Two regions sharing a border at 175°E, and an unnamed patch of sea
+    west = [[174, -42], [175, -42], [175, -41], [174, -41], [174, -42]]
+    east = [[175, -42], [176, -42], [176, -41], [175, -41], [175, -42]]
+    path = tmp_path / "regions.geojson"
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    feature("Wellington", west),
+                    feature("Hawke's Bay", east),
+                    {"type": "Feature", "properties": {}, "geometry": None},
+                ],
+            }
+        )
+    )
+
+    # Named by Stats NZ's property, unless told otherwise
+    index = load_regions(path)
+    assert len(index) == 2
+    assert index.locate(-41.5, 174.5) == "Wellington"
+    assert index.locate(-41.5, 175.5) == "Hawke's Bay"
+    assert index.locate(-40.0, 174.5) is None
+    assert index.locate(math.nan, 174.5) is None
+    with pytest.raises(ValueError, match="Feature None has no name"):
+        load_regions(path, name="name")
+
+    # Places are assigned in bulk, as a column to count them by
+    places = [
+        Place("osm", "node/1", lat=-41.28, lon=174.78, religion="christian"),
+        Place("osm", "node/2", lat=-41.6, lon=175.6, religion="christian"),
+        Place("osm", "node/3", religion="muslim"),
+        Place("osm", "node/4", lat=-36.85, lon=174.76, religion="hindu"),
+    ]
+    table = PlaceTable(places)
+    regions = index.assign(table.lat, table.lon)
+    assert list(regions) == ["Wellington", "Hawke's Bay", None, None]
+    assert regions.categories == ["Wellington", "Hawke's Bay"]
+    counts = Counts()
+    counts.update(table, region=regions)
+    assert counts.by("region", "religion") == {
+        ("Wellington", "christian"): 1,
+        ("Hawke's Bay", "christian"): 1,
+        (None, "muslim"): 1,
+        (None, "hindu"): 1,
+    }
+
+    # Points are assigned as one at a time, and as by testing every region
+    rng = random.Random(0)
+    lats = [rng.uniform(-42.5, -40.5) for _ in range(2000)]
+    lons = [rng.uniform(173.5, 176.5) for _ in range(2000)]
+    assigned = index.assign(lats, lons)
+    for lat, lon, region in zip(lats, lons, assigned, strict=True):
+        assert region == index.locate(lat, lon)
+        expected = [
+            name
+            for name, ring in (("Wellington", west), ("Hawke's Bay", east))
+            if _contains([ring], lat, lon)
+        ]
+        assert [region] == (expected or [None])
+
+    with pytest.raises(ValueError, match="as many latitudes"):
+        index.assign([0.0], [])
+
+    path.write_text(json.dumps({"type": "Feature"}))
+    with pytest.raises(ValueError, match="Not a GeoJSON FeatureCollection"):
+        load_regions(path)
@@ -0,0 +1,536 @@
+import json
+import lzma
+import threading
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+from powdb.common.geo import BBox
+from powdb.common.record import Place
+from powdb.sources import Source
+from powdb.sources.osm import geometry, history, pbf, remote, source, tiles
+
+
+def test_normalise():
+    elements = [
+        {
+            "type": "node",
+            "id": 1,
+            "lat": -41.28,
+            "lon": 174.78,
+            "tags": {
+                "amenity": "place_of_worship",
+                "name": "St Paul's",
+                "religion": "christian",
+                "denomination": "anglican",
+            },
+        },
+        # Skeleton nodes are not places in themselves
+        {"type": "node", "id": 2, "lat": -41.0, "lon": 174.0},
+        {"type": "way", "id": 3, "nodes": [2], "tags": {"name": "Temple"}},
+    ]
+
+    places = list(remote.normalise(elements))
+    assert [p.id for p in places] == ["node/1", "way/3"]
+    assert places[0].source == "osm"
+    assert places[0].key == ("osm", "node/1")
+    assert places[0].name == "St Paul's"
+    assert places[0].religion == "christian"
+    assert places[0].denomination == "anglican"
+    assert (places[0].lat, places[0].lon) == (-41.28, 174.78)
+    assert places[0].tags["amenity"] == "place_of_worship"
+    assert places[1].religion is None
+
+    # Ways are located by their nodes
+    assert (places[1].lat, places[1].lon) == (-41.0, 174.0)
+
+
+def test_collapse():
+    elements = [
+        # Tagged elements, as from `out meta`
+        {"type": "node", "id": 1, "lat": 1.0, "lon": 1.0, "tags": {"a": "b"}},
+        # A closed square way
+        {"type": "way", "id": 10, "nodes": [2, 3, 4, 5, 2], "tags": {}},
+        {"type": "way", "id": 11, "nodes": [2, 3, 4, 5, 2], "tags": {"a": "b"}},
+        # A multipolygon, whose outer ring is split across two ways
+        {
+            "type": "relation",
+            "id": 20,
+            "members": [
+                {"type": "way", "ref": 12, "role": "outer"},
+                {"type": "way", "ref": 13, "role": "outer"},
+                {"type": "way", "ref": 11, "role": "inner"},
+            ],
+            "tags": {"type": "multipolygon"},
+        },
+        # A relation of a node and a way, one of which is missing
+        {
+            "type": "relation",
+            "id": 21,
+            "members": [
+                {"type": "node", "ref": 1, "role": ""},
+                {"type": "way", "ref": 99, "role": ""},
+                {"type": "relation", "ref": 20, "role": ""},
+            ],
+            "tags": {"a": "b"},
+        },
+        # A way whose nodes were not returned
+        {"type": "way", "id": 14, "nodes": [98, 99], "tags": {"a": "b"}},
+        # Skeleton elements, as from `>; out skel qt;`
+        {"type": "node", "id": 2, "lat": 0.0, "lon": 0.0},
+        {"type": "node", "id": 3, "lat": 0.0, "lon": 2.0},
+        {"type": "node", "id": 4, "lat": 2.0, "lon": 2.0},
+        {"type": "node", "id": 5, "lat": 2.0, "lon": 0.0},
+        {"type": "node", "id": 6, "lat": -4.0, "lon": -4.0},
+        {"type": "node", "id": 7, "lat": 4.0, "lon": 4.0},
+        {"type": "way", "id": 11, "nodes": [2, 3, 4, 5, 2]},
+        {"type": "way", "id": 12, "nodes": [6, 3, 7]},
+        {"type": "way", "id": 13, "nodes": [7, 5, 6]},
+    ]
+
+    # Only tagged elements are kept, with ways and relations located
+    out = {(e["type"], e["id"]): e for e in geometry.collapse(elements)}
+    assert list(out) == [
+        ("node", 1),
+        ("way", 11),
+        ("relation", 20),
+        ("relation", 21),
+        ("way", 14),
+    ]
+    assert "center" not in out["node", 1]
+
+    # Closing nodes are not counted twice
+    assert out["way", 11]["center"] == {"lat": 1.0, "lon": 1.0}
+    assert out["way", 11]["bounds"] == {
+        "minlat": 0.0,
+        "minlon": 0.0,
+        "maxlat": 2.0,
+        "maxlon": 2.0,
+    }
+
+    # Nor are nodes shared by the ways of a relation, and inner ways are not
+    # counted at all
+    assert out["relation", 20]["center"] == {"lat": 0.5, "lon": 0.5}
+    assert out["relation", 20]["bounds"]["minlat"] == -4.0
+    assert out["relation", 20]["bounds"]["maxlon"] == 4.0
+
+    # Missing members are ignored
+    assert out["relation", 21]["center"] == {"lat": 1.0, "lon": 1.0}
+    assert "center" not in out["way", 14]
+
+    places = {p.id: p for p in remote.normalise(elements)}
+    assert (places["relation/20"].lat, places["relation/20"].lon) == (0.5, 0.5)
+    assert places["way/14"].lat is None
+
+
+def test_church_query():
+    q = remote.church_query("AU", BBox(-1.0, 2.0, 3.5, 4.0))
+    assert 'area["ISO3166-1"="AU"]' in q
+    assert 'node["amenity"="place_of_worship"](area.a)(-1.0,2.0,3.5,4.0);' in q
+    assert (
+        'node["amenity"="place_of_worship"](area.a);' in remote.church_query()
+    )
+
+    # Places are selected by the same tags as from a PBF extract
+    assert (
+        'way["building"~"^(cathedral|chapel|church|kingdom_hall|monastery|'
+        'mosque|religious|shrine|synagogue|temple)$"](area.a);'
+    ) in remote.church_query()
+    assert 'relation["historic"="church"](area.a);' in remote.church_query()
+    assert "presbytery" not in remote.church_query()
+
+
+def test_build_overpass_query():
+    q = remote.build_overpass_query("node(1);\nout;", timeout=25)
+    assert q.startswith("[out:json][timeout:25];\n")
+    assert q.endswith("node(1);\nout;")
+
+
+def test_harvest_tiles(monkeypatch):
+    # A way spanning every tile, and a node unique to each tile
+    def fetch_tile(country, tile, since, timeout):
+        if tile.north - tile.south > 1:
+            raise remote.OverpassError("runtime error: Query timed out")
+
+        node = {"type": "node", "id": hash(tile), "lat": tile.south}
+        return [{"type": "way", "id": 1}, node], {"tile": tile}
+
+    monkeypatch.setattr(tiles, "_fetch_tile", fetch_tile)
+
+    # Tiles too large to be answered are split until they succeed
+    bbox = BBox(0.0, 0.0, 4.0, 4.0)
+    meta = []
+    elements = list(tiles.harvest(bbox, rows=2, cols=2, workers=3, meta=meta))
+    assert elements.count({"type": "way", "id": 1}) == 1
+    assert len(elements) == 1 + 16
+    assert len(meta) == 16
+
+    # Unless they reach the maximum depth, at which point we give up
+    with pytest.raises(remote.OverpassError, match="timed out"):
+        list(tiles.harvest(bbox, rows=1, cols=1, max_depth=1))
+
+    # Other errors are not retried
+    def fetch_tile(country, tile, since, timeout):
+        raise remote.OverpassError("runtime error: something else")
+
+    monkeypatch.setattr(tiles, "_fetch_tile", fetch_tile)
+    with pytest.raises(remote.OverpassError, match="something else"):
+        list(tiles.harvest(bbox))
+
+    # Nor is failing to connect, which smaller tiles would not help
+    fetched = []
+
+    def fetch_tile(country, tile, since, timeout):
+        fetched.append(tile)
+        raise requests.ConnectTimeout("unreachable")
+
+    monkeypatch.setattr(tiles, "_fetch_tile", fetch_tile)
+    with pytest.raises(requests.ConnectTimeout):
+        list(tiles.harvest(bbox, rows=2, cols=2, workers=1))
+    assert len(fetched) <= 4
+
+    # Countries spanning the antimeridian are tiled in every box, with small
+    # boxes split no more finely than large ones
+    fetched.clear()
+
+    def fetch_tile(country, tile, since, timeout):
+        fetched.append(tile)
+        return [], {}
+
+    monkeypatch.setattr(tiles, "_fetch_tile", fetch_tile)
+    assert list(tiles.harvest(rows=4, cols=4)) == []
+    assert len(fetched) == 16 + 2
+    for lat, lon in [(-41.29, 174.78), (-43.95, -176.56), (-29.27, -177.92)]:
+        assert any(
+            t.south <= lat <= t.north and t.west <= lon <= t.east
+            for t in fetched
+        )
+
+    # Tiles yet to be fetched are cancelled if the caller stops early
+    fetched = []
+
+    def fetch_tile(country, tile, since, timeout):
+        fetched.append(tile)
+        return [{"type": "node", "id": hash(tile)}], {}
+
+    monkeypatch.setattr(tiles, "_fetch_tile", fetch_tile)
+    elements = tiles.harvest(bbox, rows=4, cols=4, workers=1)
+    next(elements)
+    elements.close()
+    assert len(fetched) <= 2
+
+
+def test_source(monkeypatch):
+    queries = []
+
+    def stream_overpass(query, meta):
+        queries.append(query)
+        meta["osm3s"] = {"timestamp_osm_base": "2025-06-01T00:00:00Z"}
+        yield {"type": "node", "id": 1, "tags": {"name": "Temple"}}
+
+    monkeypatch.setattr(source, "stream_overpass", stream_overpass)
+
+    src = source.OSM()
+    assert isinstance(src, Source)
+    assert src.watermark is None
+
+    places = list(src.fetch())
+    assert [p.name for p in places] == ["Temple"]
+    assert src.watermark == "2025-06-01T00:00:00Z"
+    assert "newer" not in queries[-1]
+
+    list(src.fetch(since=src.watermark))
+    assert '(newer:"2025-06-01T00:00:00Z")' in queries[-1]
+
+
+def test_history(tmp_path):
+    # Nodes 1 to 5 were created in changesets 10 and 11 (except node 4, which
+    # never existed), and the first version of node 3 has been redacted
+    created = {1: 10, 2: 11, 3: 10, 5: 11}
+    requests_made = []
+    changeset_batches = []
+    lock = threading.Lock()
+
+    class Transport:
+        def stream(self, method, uri):
+            url = urlsplit(uri)
+            with lock:
+                requests_made.append(url.path.rsplit("/", 1)[-1])
+
+            def error(status):
+                resp = requests.Response()
+                resp.status_code = status
+                return requests.HTTPError(response=resp)
+
+            q = {k: v[0].split(",") for k, v in parse_qs(url.query).items()}
+            if url.path.endswith("/nodes.json"):
+                ids = [int(i.removesuffix("v1")) for i in q["nodes"]]
+                if 4 in ids:
+                    raise error(404)
+                if 3 in ids:
+                    raise error(403)
+                body = {"elements": [version(i, 1) for i in ids]}
+            elif url.path.endswith("/history.json"):
+                id_ = int(url.path.split("/")[-2])
+                if id_ not in created:
+                    raise error(404)
+                body = {"elements": [version(id_, 2), version(id_, 3)]}
+            else:
+                ids = list(map(int, q["changesets"]))
+                changeset_batches.append(len(ids))
+                body = {"changesets": [changeset(i) for i in ids]}
+            yield json.dumps(body).encode()
+
+    def version(id_, v):
+        return {
+            "type": "node",
+            "id": id_,
+            "version": v,
+            "timestamp": f"201{v}-01-0{id_}T00:00:00Z",
+            "changeset": created[id_],
+        }
+
+    def changeset(id_):
+        return {
+            "id": id_,
+            "created_at": "2010-01-01T00:00:00Z",
+            "closed_at": "2010-01-01T01:00:00Z",
+            "tags": {"source": "survey"} if id_ == 10 else {},
+        }
+
+    def places():
+        return [
+            Place("osm", f"node/{i}", timestamp="2020-01-01T00:00:00Z")
+            for i in range(1, 6)
+        ] + [
+            Place(
+                "dbpedia",
+                "http://dbpedia.org/resource/A",
+                timestamp="2020-01-01T00:00:00Z",
+            )
+        ]
+
+    path = tmp_path / "history.sqlite"
+    with history.HistoryStore(path) as store:
+        out = list(
+            history.enrich(
+                places(), store, transport=Transport(), batch_size=4, workers=2
+            )
+        )
+
+    # Places are tagged with when they were first seen and last modified, in
+    # their original order
+    assert [p.id for p in out] == [p.id for p in places()]
+    assert out[0].tags == {
+        "first_seen": "2011-01-01T00:00:00Z",
+        "last_modified": "2020-01-01T00:00:00Z",
+        "first_seen:source": "survey",
+    }
+    assert "first_seen:source" not in out[1].tags
+
+    # Redacted versions fall back to the earliest in the element's history,
+    # and elements that never existed are left as they were
+    assert out[2].tags["first_seen"] == "2012-01-03T00:00:00Z"
+    assert "first_seen" not in out[3].tags
+    assert out[5].tags == {}
+
+    # Batches with missing elements are split until those are found, and
+    # each changeset is only looked up once
+    assert requests_made.count("changesets.json") == 1
+    assert requests_made.count("history.json") == 2
+    assert requests_made.count("nodes.json") > 2
+
+    # Histories are cached, so only missing elements are fetched again
+    requests_made.clear()
+    with history.HistoryStore(path) as store:
+        again = list(history.enrich(places(), store, transport=Transport()))
+    assert [p.tags for p in again] == [p.tags for p in out]
+    assert requests_made == ["nodes.json", "history.json"]
+
+    # Changesets are fetched at most 100 at a time, whatever the batch size
+    changeset_batches.clear()
+    with history.HistoryStore(tmp_path / "changesets.sqlite") as store:
+        sets = history.changesets(
+            range(1, 251), store, transport=Transport(), batch_size=500
+        )
+    assert sorted(sets) == list(range(1, 251))
+    assert sorted(changeset_batches) == [50, 100, 100]
+
+
+def _pb(field, value):
+    # A field of a Protocol Buffers message: a varint, bytes, or packed varints
+    def varint(n):
+        out = bytearray()
+        while n >= 0x80:
+            out.append(n & 0x7F | 0x80)
+            n >>= 7
+        return bytes([*out, n])
+
+    if isinstance(value, int):
+        return varint(field << 3) + varint(value)
+    if isinstance(value, list):
+        value = b"".join(map(varint, value))
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+def _sint(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _deltas(ns):
+    return [_sint(b - a) for a, b in zip([0, *ns], ns, strict=False)]
+
+
+def _blob(kind, data, compression="zlib"):
+    match compression:
+        case "zlib":
+            blob = _pb(2, len(data)) + _pb(3, zlib.compress(data))
+        case "lzma":
+            blob = _pb(2, len(data)) + _pb(4, lzma.compress(data))
+        case "zstd":
+            blob = _pb(2, len(data)) + _pb(7, data)
+    header = _pb(1, kind.encode()) + _pb(3, len(blob))
+    return len(header).to_bytes(4, "big") + header + blob
+
+
+def test_read_pbf(tmp_path):
+    strings = [b"", b"amenity", b"place_of_worship", b"name", b"St Paul's"]
+    strings += [b"building", b"chapel", b"church", b"outer", b"mapper"]
+    table = _pb(1, b"".join(_pb(1, s) for s in strings))
+    t, day = 1735689600, 86400  # 2025-01-01T00:00:00Z
+
+    def info(seconds):
+        # Version 2, by "mapper" in changeset 7
+        return _pb(4, _pb(1, 2) + _pb(2, seconds) + _pb(3, 7) + _pb(5, 9))
+
+    # Nodes 1 to 6 (densely encoded), of which node 1 is a place and node 6 is
+    # of no interest, and node 7 (not), a place since a day later
+    lats = [-412800000, -410000000, -410001000, -420000000, -420001000, 0]
+    dense = [
+        _pb(1, _deltas([1, 2, 3, 4, 5, 6])),
+        _pb(5, _pb(1, [1] * 6) + _pb(2, _deltas([t] * 6))),
+        _pb(8, _deltas(lats)),
+        _pb(9, _deltas([1747800000] * 6)),
+        _pb(10, [1, 2, 3, 4, 0, 0, 0, 0, 0, 0]),
+    ]
+    node = [
+        _pb(1, _sint(7)),
+        _pb(2, [5]),
+        _pb(3, [6]),
+        info(t + day),
+        _pb(8, _sint(-400000000)),
+        _pb(9, _sint(1740000000)),
+    ]
+    nodes = _pb(2, b"".join(dense)) + _pb(1, b"".join(node))
+
+    # Way 10 is a place, way 11 a member of relation 20 (also a place), and
+    # way 12 is of no interest
+    ways = b"".join(
+        [
+            _pb(
+                3,
+                _pb(1, 10)
+                + _pb(2, [1])
+                + _pb(3, [2])
+                + info(t)
+                + _pb(8, _deltas([2, 3, 2])),
+            ),
+            _pb(3, _pb(1, 11) + _pb(8, _deltas([4, 5, 4]))),
+            _pb(3, _pb(1, 12) + _pb(8, _deltas([6, 6]))),
+        ]
+    )
+    relation = [
+        _pb(1, 20),
+        _pb(2, [5]),
+        _pb(3, [7]),
+        info(t),
+        _pb(8, [8]),
+        _pb(9, _deltas([11])),
+        _pb(10, [1]),
+    ]
+
+    def extract(
+        features=(b"OsmSchema-V0.6", b"DenseNodes"), compression="zlib"
+    ):
+        header = b"".join(_pb(4, f) for f in features) + _pb(32, t + 2 * day)
+        return b"".join(
+            [
+                _blob("OSMHeader", header),
+                _blob("OSMData", table + _pb(2, nodes), compression),
+                # Blocks may be compressed differently
+                _blob("OSMData", table + _pb(2, ways), "lzma"),
+                _blob("OSMData", table + _pb(2, _pb(4, b"".join(relation)))),
+            ]
+        )
+
+    path = tmp_path / "extract.osm.pbf"
+    path.write_bytes(extract())
+
+    meta = {}
+    elements = list(pbf.read_pbf(path, workers=0, meta=meta))
+    assert meta == {"osm3s": {"timestamp_osm_base": "2025-01-03T00:00:00Z"}}
+    assert [(e["type"], e["id"]) for e in elements] == [
+        # Tagged nodes, as each block is decoded
+        ("node", 1),
+        ("node", 7),
+        # Then tagged ways and relations
+        ("way", 10),
+        ("relation", 20),
+        # Then (only) the ways and nodes that they reference, as skeletons
+        ("way", 11),
+        ("node", 2),
+        ("node", 3),
+        ("node", 4),
+        ("node", 5),
+    ]
+    assert elements[0] == {
+        "type": "node",
+        "id": 1,
+        "lat": -41.28,
+        "lon": 174.78,
+        "version": 1,
+        "timestamp": "2025-01-01T00:00:00Z",
+        "tags": {"amenity": "place_of_worship", "name": "St Paul's"},
+    }
+    assert elements[1] == {
+        "type": "node",
+        "id": 7,
+        "lat": -40.0,
+        "lon": 174.0,
+        "version": 2,
+        "timestamp": "2025-01-02T00:00:00Z",
+        "changeset": 7,
+        "user": "mapper",
+        "tags": {"building": "chapel"},
+    }
+    assert elements[3]["members"] == [
+        {"type": "way", "ref": 11, "role": "outer"}
+    ]
+    assert elements[4] == {"type": "way", "id": 11, "nodes": [4, 5, 4]}
+    assert elements[5] == {"type": "node", "id": 2, "lat": -41.0, "lon": 174.78}
+
+    # Blocks are decoded the same on a pool of processes
+    assert list(pbf.read_pbf(path, workers=2)) == elements
+
+    # Only places changed since a time are read
+    since = "2025-01-01T00:00:00Z"
+    assert [e["id"] for e in pbf.read_pbf(path, 0, since=since)] == [7]
+
+    # The source reads the extract rather than querying Overpass, with the
+    # time of its data as its watermark
+    src = source.OSM(pbf=path, workers=0)
+    places = {p.id: p for p in src.fetch()}
+    assert list(places) == ["node/1", "node/7", "way/10", "relation/20"]
+    assert places["way/10"].lat == pytest.approx(-41.0, abs=1e-3)
+    assert places["relation/20"].lat == pytest.approx(-42.0, abs=1e-3)
+    assert src.watermark == "2025-01-03T00:00:00Z"
+
+    # Data that cannot be read fail loudly
+    path.write_bytes(extract(compression="zstd"))
+    with pytest.raises(pbf.PBFError, match="compression"):
+        list(pbf.read_pbf(path, workers=0))
+    path.write_bytes(extract(features=(b"HistoricalInformation",)))
+    with pytest.raises(pbf.PBFError, match="HistoricalInformation"):
+        list(pbf.read_pbf(path, workers=0))
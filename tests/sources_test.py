@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from powdb.common.lazy import lazy
+from powdb.sources import (
+    SOURCES,
+    Source,
+    load_watermarks,
+    run_sources,
+    save_watermarks,
+)
+
+
+def test_run_sources():
+    # When each source produced its first and last records
+    spans = {}
+
+    def slow(n, delay, name=None):
+        def fetch():
+            for i in range(n):
+                time.sleep(delay)
+                spans.setdefault(name, []).append(time.perf_counter())
+                yield i
+
+        return fetch
+
+    def failing():
+        yield 1
+        raise RuntimeError("source failed")
+
+    records = []
+    sources = {"a": slow(5, 0.05, "a"), "b": slow(5, 0.05, "b"), "c": failing}
+
+    outcomes = asyncio.run(
+        run_sources(sources, lambda n, r: records.append((n, r)), batch_size=2)
+    )
+
+    # Sources run concurrently, so each starts before the other finishes
+    (a0, *_, a1), (b0, *_, b1) = spans["a"], spans["b"]
+    assert a0 < b1 and b0 < a1
+
+    # Every record is consumed, including those before a source fails, and the
+    # failing source does not stop the others
+    assert sorted(r for n, r in records if n == "a") == list(range(5))
+    assert sorted(r for n, r in records if n == "b") == list(range(5))
+    assert ("c", 1) in records
+    assert outcomes["a"].count == 5 and outcomes["a"].error is None
+    assert outcomes["c"].count == 1
+    assert isinstance(outcomes["c"].error, RuntimeError)
+
+    # Errors from the consumer stop everything
+    def consume(n, r):
+        raise ValueError("consumer failed")
+
+    with pytest.raises(ValueError, match="consumer failed"):
+        asyncio.run(run_sources({"a": slow(100, 0.001)}, consume, batch_size=1))
+
+
+def test_watermarks(tmp_path):
+    path = tmp_path / "data" / "watermarks.json"
+    assert load_watermarks(path) == {}
+
+    save_watermarks({"osm": "2025-06-01T00:00:00Z"}, path)
+    assert load_watermarks(path) == {"osm": "2025-06-01T00:00:00Z"}
+
+
+def test_registry():
+    for name, cls in SOURCES.items():
+        src = cls()
+        assert isinstance(src, Source)
+        assert src.name == name
+
+
+def _imported(code: str) -> set[str]:
+    # Modules imported by a fresh interpreter running `code`
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"{code}\nimport json, sys\nprint(json.dumps(list(sys.modules)))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+        env=os.environ | {"PYTHONPATH": os.pathsep.join(sys.path)},
+    ).stdout
+    return set(json.loads(out.splitlines()[-1]))
+
+
+def test_lazy_imports():
+    # Parsing arguments imports no source, nor their dependencies
+    modules = _imported("import cli; cli.parse_args([])")
+    assert "powdb.sources" in modules
+    for heavy in (
+        "asyncio",
+        "requests",
+        "sqlite3",
+        "powdb.sources.base",
+        "powdb.sources.osm.source",
+        "powdb.sources.dbpedia.source",
+    ):
+        assert heavy not in modules
+
+    # Looking up a source imports only that source
+    modules = _imported("from powdb.sources import SOURCES; SOURCES['osm']")
+    assert "powdb.sources.osm.source" in modules
+    assert "powdb.sources.dbpedia.source" not in modules
+    assert not any(m.startswith("powdb.sources.dbpedia") for m in modules)
+
+    # Names re-exported by packages are the objects, not their submodules
+    from powdb.common import utils
+    from powdb.common.utils.eltype import eltype
+    from powdb.common.utils.only import only
+
+    assert utils.eltype is eltype
+    assert utils.only is only
+    assert "unique" in dir(utils)
+    assert not hasattr(utils, "missing")
+
+    # Even if their submodules were imported first
+    _imported(
+        "from powdb.common.utils.unique import unique as f\n"
+        "from powdb.common.utils.eltype import TypeUnion\n"
+        "from powdb.common.utils import eltype, unique\n"
+        "from powdb import common\n"
+        "assert unique is f and common.unique is f, unique\n"
+        "assert callable(eltype) and common.eltype is eltype, eltype"
+    )
+    with pytest.raises(ValueError, match="named after their modules"):
+        lazy(utils.__name__, {"only": ".only"})
@@ -0,0 +1,199 @@
+import json
+import math
+import sqlite3
+import struct
+
+import pytest
+
+from powdb.common.record import Place
+from powdb.store import Categorical, Counts, Database, PlaceTable, Strings
+
+
+def _places():
+    return [
+        Place("osm", "node/1", "St Paul's", -41.28, 174.78, "christian"),
+        Place("osm", "way/2", None, None, None, "muslim", "sunni"),
+        Place("dbpedia", "http://dbpedia.org/resource/Ā", "Māori", 1.5, -2.5),
+        Place("osm", "node/3", "", 0.0, 0.0, "christian", "anglican"),
+    ]
+
+
+def test_columns():
+    c = Categorical(["a", None, "b", "a"])
+    assert list(c) == ["a", None, "b", "a"]
+    assert c.categories == ["a", "b"]
+    assert list(c.codes) == [0, -1, 1, 0]
+    assert c.code("b") == 1
+    assert c[1] is None and len(c) == 4
+
+    s = Strings(["abc", None, "", "ā"])
+    assert list(s) == ["abc", None, "", "ā"]
+    assert list(s.offsets) == [0, 3, 3, 3, 5]
+    assert len(s) == 4
+
+
+def test_place_table(tmp_path):
+    places = _places()
+    t = PlaceTable(places)
+
+    assert len(t) == len(places)
+    assert list(t) == places
+    assert t[-1] == places[-1]
+    assert math.isnan(t.lat[1])
+    assert t.religion.categories == ["christian", "muslim"]
+
+    # Round trips through a file, without copying its columns
+    path = tmp_path / "places.powdb"
+    t.save(path)
+    u = PlaceTable.load(path)
+    assert list(u) == places
+    assert isinstance(u.lat, memoryview)
+    assert u.source.categories == ["osm", "dbpedia"]
+    assert u.nbytes == t.nbytes
+
+    with pytest.raises(TypeError, match="loaded from file"):
+        u.append(places[0])
+
+    # Works for empty tables
+    PlaceTable().save(path)
+    assert len(PlaceTable.load(path)) == 0
+
+    path.write_bytes(b"not a table")
+    with pytest.raises(ValueError, match="Not a place table"):
+        PlaceTable.load(path)
+
+
+def test_database(tmp_path):
+    path = tmp_path / "places.gpkg"
+    places = _places()
+    places[0].tags = {"name:mi": "Hāto Pāora"}
+
+    with Database(path, batch_size=3) as db:
+        assert db.upsert(places[:3]) == 3
+        for p in places[2:]:
+            db.add(p)
+        assert len(db) == 4
+
+        # Indexes are not built until the database is closed
+        indexes = db._conn.execute("PRAGMA index_list(places)").fetchall()
+        assert {i[1] for i in indexes} == {"sqlite_autoindex_places_1"}
+
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        "SELECT source, id, name, lat, lon, tags, geom FROM places ORDER BY fid"
+    ).fetchall()
+    assert [r[:2] for r in rows] == [p.key for p in places]
+    assert rows[0][2:5] == ("St Paul's", -41.28, 174.78)
+    assert json.loads(rows[0][5]) == {"name:mi": "Hāto Pāora"}
+    assert rows[1][5] is None
+
+    # Locations are GeoPackage points, (lon, lat) in WGS 84
+    assert rows[0][6][:4] == b"GP\x00\x01"
+    point = struct.unpack("<iBIdd", rows[0][6][4:])
+    assert point == (4326, 1, 1, 174.78, -41.28)
+    assert rows[1][6] is None
+    assert conn.execute("PRAGMA application_id").fetchone() == (0x47504B47,)
+    (bounds,) = conn.execute(
+        "SELECT min_x, min_y, max_x, max_y FROM gpkg_contents"
+    ).fetchall()
+    assert bounds == (-2.5, -41.28, 174.78, 1.5)
+
+    # Places can be found by location with the R*Tree
+    found = conn.execute(
+        """
+        SELECT p.id FROM places p JOIN rtree_places_geom r ON p.fid = r.id
+        WHERE r.minx >= 170 AND r.maxx <= 180 AND r.miny >= -45
+        """
+    ).fetchall()
+    assert found == [("node/1",)]
+    conn.close()
+
+    # Publishing again updates places in place
+    with Database(path) as db:
+        places[0].name = "Old St Paul's"
+        places[0].lat = -41.0
+        db.upsert([places[0], Place("osm", "node/4")])
+        assert len(db) == 5
+
+    conn = sqlite3.connect(path)
+    assert conn.execute(
+        "SELECT fid, name, lat FROM places WHERE id = 'node/1'"
+    ).fetchall() == [(1, "Old St Paul's", -41.0)]
+    assert conn.execute(
+        "SELECT miny FROM rtree_places_geom WHERE id = 1"
+    ).fetchall() == [(-41.0,)]
+    indexes = {i[1] for i in conn.execute("PRAGMA index_list(places)")}
+    assert {"places_name", "places_religion"} <= indexes
+    conn.close()
+
+    # A plain SQLite database has no GeoPackage metadata
+    path = tmp_path / "places.db"
+    with Database(path) as db:
+        db.upsert(places)
+    conn = sqlite3.connect(path)
+    tables = {t for (t,) in conn.execute("SELECT name FROM sqlite_master")}
+    assert "places" in tables
+    assert "gpkg_contents" not in tables
+    assert conn.execute("SELECT count(geom) FROM places").fetchone() == (0,)
+    conn.close()
+
+    # A failed batch is rolled back
+    with Database(path) as db, pytest.raises(sqlite3.IntegrityError):
+        db.upsert([Place("osm", "node/5"), Place(None, "node/6")])
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT count(*) FROM places").fetchone() == (4,)
+    conn.close()
+
+
+def test_counts(tmp_path):
+    places = _places()
+    t = PlaceTable(places)
+    regions = Categorical(["Wellington", None, None, "Auckland"])
+
+    counts = Counts()
+    counts.update(t, region=regions)
+    assert len(counts) == 4
+    assert counts.by("religion") == {
+        ("christian",): 2,
+        ("muslim",): 1,
+        (None,): 1,
+    }
+    assert counts.by("source", "region") == {
+        ("osm", "Wellington"): 1,
+        ("osm", None): 1,
+        ("dbpedia", None): 1,
+        ("osm", "Auckland"): 1,
+    }
+    assert counts.by() == {(): 4}
+
+    # Updated incrementally, with only the places added since, even from a
+    # table whose categories are coded differently (as one loaded from file)
+    t.save(tmp_path / "places.powdb")
+    u = PlaceTable([Place("osm", "node/5", religion="hindu")])
+    u.extend(places)
+    n = len(u)
+    u.append(
+        Place("dbpedia", "x", religion="christian", denomination="anglican")
+    )
+    counts.update(u, start=n)
+    assert counts.by("religion", "denomination")[("christian", "anglican")] == 2
+    assert counts.by("region")[(None,)] == 3
+
+    # ...or discounted, as places are replaced
+    counts.subtract(PlaceTable.load(tmp_path / "places.powdb"), 1, 2)
+    assert len(counts) == 4
+    assert ("muslim",) not in counts.by("religion")
+
+    # Without regions, places are counted as in none
+    by_region = Counts(by=("region", "source"))
+    by_region.update(t)
+    assert by_region.by("region") == {(None,): 4}
+
+    assert counts.report("religion", top=2).splitlines() == [
+        "religion     places  share",
+        "christian         3  75.0%",
+        "None              1  25.0%",
+    ]
+
+    with pytest.raises(ValueError, match="Column region has 1 rows, not 4"):
+        counts.update(t, region=Categorical(["Auckland"]))